@@ -0,0 +1,9 @@
+""" Builds the minified, content-hashed bundles of scripts and stylesheets
+  loaded by the AppsCake pages. Run it from the AppsCake directory after
+  changing any of them.
+"""
+from src import assets
+
+manifest = assets.build()
+for name, path in sorted(manifest.items()):
+  print "{0} -> {1}".format(name, path)
@@ -0,0 +1,65 @@
+""" Gunicorn settings for serving AppsCake in production, behind nginx. Run
+  from the AppsCake directory with:
+
+    gunicorn -c config/gunicorn.py config.wsgi:application
+
+  Every process shares the state of deployments through the deployment
+  registry, so any worker of any instance can answer for any deployment.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+  __file__))))
+from src import host_discovery
+
+
+# The address to listen on when none is given with -b: APPSCAKE_BIND, or
+# else the host's private IP and APPSCAKE_PORT.
+bind = os.environ.get('APPSCAKE_BIND') or "{0}:{1}".format(
+  host_discovery.get_host_ips()['private_ip'],
+  os.environ.get('APPSCAKE_PORT', 8000))
+
+# The number of worker processes. Each runs at most
+# APPSCAKE_MAX_CONCURRENT_RUNS deployments and terminations of its own.
+workers = int(os.environ.get('APPSCAKE_WORKERS', 2))
+
+# Status event streams and long polls hold a thread for minutes, so every
+# worker serves requests from a pool of threads. At most
+# APPSCAKE_MAX_OPEN_STREAMS threads of a worker are held by streams at a
+# time, leaving the rest for other requests; raise both together.
+worker_class = 'gthread'
+threads = int(os.environ.get('APPSCAKE_THREADS', 16))
+
+# The number of seconds a worker may go without checking in before it is
+# restarted.
+timeout = 60
+
+# The number of seconds an idle connection from nginx is kept open. This is
+# longer than nginx keeps idle upstream connections, so that nginx is the
+# one to close them.
+keepalive = 75
+
+# Workers are never recycled after a number of requests, since the
+# deployments they started run inside them.
+max_requests = 0
+
+# Each worker imports the application itself. Its scheduler and thread
+# maps must not be shared with other workers.
+preload_app = False
+
+def post_fork(server, worker):
+  """ Starts the tools executor of a worker while the worker still has a
+  single thread, before its pool of request threads, when the tools run in
+  processes of their own. Forking later could copy a lock held by another
+  thread into the fork server, where it would never be released.
+
+  Args:
+    server: The gunicorn Arbiter.
+    worker: The gunicorn Worker which was just forked.
+  """
+  os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+  from django.conf import settings
+  if settings.APPSCAKE_TOOLS_BACKEND in ('process', 'forkserver'):
+    from src import views
+    views.get_executor()
@@ -25,6 +25,63 @@ DATABASES = {
     }
 }
 
+# Directory where the phase timings of finished AppScale tools runs are kept.
+# They are used to estimate the progress and completion time of later runs.
+APPSCAKE_TRANSCRIPT_DIR = 'db/transcripts'
+
+# Directory where the full output of each AppScale tools run is written.
+# Only the end of the output is kept in memory.
+APPSCAKE_LOG_DIR = 'db/logs'
+
+# The most AppScale tools runs (deployments and terminations) each AppsCake
+# process executes at once. Further runs wait in a queue.
+APPSCAKE_MAX_CONCURRENT_RUNS = 4
+
+# Where the AppScale tools run: 'thread' runs them inside each deployment
+# thread, 'process' runs them in a pool of APPSCAKE_MAX_CONCURRENT_RUNS
+# pre-forked worker processes which already have the tools imported, and
+# 'forkserver' runs each command in a fresh process forked from a server
+# which has initialized the tools once.
+APPSCAKE_TOOLS_BACKEND = 'thread'
+
+# The number of seconds during which repeated submissions of the same start
+# request (double-clicks, browser retries) go to the deployment the first
+# one started.
+APPSCAKE_DUPLICATE_WINDOW = 300
+
+# The number of seconds each node of a cluster layout has to answer on its
+# SSH port before a deployment to it is started.
+APPSCAKE_PREFLIGHT_TIMEOUT = 3
+
+# A running AppScale tools command is killed, and its run marked as timed
+# out, if it prints nothing for APPSCAKE_IDLE_OUTPUT_TIMEOUT seconds or spends
+# more than APPSCAKE_PHASE_TIMEOUT_FACTOR times the expected duration of a
+# phase in it.
+APPSCAKE_IDLE_OUTPUT_TIMEOUT = 1800
+APPSCAKE_PHASE_TIMEOUT_FACTOR = 4
+
+# The number of seconds a finished AppScale tools run is kept in memory
+# before it is archived in the deployment registry.
+APPSCAKE_RUN_TTL = 3600
+
+# The most terminations of one bulk terminate request that run at the same
+# time. They also count towards APPSCAKE_MAX_CONCURRENT_RUNS.
+APPSCAKE_BULK_TERMINATE_PARALLELISM = 2
+
+# The longest time, in seconds, a long-poll status request is held open
+# waiting for the status to change.
+APPSCAKE_LONG_POLL_TIMEOUT = 25
+
+# The longest time, in seconds, a server-sent event status stream stays
+# open before the browser has to reconnect.
+APPSCAKE_STATUS_STREAM_TIMEOUT = 300
+
+# The most status and tools log streams and long polls one process holds
+# open at a time. Each holds a request thread, so this must stay below the
+# threads of a gunicorn worker (see config/gunicorn.py); further requests
+# get a 503 response and are retried by the browser.
+APPSCAKE_MAX_OPEN_STREAMS = 12
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
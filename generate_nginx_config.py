@@ -1,13 +1,124 @@
+""" Writes the nginx site that serves AppsCake, from the nginx_config
+  template. Run with --help to see the options.
+"""
+import argparse
 import jinja2
-import os
-import socket
 
-my_public_ip = os.popen("curl -L http://metadata/computeMetadata/v1beta1/instance/network-interfaces/0/access-configs/0/external-ip").read()
-my_private_ip = socket.gethostbyname(socket.gethostname())
+from src import host_discovery
 
-template_contents = open('/root/appscake/nginx_config').read()
-template = jinja2.Template(template_contents)
-rendered_template = template.render(my_private_ip=my_private_ip, my_public_ip=my_public_ip)
+# The ports of the AppsCake servers nginx balances requests across, as
+# started by appscake.god.
+APPSCAKE_PORTS = [8000, 8001]
 
-with open('/etc/nginx/sites-available/default', 'w') as file_handle:
-  file_handle.write(rendered_template)
\ No newline at end of file
+# The idle connections to the AppsCake servers each nginx worker keeps.
+DEFAULT_UPSTREAM_KEEPALIVE = 16
+
+# The directory holding the static files of AppsCake.
+DEFAULT_STATIC_ROOT = "/root/appscake/src/static/"
+
+# The directory holding the page nginx shows when AppsCake fails or cannot
+# be reached.
+DEFAULT_ERROR_PAGE_ROOT = "/root/appscake/src/templates/"
+
+# The number of seconds browsers may cache static files other than bundles.
+DEFAULT_STATIC_MAX_AGE = 3600
+
+# The pages cached by nginx for a moment. The home page is left out, since
+# it carries a CSRF token and a submission token for each visitor.
+DEFAULT_MICROCACHE_PATHS = ["/about/"]
+
+# The number of seconds a page is kept in the microcache.
+DEFAULT_MICROCACHE_SECONDS = 1
+
+
+def get_parser():
+  """ Builds the parser of the command line options.
+
+  Returns:
+    An argparse.ArgumentParser.
+  """
+  parser = argparse.ArgumentParser(description="Writes the nginx site that "
+    "serves AppsCake.")
+  parser.add_argument("--template", default="/root/appscake/nginx_config",
+    help="the nginx site template")
+  parser.add_argument("--output",
+    default="/etc/nginx/sites-available/default",
+    help="where to write the nginx site")
+  parser.add_argument("--static-root", default=DEFAULT_STATIC_ROOT,
+    help="the directory nginx serves static files from")
+  parser.add_argument("--static-url", default="/static/",
+    help="the URL prefix of static files")
+  parser.add_argument("--static-max-age", type=int,
+    default=DEFAULT_STATIC_MAX_AGE,
+    help="seconds browsers may cache static files other than bundles "
+    "(0 to send no cache header)")
+  parser.add_argument("--error-page-root", default=DEFAULT_ERROR_PAGE_ROOT,
+    help="the directory holding 500.html, shown when AppsCake fails")
+  parser.add_argument("--no-gzip", dest="gzip", action="store_false",
+    help="do not compress responses")
+  parser.add_argument("--brotli-static", action="store_true",
+    help="serve .br copies of the bundles (needs the nginx brotli module)")
+  parser.add_argument("--upstream", action="append", metavar="HOST:PORT",
+    help="an AppsCake server (may be repeated; defaults to this host's "
+    "private IP on ports {0})".format(
+    ", ".join(str(port) for port in APPSCAKE_PORTS)))
+  parser.add_argument("--upstream-keepalive", type=int,
+    default=DEFAULT_UPSTREAM_KEEPALIVE,
+    help="idle connections to the servers kept by each nginx worker "
+    "(0 to close them)")
+  parser.add_argument("--microcache-path", action="append", metavar="PATH",
+    help="a page nginx caches for everyone (may be repeated; defaults to "
+    "{0})".format(", ".join(DEFAULT_MICROCACHE_PATHS)))
+  parser.add_argument("--microcache-seconds", type=int,
+    default=DEFAULT_MICROCACHE_SECONDS,
+    help="seconds a page is microcached (0 to turn microcaching off)")
+  parser.add_argument("--refresh-host-ips", action="store_true",
+    help="ask the metadata servers for this host's IPs again instead of "
+    "using the cached ones")
+  return parser
+
+def with_trailing_slash(path):
+  """ Ends a path or URL prefix with a slash, as nginx aliases need.
+
+  Args:
+    path: A str, the path.
+  Returns:
+    A str, the path ending in a slash.
+  """
+  if path.endswith("/"):
+    return path
+  return path + "/"
+
+def main():
+  """ Renders the nginx site from the command line options. """
+  options = get_parser().parse_args()
+
+  host_ips = host_discovery.get_host_ips(refresh=options.refresh_host_ips)
+  my_public_ip = host_ips['public_ip']
+  my_private_ip = host_ips['private_ip']
+
+  # The AppsCake servers listen on the host's private IP.
+  upstream_servers = options.upstream or ["{0}:{1}".format(my_private_ip,
+    port) for port in APPSCAKE_PORTS]
+  microcache_paths = []
+  if options.microcache_seconds > 0:
+    microcache_paths = options.microcache_path or DEFAULT_MICROCACHE_PATHS
+
+  template_contents = open(options.template).read()
+  template = jinja2.Template(template_contents)
+  rendered_template = template.render(my_private_ip=my_private_ip,
+    my_public_ip=my_public_ip, upstream_servers=upstream_servers,
+    upstream_keepalive=max(options.upstream_keepalive, 0),
+    static_root=with_trailing_slash(options.static_root),
+    static_url=with_trailing_slash(options.static_url),
+    static_max_age=max(options.static_max_age, 0),
+    error_page_root=with_trailing_slash(options.error_page_root),
+    gzip=options.gzip,
+    brotli_static=options.brotli_static, microcache_paths=microcache_paths,
+    microcache_seconds=max(options.microcache_seconds, 0))
+
+  with open(options.output, 'w') as file_handle:
+    file_handle.write(rendered_template)
+
+if __name__ == '__main__':
+  main()
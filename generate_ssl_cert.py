@@ -1,4 +1,9 @@
+import collections
+import multiprocessing.pool
+import os
+import shutil
 import subprocess
+import tempfile
 
 class NginxCert():
 
@@ -6,6 +11,16 @@ class NginxCert():
   # AppScale deployment metadata.
   LOCAL_NGINX_PATH = "/etc/nginx/"
 
+  # The number of days a new certificate is valid for.
+  VALID_DAYS = 365
+
+  # The number of seconds an existing certificate must still be valid for
+  # to be reused by main().
+  DEFAULT_MIN_VALIDITY = 30 * 24 * 60 * 60
+
+  # The most certificates generated at once by generate_ssl_certs.
+  MAX_PARALLEL = 4
+
 
   @classmethod
   def get_certificate_location(cls, keyname):
@@ -36,23 +51,154 @@ class NginxCert():
 
 
   @classmethod
-  def generate_ssl_cert(cls, keyname):
+  def get_ssl_link_location(cls, keyname):
+    """Determines the location of the link to the directory holding the
+    current private key and self-signed certificate of this AppScale
+    deployment. The key and certificate locations link through it, so both
+    are replaced at once by pointing it to another directory.
+
+    Args:
+      keyname: A str that indicates the name of the SSH keypair that
+        uniquely identifies this AppScale deployment.
+    Returns:
+      A str that indicates where the link can be found.
+    """
+    return cls.LOCAL_NGINX_PATH + keyname + "-ssl"
+
+
+  @classmethod
+  def replace_link(cls, target, link, temporary):
+    """Points a symbolic link to a new target in a single rename, so readers
+    see either the old target or the new one.
+
+    Args:
+      target: A str, the path the link should point to.
+      link: A str, the path of the link, which may already exist.
+      temporary: A str, an unused path on the same filesystem to create the
+        new link at before it is moved over the old one.
+    """
+    os.symlink(target, temporary)
+    os.rename(temporary, link)
+
+
+  @classmethod
+  def is_ssl_cert_valid(cls, keyname, min_validity):
+    """Checks if the key and self-signed certificate of an AppScale
+    deployment exist and the certificate stays valid for a while longer.
+
+    Args:
+      keyname: A str representing the SSH keypair name used for this AppScale
+        deployment.
+      min_validity: An int, the number of seconds the certificate must still
+        be valid for.
+    Returns:
+      True if the certificate can be reused, False otherwise.
+    """
+    certificate = cls.get_certificate_location(keyname)
+    if not os.path.exists(certificate) or \
+      not os.path.exists(cls.get_private_key_location(keyname)):
+      return False
+    with open(os.devnull, 'w') as devnull:
+      return subprocess.call(["openssl", "x509", "-checkend",
+        str(int(min_validity)), "-noout", "-in", certificate],
+        stdout=devnull, stderr=devnull) == 0
+
+
+  @classmethod
+  def generate_ssl_cert(cls, keyname, min_validity=None):
     """Generates a self-signed SSL certificate that AppScale services can use
     to encrypt traffic with.
 
     Args:
       keyname: A str representing the SSH keypair name used for this AppScale
         deployment.
-      is_verbose: A bool that indicates if we want to print out the certificate
-        generation to stdout or not.
+      min_validity: An int, the number of seconds an existing certificate
+        must still be valid for to be kept instead, or None to always
+        generate a new one.
+    Returns:
+      True if a new certificate was generated, False if the existing one was
+      kept.
+    Raises:
+      subprocess.CalledProcessError: If openssl could not generate the
+        certificate.
+    """
+    if min_validity is not None and \
+      cls.is_ssl_cert_valid(keyname, min_validity):
+      return False
+
+    # The key and certificate are written into a new directory, which then
+    # replaces the old one with a single rename of the link both locations
+    # go through, so nginx never reads a key without its certificate.
+    link = cls.get_ssl_link_location(keyname)
+    previous = None
+    if os.path.islink(link):
+      previous = os.path.join(os.path.dirname(link), os.readlink(link))
+    directory = tempfile.mkdtemp(prefix=os.path.basename(link) + ".",
+      dir=os.path.dirname(link))
+    swapped = False
+    try:
+      subprocess.check_call(["openssl", "req", "-new", "-newkey", "rsa:2048",
+        "-days", str(cls.VALID_DAYS), "-nodes", "-x509",
+        "-subj", "/C=US/ST=Foo/L=Bar/O=AppScale/CN=appscale.com",
+        "-keyout", os.path.join(directory, "key.pem"),
+        "-out", os.path.join(directory, "cert.pem")])
+      cls.replace_link(os.path.basename(directory), link,
+        os.path.join(directory, "ssl.link"))
+      swapped = True
+    finally:
+      if not swapped:
+        shutil.rmtree(directory, ignore_errors=True)
+    if previous is not None:
+      shutil.rmtree(previous, ignore_errors=True)
+
+    # Certificates written before this layout are plain files, which are
+    # replaced by links the first time.
+    for location, name in [(cls.get_private_key_location(keyname), "key.pem"),
+      (cls.get_certificate_location(keyname), "cert.pem")]:
+      target = os.path.join(os.path.basename(link), name)
+      if not os.path.islink(location) or os.readlink(location) != target:
+        cls.replace_link(target, location, os.path.join(directory,
+          name + ".link"))
+    return True
+
+
+  @classmethod
+  def generate_ssl_certs(cls, keynames, min_validity=None,
+    parallel=MAX_PARALLEL):
+    """Generates the self-signed SSL certificates of many AppScale
+    deployments at once.
+
+    Args:
+      keynames: A list of strs, the SSH keypair names of the deployments.
+      min_validity: An int, the number of seconds an existing certificate
+        must still be valid for to be kept instead, or None to always
+        generate new ones.
+      parallel: An int, the most certificates generated at once.
+    Returns:
+      A dict mapping each keyname to True if a new certificate was generated
+      for it, or False if its existing one was kept.
+    Raises:
+      subprocess.CalledProcessError: If openssl could not generate a
+        certificate.
     """
-    subprocess.call("openssl req -new -newkey rsa:2048 -days 365 -nodes -x509 " + \
-      "-subj '/C=US/ST=Foo/L=Bar/O=AppScale/CN=appscale.com' " + \
-      "-keyout {0} -out {1}".format(NginxCert.get_private_key_location(keyname),
-      NginxCert.get_certificate_location(keyname)), shell=True)
+    # Each keyname is generated once, however often it is given.
+    keynames = list(collections.OrderedDict.fromkeys(keynames))
+    if not keynames:
+      return {}
+    pool = multiprocessing.pool.ThreadPool(min(len(keynames),
+      max(int(parallel), 1)))
+    try:
+      generated = pool.map(
+        lambda keyname: cls.generate_ssl_cert(keyname, min_validity),
+        keynames)
+    finally:
+      pool.close()
+      pool.join()
+    return dict(zip(keynames, generated))
 
 def main():
-  NginxCert.generate_ssl_cert('appscake')
+  NginxCert.generate_ssl_cert('appscake',
+    min_validity=NginxCert.DEFAULT_MIN_VALIDITY)
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  main()
@@ -1,2 +1,4 @@
-import socket
-print socket.gethostbyname(socket.gethostname())
+""" Prints the private IP of this host, which AppsCake listens on. """
+from src import host_discovery
+
+print host_discovery.get_host_ips()['private_ip']
@@ -3,16 +3,17 @@
 """
 import base64
 import logging
-import os
-import sys
+import sqlite3
 import threading
+import time
 
-sys.path.append(os.path.join(os.path.dirname(__file__),"../appscale-tools/lib"))
-from appscale_tools import AppScaleTools
-from custom_exceptions import BadConfigurationException
-import parse_args
+import yaml
 
-from cStringIO import StringIO 
+import preflight
+import progress
+import registry
+import tools_output
+import tools_worker
 
 # Cluster deployment type. Examples include VirtualBox and KVM.
 CLUSTER = "cluster"
@@ -20,15 +21,296 @@ CLUSTER = "cluster"
 # Cloud deployment type. Examples include EC2 and Eucalyptus.
 CLOUD = "cloud"
 
-class AppScaleDown(threading.Thread):
+class ToolsRun(threading.Thread):
+  """ The parts shared by the threads running AppScale tools commands: the
+  capture of the tools output, progress tracking, the status published to
+  the deployment registry, and stopping a run early.
+  """
+
+  # States in which the thread was stopped before the tools finished.
+  STOPPED_STATES = []
+
+  # Lines of the tools output the thread looks for besides the phase
+  # markers of its progress model.
+  EXTRA_MARKERS = []
+
+  # The kind of run this thread is recorded as in the deployment registry.
+  REGISTRY_KIND = None
+
+  def __init__(self, deployment_type, keyname, command, placement=None,
+    transcript_store=None, deployment_registry=None, executor=None,
+    log_directory=None):
+    """ Constructor. Subclasses call register once they are set up.
+
+    Args:
+      deployment_type: A str, either cloud or cluster deployment.
+      keyname: A str, the keyname of the deployment.
+      command: A str, the tools command whose progress is tracked, as named
+        in progress.
+      placement: A str, the placement strategy of cloud deployments, or
+        None.
+      transcript_store: A progress.TranscriptStore used to estimate progress
+        from past runs and to record this one. Default phase durations are
+        used if not given.
+      deployment_registry: A registry.DeploymentRegistry to record this run
+        and its state transitions in.
+      executor: The tools_worker executor to run the tools with. They run in
+        this thread if not given.
+      log_directory: A str, the directory to write the full output of the
+        tools to. Only the end of the output is kept (in memory) if not
+        given.
+    """
+    threading.Thread.__init__(self)
+
+    self.deployment_type = deployment_type
+    self.keyname = keyname
+    self.state = self.INIT_STATE
+    self.err_message = ""
+    self.queue_position = None
+    self.finish_callbacks = []
+    self.exit_callbacks = []
+    self.exited = False
+    self.started_at = None
+    self.finished_at = None
+    self.job = tools_worker.ToolsJob()
+    self.stop_message = None
+    self.executor = executor or tools_worker.IN_PROCESS_EXECUTOR
+    self.transcript_store = transcript_store
+    if transcript_store:
+      model = transcript_store.get_model(command, deployment_type, placement)
+    else:
+      model = progress.get_default_model(command)
+    self.progress = progress.ProgressTracker(model)
+    markers = list(model.markers)
+    for marker in self.EXTRA_MARKERS:
+      if marker not in markers:
+        markers.append(marker)
+    self.std_out_capture = tools_output.CaptureStream(markers=markers,
+      listener=self.on_marker, log_path=self.get_log_path(log_directory,
+      "stdout"))
+    self.std_err_capture = tools_output.CaptureStream(
+      log_path=self.get_log_path(log_directory, "stderr"))
+
+    # The status read by others. It is replaced, never changed, on every
+    # transition.
+    self.status_lock = threading.Lock()
+    self.status = None
+    self.deployment_registry = deployment_registry
+
+  def register(self):
+    """ Takes the first snapshot of the status of this thread and adds it
+    to the deployment registry, if there is one.
+    """
+    self.status = registry.DeploymentStatus(self.get_status())
+    if self.deployment_registry:
+      self.deployment_registry.add(self)
+
+  def run(self):
+    """ Runs the tools if this thread is in a state to start them, and then
+    calls the functions waiting for it to finish.
+    """
+    # The watchdog measures how long the thread has been quiet from here,
+    # since checks before the tools start can stall too.
+    self.started_at = time.time()
+    try:
+      if self.state not in [self.INIT_STATE, self.QUEUED_STATE]:
+        logging.error("Bad state to start the {0} of {1}: {2}.".format(
+          self.REGISTRY_KIND, self.keyname, self.state))
+      else:
+        self.run_tools()
+    finally:
+      self.std_out_capture.close()
+      self.std_err_capture.close()
+      self.finished_at = time.time()
+      self.run_finish_callbacks()
+      self.run_exit_callbacks()
+    logging.debug("Thread has stopped.")
+
+  def run_tools(self):
+    """ Runs the tools command of this thread. """
+    raise NotImplementedError()
+
+  def set_state(self, state):
+    """ Moves the thread to a new state and records it in the deployment
+    registry.
+
+    Args:
+      state: A str, one of the states of this class.
+    """
+    # A run which was stopped stays stopped, even when its killed tools
+    # command then fails.
+    if self.state in self.STOPPED_STATES:
+      return
+    self.state = state
+    self.publish()
+
+  def time_out(self, message):
+    """ Stops this thread after the watchdog found it stalled. A tools
+    command running in a worker process is killed. One running in this
+    thread cannot be, so the thread keeps its scheduler slot until the
+    command ends on its own.
+
+    Args:
+      message: A str, why the run was stopped.
+    """
+    logging.error("Timed out {0}: {1}".format(self.keyname, message))
+    self.stop(self.TIMEOUT_STATE, message)
+
+  def stop(self, state, message):
+    """ Ends this thread early in one of the STOPPED_STATES. A tools command
+    running in a worker process is killed. One running in this thread
+    cannot be, so the thread is left to finish on its own. Either way, a
+    thread which started keeps its scheduler slot until it exits, so the
+    scheduler never runs more tools than it has slots for. A thread which
+    never started is finished right away.
+
+    Args:
+      state: A str, the state to end in.
+      message: A str, why the run was stopped.
+    """
+    self.stop_message = message
+    self.set_state(state)
+    self.job.cancel()
+    if self.ident is not None:
+      return
+    self.finished_at = time.time()
+    self.run_finish_callbacks()
+    self.run_exit_callbacks()
+
+  def set_queue_position(self, position):
+    """ Records the position of this thread in the scheduler's queue.
+
+    Args:
+      position: An int, the number of runs ahead of this one plus one.
+    """
+    if position != self.queue_position:
+      self.queue_position = position
+      self.publish()
+
+  def get_log_path(self, log_directory, name):
+    """ Determines the log file for one output stream of the tools.
+
+    Args:
+      log_directory: A str, the directory holding transcript logs, or None.
+      name: A str, stdout or stderr.
+    Returns:
+      A str, the path of the log file, or None if there is no log directory.
+    """
+    if not log_directory:
+      return None
+    return tools_output.get_log_path(log_directory, self.REGISTRY_KIND,
+      self.keyname, name)
+
+  def run_finish_callbacks(self):
+    """ Calls the functions waiting for this thread to finish, such as the
+    scheduler freeing its slot. A failing callback does not stop the others,
+    and each is only called once.
+    """
+    with self.status_lock:
+      callbacks, self.finish_callbacks = self.finish_callbacks, []
+    for callback in callbacks:
+      try:
+        callback(self)
+      except Exception as exception:
+        logging.exception(exception)
+
+  def add_exit_callback(self, callback):
+    """ Calls a function once this thread has exited, or right away if it
+    already has. These are called after the finish callbacks, once nothing
+    more runs in the thread.
+
+    Args:
+      callback: A function called with this thread.
+    """
+    with self.status_lock:
+      if not self.exited:
+        self.exit_callbacks.append(callback)
+        return
+    callback(self)
+
+  def run_exit_callbacks(self):
+    """ Calls the functions waiting for this thread to exit. A failing
+    callback does not stop the others.
+    """
+    with self.status_lock:
+      self.exited = True
+      callbacks, self.exit_callbacks = self.exit_callbacks, []
+    for callback in callbacks:
+      try:
+        callback(self)
+      except Exception as exception:
+        logging.exception(exception)
+
+  def on_marker(self, marker, line, offset):
+    """ Passes a phase marker found in the tools output on to the progress
+    tracker, and records the new status if the run moved to a later phase.
+
+    Args:
+      marker: A str, the marker found in the output.
+      line: A str, the line of output containing the marker.
+      offset: An int, the byte offset of the line in the output.
+    """
+    phase = self.progress.phase
+    self.progress.on_marker(marker, line, offset)
+    if self.progress.phase != phase:
+      self.publish()
+
+  def refresh_progress(self):
+    """ Moves the estimated progress of the tools on through the phase in
+    progress, and records the new status if the estimate changed. Only runs
+    whose tools are running are refreshed.
+
+    Returns:
+      True if a new status was recorded, False otherwise.
+    """
+    if self.finished_at is not None or self.state in self.STOPPED_STATES:
+      return False
+    if not self.progress.update():
+      return False
+    self.publish()
+    return True
+
+  def publish(self):
+    """ Takes a new snapshot of the status of this thread and records it in
+    the deployment registry, if there is one. Registry errors are logged but
+    do not stop the tools.
+    """
+    with self.status_lock:
+      self.status = registry.DeploymentStatus(self.get_status(),
+        self.progress.started_at, self.status.version + 1)
+      if not self.deployment_registry:
+        return
+      try:
+        self.deployment_registry.update(self.REGISTRY_KIND, self.keyname,
+          self.status)
+      except sqlite3.Error as db_error:
+        logging.exception(db_error)
+
+  def get_completion_percentage(self):
+    """ Gets an estimated percentage of how close to finished we are based
+    on the phases the tools have been through, weighted by how long each
+    phase usually takes.
+    
+    Returns:
+      An int, an estimated percentage below 100.
+    """
+    return self.progress.percent
+
+  def get_status(self):
+    """ Gets the status of this thread.
+
+    Returns:
+      A dict of the current status, with the state of the tools and
+      additional information depending on the state.
+    """
+    raise NotImplementedError()
+
+
+class AppScaleDown(ToolsRun):
   """ Runs terminate instances thread on a currently running AppScale 
   deployment. 
   """
 
-  # Expected number of lines of output from doing appscale-terminate-instances
-  # with verbose on.
-  EXPECTED_NUM_LINES = 5
-
   # Initialization state of the AppScaleDown thread. 
   # States are used internally by this class to keep track of where 
   # we are in the process of running appscale-terminate-instances. States are 
@@ -36,6 +318,10 @@ class AppScaleDown(threading.Thread):
   # current stage of the tools.
   INIT_STATE = "init"
 
+  # When waiting for a free slot in the scheduler before running
+  # appscale-terminate-instances.
+  QUEUED_STATE = "queued"
+
   # When appscale-terminate-instances is currently running.
   TERMINATING_STATE = "terminating"
   
@@ -45,8 +331,19 @@ class AppScaleDown(threading.Thread):
   # When there was an error when trying to terminate instances.
   ERROR_STATE = "error"
 
+  # When appscale-terminate-instances stalled and was stopped by the
+  # watchdog.
+  TIMEOUT_STATE = "timeout"
+
+  # States in which the thread was stopped before the tools finished.
+  STOPPED_STATES = [TIMEOUT_STATE]
+
+  # The kind of run this thread is recorded as in the deployment registry.
+  REGISTRY_KIND = registry.TERMINATION
+
   def __init__(self, deployment_type, keyname, ec2_access=None, 
-    ec2_secret=None, ec2_url=None):
+    ec2_secret=None, ec2_url=None, transcript_store=None,
+    deployment_registry=None, executor=None, log_directory=None):
     """ A constructor setting up the required arguments for running
     appscale-terminate-instances. Named arguments are for cloud
     deployments.
@@ -58,30 +355,32 @@ class AppScaleDown(threading.Thread):
       ec2_secret: A str, the EC2/Euca secret key.
       ec2_url: A str, a URL pointing to where the EC2/Euca cloud is located. 
         (required for Euca).
+      transcript_store: A progress.TranscriptStore used to estimate progress
+        from past runs and to record this one. Default phase durations are
+        used if not given.
+      deployment_registry: A registry.DeploymentRegistry to record this run
+        and its state transitions in.
+      executor: The tools_worker executor to run the tools with. They run in
+        this thread if not given.
+      log_directory: A str, the directory to write the full output of the
+        tools to. Only the end of the output is kept (in memory) if not
+        given.
     """
-    threading.Thread.__init__(self)
-
-    self.state = self.INIT_STATE
-    self.deployment_type = deployment_type
-    self.keyname = keyname
+    ToolsRun.__init__(self, deployment_type, keyname,
+      progress.TERMINATE_INSTANCES, transcript_store=transcript_store,
+      deployment_registry=deployment_registry, executor=executor,
+      log_directory=log_directory)
     self.ec2_access = ec2_access
     self.ec2_secret = ec2_secret
     self.ec2_url = ec2_url
-    self.err_message = ""
-    self.std_out_capture = StringIO()
-    self.std_err_capture = StringIO()
+    self.register()
 
-  def run(self):
-    """ Checks the current state of the thread and terminates AppScale. """
-    logging.debug("AppScaleDown thread has started.")
-    if self.state != self.INIT_STATE:
-      logging.error("Bad state to start terminating instances: {0}.". \
-        format(self.state))
-    elif not self.appscale_down():
+  def run_tools(self):
+    """ Terminates AppScale. """
+    if not self.appscale_down():
       logging.error("Unable to shut down AppScale.")
     else:
       logging.info("AppScale deployment was successfully terminated.") 
-    logging.debug("Thread has stopped.")
 
   def appscale_down(self):
     """ Terminates a currently running deployment of AppScale. Calls on the 
@@ -92,14 +391,8 @@ class AppScaleDown(threading.Thread):
       True on success, False otherwise. 
     """
     logging.debug("Starting AppScale down.")
-    self.state = self.TERMINATING_STATE
-
-    # We capture the stdout and stderr of the tools and use it to calculate
-    # the percentage towards completion.
-    old_stdout = sys.stdout
-    old_stderr = sys.stderr
-    sys.stdout = self.std_out_capture
-    sys.stderr = self.std_err_capture
+    self.progress.start()
+    self.set_state(self.TERMINATING_STATE)
 
     terminate_args = ['--keyname', self.keyname, "--verbose"]
 
@@ -110,24 +403,26 @@ class AppScaleDown(threading.Thread):
     try: 
       logging.info("Starting terminate instances.")
 
-      options = parse_args.ParseArgs(terminate_args, 
-        "appscale-terminate-instances").args
-      AppScaleTools.terminate_instances(options)
-      self.state = self.TERMINATED_STATE
+      # We capture the stdout and stderr of the tools and use it to calculate
+      # the percentage towards completion. Only this run's output is
+      # captured, so other deployments can run at the same time.
+      self.executor.execute("terminate_instances", terminate_args,
+        self.std_out_capture, self.std_err_capture, self.job)
 
       logging.info("AppScale terminate instances successfully ran!")
-    except BadConfigurationException as bad_config:
-      self.state = self.ERROR_STATE
+      if self.transcript_store:
+        self.transcript_store.save(progress.TERMINATE_INSTANCES,
+          self.deployment_type, None, self.keyname, self.progress)
+      self.set_state(self.TERMINATED_STATE)
+    except tools_worker.BadConfigurationException as bad_config:
       logging.exception(bad_config)
       self.err_message = "Bad configuration. Unable to terminate AppScale. " \
         "{0}".format(bad_config)
+      self.set_state(self.ERROR_STATE)
     except Exception as exception:
-      self.state = self.ERROR_STATE
       logging.exception(exception)
       self.err_message = "Exception when terminating: {0}".format(exception)
-    finally:
-      sys.stdout = old_stdout
-      sys.stderr = old_stderr
+      self.set_state(self.ERROR_STATE)
 
     return self.state == self.TERMINATED_STATE
 
@@ -143,33 +438,20 @@ class AppScaleDown(threading.Thread):
     status_dict = {'status': self.state, 'percent': 0}
     if self.state == self.INIT_STATE:
       pass
+    elif self.state == self.QUEUED_STATE:
+      status_dict['queue_position'] = self.queue_position
     elif self.state == self.TERMINATING_STATE:
       status_dict['percent'] = self.get_completion_percentage()
+      status_dict['eta'] = self.progress.eta
     elif self.state == self.TERMINATED_STATE:
       status_dict['percent'] = 100
+    elif self.state == self.TIMEOUT_STATE:
+      status_dict['error_message'] = self.stop_message
     else:
       status_dict['error_message'] = "Unknown state"
     return status_dict
 
-  def get_completion_percentage(self):
-    """ Gets an estimated percentage of how close to finished we are based
-    on the number of lines output by appscale-terminate-instances.
-    
-    Returns:
-      An int, an estimated percentage up to 100.
-    """
-    logging.debug("Captured tools output thus far: {0}". \
-      format(self.std_out_capture.getvalue()))
-
-    count = self.std_out_capture.getvalue().count('\n')
-    if count >= self.EXPECTED_NUM_LINES:
-      count = self.EXPECTED_NUM_LINES - 1
-
-    percentage = int((float(count)/float(self.EXPECTED_NUM_LINES)) * 100)
-    return percentage
-
-
-class AppScaleUp(threading.Thread):
+class AppScaleUp(ToolsRun):
   """ Runs the AppScale tools command appscale-run-instances to start a new 
   AppScale deployment. 
   """
@@ -180,6 +462,10 @@ class AppScaleUp(threading.Thread):
   # shared with the web front end in JSON format for the user to know the 
   # current stage of the tools.
   INIT_STATE = "initializing"
+
+  # When waiting for a free slot in the scheduler before running
+  # appscale-run-instances.
+  QUEUED_STATE = "queued"
  
   # When appscale-run-instances in currently running.
   RUNNING_STATE = "running"
@@ -189,6 +475,15 @@ class AppScaleUp(threading.Thread):
 
   # When appscale-run-instances ended in an error state.
   ERROR_STATE = "error"
+
+  # When appscale-run-instances stalled and was stopped by the watchdog.
+  TIMEOUT_STATE = "timeout"
+
+  # When the deployment was cancelled by the user.
+  CANCELLED_STATE = "cancelled"
+
+  # States in which the thread was stopped before the tools finished.
+  STOPPED_STATES = [TIMEOUT_STATE, CANCELLED_STATE]
  
   # Automatic layout of roles in AppScale. User supplies the minimum and 
   # maximum number of nodes.
@@ -198,19 +493,24 @@ class AppScaleUp(threading.Thread):
   # go on which nodes in an ips.yaml configuration.
   ADVANCED = "advanced"
 
-  # Expected number of lines of output from doing appscale-run-instances.
-  EXPECTED_NUM_LINES = 17
-
   # Contents of the line which contains the status link from the tools output.
   STATUS_LINK_LINE = "View status information about your AppScale deployment at"
 
+  # Lines of the tools output looked for besides the phase markers.
+  EXTRA_MARKERS = [STATUS_LINK_LINE]
+
   # The default location URL for EC2.
   EC2_URL_DEFAULT = "https://ec2.us-east-1.amazonaws.com"
 
+  # The kind of run this thread is recorded as in the deployment registry.
+  REGISTRY_KIND = registry.DEPLOYMENT
+
   def __init__(self, deployment_type, keyname, admin_email, admin_pass, 
     root_pass=None, placement=None, infrastructure=None, min_nodes=None, 
     max_nodes=None, machine=None, instance_type=None, ips_yaml=None, 
-    ec2_secret=None, ec2_access=None, ec2_url=None):
+    ec2_secret=None, ec2_access=None, ec2_url=None, transcript_store=None,
+    deployment_registry=None, executor=None, log_directory=None,
+    preflight_timeout=preflight.DEFAULT_TIMEOUT):
     """ A constructor setting up the required arguments for running
     appscale-run-instances. 
     
@@ -231,16 +531,30 @@ class AppScaleUp(threading.Thread):
       ec2_secret: A str, the EC2 secret key for EC2 and Euca.
       ec2_access: A str, the EC2 access key for EC2 and Euca.
       ec2_url: A str, the EC2 URL location for EC2 and Euca.
+      transcript_store: A progress.TranscriptStore used to estimate progress
+        from past runs and to record this one. Default phase durations are
+        used if not given.
+      deployment_registry: A registry.DeploymentRegistry to record this run
+        and its state transitions in.
+      executor: The tools_worker executor to run the tools with. They run in
+        this thread if not given.
+      log_directory: A str, the directory to write the full output of the
+        tools to. Only the end of the output is kept (in memory) if not
+        given.
+      preflight_timeout: A float, the number of seconds to wait for each
+        node of a cluster layout to answer before the tools are run.
     """
-    threading.Thread.__init__(self)
+    ToolsRun.__init__(self, deployment_type, keyname,
+      progress.RUN_INSTANCES, placement=placement,
+      transcript_store=transcript_store,
+      deployment_registry=deployment_registry, executor=executor,
+      log_directory=log_directory)
 
     logging.basicConfig(format='%(asctime)s %(levelname)s %(filename)s:' \
       '%(lineno)s %(message)s ', level=logging.INFO)
 
-    self.keyname = keyname
     self.admin_email = admin_email
     self.admin_pass = admin_pass
-    self.deployment_type = deployment_type # cloud or cluster
     self.placement = placement # simple or advance
     self.max_nodes = max_nodes
     self.machine = machine
@@ -258,30 +572,23 @@ class AppScaleUp(threading.Thread):
     if ips_yaml:
       self.ips_yaml_b64 = base64.b64encode(str(ips_yaml))
 
-    self.std_out_capture = StringIO()
-    self.std_err_capture = StringIO()
-    self.state = self.INIT_STATE
-    self.err_message = "" 
     self.args = ['--table', 'cassandra']
     self.args.extend(["--admin_user", self.admin_email,
                       "--admin_pass", self.admin_pass,
                       "--keyname", self.keyname])
     self.link = None
     self.root_pass = root_pass
+    self.preflight_timeout = preflight_timeout
+    self.register()
 
     logging.debug("Initial arguments: {0}".format(self.args))
  
-  def run(self):
-    """ Checks the current state of an AppScale deployment and starts a 
-    deployment if in the correct state. 
-    """
-    if self.state != self.INIT_STATE:
-      logging.error("Bad state to start a new thread for AppScaleUp.")
-    elif not self.appscale_up():
+  def run_tools(self):
+    """ Starts a deployment of AppScale. """
+    if not self.appscale_up():
       logging.error("Unable to start AppScale.")
     else:
       logging.info("AppScale was successfully deployed!")
-    logging.debug("Thread has stopped.")
 
   def appscale_up(self): 
     """ Starts up an AppScale deployment. Checks the type of deployment
@@ -293,7 +600,7 @@ class AppScaleUp(threading.Thread):
     Raises:
       NotImplementedError: If there is an unknown placement or deployment.
     """
-    self.state = self.RUNNING_STATE
+    self.set_state(self.RUNNING_STATE)
 
     if self.deployment_type == CLOUD:
       if self.placement == self.SIMPLE:
@@ -316,24 +623,23 @@ class AppScaleUp(threading.Thread):
     Returns:
       True on success, False otherwise.
     """
-    self.state = self.INIT_STATE
+    self.set_state(self.INIT_STATE)
     add_keypair_args = ['--keyname', self.keyname, '--ips_layout', 
       self.ips_yaml_b64, "--root_password", self.root_pass, "--auto"]
-    options = parse_args.ParseArgs(add_keypair_args, "appscale-add-keypair"). \
-      args
     try:
-      AppScaleTools.add_keypair(options)
+      self.executor.execute("add_keypair", add_keypair_args,
+        self.std_out_capture, self.std_err_capture, self.job)
       logging.info("AppScale add key pair was successful")
-    except BadConfigurationException as bad_config:
-      self.state = self.ERROR_STATE
+    except tools_worker.BadConfigurationException as bad_config:
       logging.error(str(bad_config))
       self.err_message = "Bad configuration. Unable to set up keypairs."
+      self.set_state(self.ERROR_STATE)
       return False
     except Exception as exception:
-      self.state = self.ERROR_STATE
       logging.exception(exception)
       self.err_message = "Exception when running add key pair: {0}". \
         format(exception)
+      self.set_state(self.ERROR_STATE)
       return False
     return True
 
@@ -344,11 +650,38 @@ class AppScaleUp(threading.Thread):
       True on success, False otherwise.
     """
     self.args.extend(["--ips_layout", self.ips_yaml_b64])
-    if self.run_add_keypair():
+    if self.run_preflight() and self.run_add_keypair():
       return self.run_appscale()
     else:
       return False
 
+  def run_preflight(self):
+    """ Checks that every node in the ips.yaml layout answers on its SSH
+    port, all at once, before any tools are run.
+
+    Returns:
+      True if every node answered, False otherwise.
+    """
+    try:
+      ips = preflight.get_ips(self.ips_yaml)
+    except yaml.YAMLError as yaml_error:
+      logging.error(str(yaml_error))
+      self.err_message = "Unable to parse ips.yaml: {0}".format(yaml_error)
+      self.set_state(self.ERROR_STATE)
+      return False
+
+    reports = preflight.check_nodes(ips, self.preflight_timeout)
+    for report in reports:
+      logging.info("Pre-flight check of {0}: {1}".format(report['ip'],
+        report['error'] or "{0:.3f}s".format(report['latency'])))
+    failures = preflight.get_failures(reports)
+    if failures:
+      self.err_message = "Unable to reach nodes over SSH: {0}".format(
+        failures)
+      self.set_state(self.ERROR_STATE)
+      return False
+    return True
+
   def run_advance_cloud_deploy(self):
     """ Sets up deployment arguments of an advance cloud layout and 
     starts up AppScale.
@@ -389,63 +722,60 @@ class AppScaleUp(threading.Thread):
     """
     logging.info("Tools arguments: {0}".format(str(self.args)))
 
-    self.state = self.RUNNING_STATE
-    old_stdout = sys.stdout
-    old_stderr = sys.stderr
+    self.progress.start()
+    self.set_state(self.RUNNING_STATE)
 
     try:
-      options = parse_args.ParseArgs(self.args, "appscale-run-instances").args
-      sys.stdout = self.std_out_capture
-      sys.stderr = self.std_err_capture
-
-      AppScaleTools.run_instances(options)
+      self.executor.execute("run_instances", self.args, self.std_out_capture,
+        self.std_err_capture, self.job)
       logging.info("AppScale run instances was successful!")
-      self.state = self.COMPLETE_STATE 
       self.set_status_link()
-    except BadConfigurationException as bad_config:
-      self.state = self.ERROR_STATE
+      if self.transcript_store:
+        self.transcript_store.save(progress.RUN_INSTANCES,
+          self.deployment_type, self.placement, self.keyname, self.progress)
+      self.set_state(self.COMPLETE_STATE)
+    except tools_worker.BadConfigurationException as bad_config:
       logging.exception(bad_config)
       self.err_message = "Bad configuration. {0}".format(bad_config)
+      self.set_state(self.ERROR_STATE)
     except Exception as exception:
-      self.state = self.ERROR_STATE
       logging.exception(exception)
       self.err_message = "Exception--{0}".format(exception)
+      self.set_state(self.ERROR_STATE)
     except SystemExit as sys_exit:
-      self.state = self.ERROR_STATE
       logging.error(str(sys_exit))
       self.err_message = str("Error with given arguments caused system exit.")
-    finally:
-      sys.stdout = old_stdout
-      sys.stderr = old_stderr
+      self.set_state(self.ERROR_STATE)
  
     return self.state == self.COMPLETE_STATE
 
   def set_status_link(self):
     """ Parses the output of the tools and sets the status link. """
-    lines = self.std_out_capture.getvalue().split('\n')
-    for line in lines:
-      if self.STATUS_LINK_LINE in line:
-        self.link = line.split(' ')[-1]
-        self.link = self.link.split('status')[0]
-        logging.info("AppScale status link: {0}".format(self.link))
-        return
+    line = self.std_out_capture.get_marker_line(self.STATUS_LINK_LINE)
+    if line:
+      self.link = line.split(' ')[-1]
+      self.link = self.link.split('status')[0]
+      logging.info("AppScale status link: {0}".format(self.link))
   
-  def get_completion_percentage(self):
-    """ Gets an estimated percentage of how close to finished we are based
-    on the number of lines output by appscale-run-instances.
-    
+  def cancel(self, message):
+    """ Stops this deployment, whether it is queued or running. A deployment
+    whose tools run in this thread, which cannot be interrupted, is left
+    running.
+
+    Args:
+      message: A str, shown to the user as the reason.
     Returns:
-      An int, an estimated percentage up to 100.
+      True if the deployment was stopped, False if it had already finished.
+    Raises:
+      tools_worker.CommandNotCancellable: If the tools are running in this
+        thread.
     """
-    logging.debug("Captured tools output thus far: {0}". \
-      format(self.std_out_capture.getvalue()))
-
-    count = self.std_out_capture.getvalue().count('\n')
-    if count >= self.EXPECTED_NUM_LINES:
-      count = self.EXPECTED_NUM_LINES - 1
-
-    percentage = int((float(count)/float(self.EXPECTED_NUM_LINES)) * 100)
-    return percentage
+    if self.state in registry.FINISHED_STATES:
+      return False
+    self.job.cancel_now()
+    logging.info("Cancelling deployment {0}.".format(self.keyname))
+    self.stop(self.CANCELLED_STATE, message)
+    return True
 
   def get_status(self):
     """ Sees what the current status of an AppScale deployment is.
@@ -458,13 +788,18 @@ class AppScaleUp(threading.Thread):
     status_dict = {'status': self.state, 'percent': 0}
     if self.state == self.INIT_STATE:
       pass
+    elif self.state == self.QUEUED_STATE:
+      status_dict['queue_position'] = self.queue_position
     elif self.state == self.ERROR_STATE:
       status_dict['error_message'] = self.err_message
     elif self.state == self.RUNNING_STATE:
       status_dict['percent'] = self.get_completion_percentage()
+      status_dict['eta'] = self.progress.eta
     elif self.state == self.COMPLETE_STATE:
       status_dict['percent'] = 100 
       status_dict['link'] = self.link
+    elif self.state in self.STOPPED_STATES:
+      status_dict['error_message'] = self.stop_message
     else:
       status_dict['error_message'] = "Unknown state"
     return status_dict
@@ -0,0 +1,317 @@
+""" Combines the scripts and stylesheets loaded by every AppsCake page into a
+  few minified bundles. Each bundle is named after a hash of its contents,
+  so it can be cached by browsers forever, and has a gzipped copy next to
+  it for nginx to serve as is.
+"""
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import threading
+from cStringIO import StringIO
+
+
+# The directory holding the static files of AppsCake.
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  "static")
+
+# The directory, relative to the static files, the bundles are written to.
+BUNDLE_DIR = "bundles"
+
+# The file in BUNDLE_DIR mapping the name of each bundle to its file.
+MANIFEST_NAME = "manifest.json"
+
+# The static files each bundle is made of, in the order they are loaded.
+BUNDLES = {
+  'head.js': [
+    "js/parsley.js",
+    "js/libs/modernizr-2.6.2-respond-1.1.0.min.js",
+    "js/flat-js/jquery-1.8.2.min.js",
+    "js/flat-js/jquery-ui-1.10.0.custom.min.js",
+  ],
+  'app.js': [
+    "js/plugins.js",
+    "js/main.js",
+    "js/bootstrap.js",
+    "js/flat-js/custom_checkbox_and_radio.js",
+    "js/flat-js/custom_radio.js",
+    "js/flat-js/html5shiv.js",
+    "js/flat-js/bootstrap-tooltip.js",
+    "js/flat-js/jquery.placeholder.js",
+    "js/flat-js/application.js",
+  ],
+  'style.css': [
+    "css/style.css",
+  ],
+}
+
+# The number of hex digits of the content hash put in bundle names.
+HASH_LENGTH = 12
+
+# Matches an @import rule, capturing the imported URL and any media query.
+CSS_IMPORT = re.compile(r"""@import\s+(?:url\(\s*['"]?([^'")]+)['"]?\s*\)|"""
+  r"""['"]([^'"]+)['"])\s*([^;]*);""")
+
+# Matches a comment, other than a /*! license comment.
+CSS_COMMENT = re.compile(r"/\*(?!!).*?\*/", re.DOTALL)
+
+# Matches a url() reference, capturing its quote and the URL.
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+# The manifest last read, with its path and the time it was last changed.
+MANIFEST_CACHE = {'path': None, 'mtime': None, 'bundles': {}}
+
+# Guards MANIFEST_CACHE.
+MANIFEST_LOCK = threading.Lock()
+
+
+def is_local_url(url):
+  """ Checks if a URL in a stylesheet refers to a file next to it.
+
+  Args:
+    url: A str, the URL.
+  Returns:
+    True if the URL is relative to the stylesheet, False otherwise.
+  """
+  return not (url.startswith("/") or url.startswith("data:") or
+    "://" in url)
+
+def rebase_url(url, source_dir):
+  """ Rewrites a relative URL of a stylesheet so that it still points at the
+  same file from a bundle in BUNDLE_DIR.
+
+  Args:
+    url: A str, the URL relative to the stylesheet.
+    source_dir: A str, the directory of the stylesheet, relative to the
+      static files.
+  Returns:
+    A str, the URL relative to BUNDLE_DIR.
+  """
+  if not is_local_url(url):
+    return url
+  path = re.split(r"[?#]", url, 1)[0]
+  suffix = url[len(path):]
+  target = posixpath.normpath(posixpath.join(source_dir, path))
+  return posixpath.relpath(target, BUNDLE_DIR) + suffix
+
+def rebase_urls(contents, source_dir):
+  """ Rewrites every relative URL in part of a stylesheet for BUNDLE_DIR.
+
+  Args:
+    contents: A str, the part of the stylesheet.
+    source_dir: A str, the directory of the stylesheet, relative to the
+      static files.
+  Returns:
+    A str, the part of the stylesheet with its URLs rewritten.
+  """
+  return CSS_URL.sub(lambda match: 'url("{0}")'.format(
+    rebase_url(match.group(2), source_dir)), contents)
+
+def read_stylesheet(path, static_dir, remote_imports):
+  """ Reads a stylesheet with its local @import rules replaced by the
+  stylesheets they import, and its URLs rewritten for BUNDLE_DIR.
+
+  Args:
+    path: A str, the stylesheet's path relative to the static files.
+    static_dir: A str, the directory holding the static files.
+    remote_imports: A list of strs, where the @import rules of remote
+      stylesheets are added. They have to come first in the bundle.
+  Returns:
+    A str, the contents of the stylesheet.
+  """
+  source_dir = posixpath.dirname(path)
+  with open(os.path.join(static_dir, path)) as file_handle:
+    contents = file_handle.read()
+  # Comments may mention @import rules and are left out of the bundle anyway.
+  contents = CSS_COMMENT.sub("", contents)
+
+  def inline_import(match):
+    url, media = match.group(1) or match.group(2), match.group(3).strip()
+    if not is_local_url(url):
+      remote_imports.append(match.group(0))
+      return ""
+    imported = read_stylesheet(posixpath.normpath(posixpath.join(source_dir,
+      url)), static_dir, remote_imports)
+    if media:
+      return "@media {0} {{\n{1}\n}}\n".format(media, imported)
+    return imported + "\n"
+
+  # Imported stylesheets have had their own URLs rewritten already.
+  pieces = []
+  position = 0
+  for match in CSS_IMPORT.finditer(contents):
+    pieces.append(rebase_urls(contents[position:match.start()], source_dir))
+    pieces.append(inline_import(match))
+    position = match.end()
+  pieces.append(rebase_urls(contents[position:], source_dir))
+  return "".join(pieces)
+
+def minify(name, contents):
+  """ Minifies the contents of a bundle.
+
+  Args:
+    name: A str, the name of the bundle.
+    contents: A str, the combined scripts or stylesheets.
+  Returns:
+    A str, the minified contents.
+  """
+  # The minifiers are only needed when building the bundles.
+  if name.endswith(".css"):
+    import rcssmin
+    return rcssmin.cssmin(contents, keep_bang_comments=True)
+  import rjsmin
+  return rjsmin.jsmin(contents, keep_bang_comments=True)
+
+def combine(name, sources, static_dir=STATIC_DIR):
+  """ Combines the static files of a bundle, without minifying them.
+
+  Args:
+    name: A str, the name of the bundle. Bundles ending in .css are
+      stylesheets and the rest are scripts.
+    sources: A list of strs, the paths of the files relative to the static
+      files.
+    static_dir: A str, the directory holding the static files.
+  Returns:
+    A str, the contents of the bundle.
+  """
+  if name.endswith(".css"):
+    remote_imports = []
+    stylesheets = [read_stylesheet(source, static_dir, remote_imports)
+      for source in sources]
+    return "\n".join(remote_imports + stylesheets)
+
+  scripts = []
+  for source in sources:
+    with open(os.path.join(static_dir, source)) as file_handle:
+      scripts.append(file_handle.read())
+  # Scripts which leave out their last semicolon must not run into the next.
+  return ";\n".join(scripts)
+
+def write_file(path, contents):
+  """ Writes a file of a build under a temporary name and then renames it,
+  so that neither servers nor builds running at the same time see it
+  partly written.
+
+  Args:
+    path: A str, the path of the file.
+    contents: A str, the contents of the file.
+  """
+  temporary_path = "{0}.{1}.tmp".format(path, os.getpid())
+  with open(temporary_path, 'wb') as file_handle:
+    file_handle.write(contents)
+  os.rename(temporary_path, path)
+
+def gzip_contents(name, contents):
+  """ Compresses a bundle with gzip.
+
+  Args:
+    name: A str, the file name stored in the gzip header.
+    contents: A str, the contents of the bundle.
+  Returns:
+    A str, the compressed contents.
+  """
+  output = StringIO()
+  # A fixed modification time keeps the compressed copy the same across
+  # builds.
+  compressed = gzip.GzipFile(name, 'wb', 9, output, 0)
+  compressed.write(contents)
+  compressed.close()
+  return output.getvalue()
+
+def write_bundle(name, contents, static_dir=STATIC_DIR):
+  """ Writes a bundle to BUNDLE_DIR with a gzipped copy, and a brotli copy
+  if the brotli module is installed.
+
+  Args:
+    name: A str, the name of the bundle.
+    contents: A str, the contents of the bundle.
+    static_dir: A str, the directory holding the static files.
+  Returns:
+    A str, the bundle's path relative to the static files.
+  """
+  base, extension = os.path.splitext(name)
+  digest = hashlib.md5(contents).hexdigest()[:HASH_LENGTH]
+  path = posixpath.join(BUNDLE_DIR, "{0}.{1}{2}".format(base, digest,
+    extension))
+  full_path = os.path.join(static_dir, path)
+  write_file(full_path, contents)
+  write_file(full_path + ".gz", gzip_contents(os.path.basename(full_path),
+    contents))
+
+  # Only served by nginx builds with the brotli module, so optional.
+  try:
+    import brotli
+  except ImportError:
+    return path
+  write_file(full_path + ".br", brotli.compress(contents))
+  return path
+
+def build(static_dir=STATIC_DIR, bundles=None):
+  """ Builds every bundle and writes the manifest listing them. Bundles of
+  earlier builds are kept, for pages which still refer to them.
+
+  Args:
+    static_dir: A str, the directory holding the static files.
+    bundles: A dict mapping bundle names to their sources, or None to
+      build BUNDLES.
+  Returns:
+    A dict mapping each bundle name to its path relative to the static
+    files.
+  """
+  if bundles is None:
+    bundles = BUNDLES
+  bundle_dir = os.path.join(static_dir, BUNDLE_DIR)
+  if not os.path.isdir(bundle_dir):
+    os.makedirs(bundle_dir)
+
+  manifest = {}
+  for name, sources in sorted(bundles.items()):
+    contents = minify(name, combine(name, sources, static_dir))
+    manifest[name] = write_bundle(name, contents, static_dir)
+
+  write_file(os.path.join(bundle_dir, MANIFEST_NAME), json.dumps(manifest,
+    indent=2, sort_keys=True))
+  return manifest
+
+def get_manifest(static_dir=STATIC_DIR):
+  """ Reads the manifest of the last build, again only once it changes.
+
+  Args:
+    static_dir: A str, the directory holding the static files.
+  Returns:
+    A dict mapping each bundle name to its path relative to the static
+    files. It is empty if the bundles have not been built.
+  """
+  manifest_path = os.path.join(static_dir, BUNDLE_DIR, MANIFEST_NAME)
+  try:
+    mtime = os.path.getmtime(manifest_path)
+  except OSError:
+    return {}
+  with MANIFEST_LOCK:
+    if MANIFEST_CACHE['path'] != manifest_path or \
+      MANIFEST_CACHE['mtime'] != mtime:
+      with open(manifest_path) as file_handle:
+        MANIFEST_CACHE['bundles'] = json.load(file_handle)
+      MANIFEST_CACHE['path'] = manifest_path
+      MANIFEST_CACHE['mtime'] = mtime
+    return MANIFEST_CACHE['bundles']
+
+def get_bundle_paths(name, static_dir=STATIC_DIR):
+  """ Lists the static files a page loads for a bundle.
+
+  Args:
+    name: A str, the name of a bundle in BUNDLES.
+    static_dir: A str, the directory holding the static files.
+  Returns:
+    A list of strs, the paths relative to the static files. This is the
+    built bundle, or its separate sources if the bundles have not been
+    built.
+  Raises:
+    KeyError: If there is no such bundle.
+  """
+  path = get_manifest(static_dir).get(name)
+  if path:
+    return [path]
+  return list(BUNDLES[name])
@@ -1,6 +1,13 @@
 """ Helper functions for AppsCake. """
+import hashlib
+import hmac
+import json
 import uuid
 
+# Form fields which differ between otherwise identical submissions of the
+# start form.
+UNIQUE_FIELDS = ["csrfmiddlewaretoken", "submission_token"]
+
 def generate_keyname():
   """ Generates a random keyname to use for an AppScale deployment. 
   
@@ -8,3 +15,43 @@ def generate_keyname():
     A string which is the name of the AppScale key.
   """
   return str(uuid.uuid1())
+
+def generate_submission_token():
+  """ Generates a token for the start form, so repeated submissions of the
+  same form can be told apart from new ones.
+
+  Returns:
+    A str, the token.
+  """
+  return uuid.uuid4().hex
+
+def generate_batch_id():
+  """ Generates the ID of a batch of runs started together.
+
+  Returns:
+    A str, the ID.
+  """
+  return uuid.uuid4().hex
+
+def get_idempotency_key(params, secret):
+  """ Builds the key identifying a start request, so that duplicates of it
+  can be recognized. It is a keyed hash of the normalized deployment
+  parameters (keyed, as the parameters include passwords and cloud
+  credentials), prefixed with the form's submission token if it has one.
+  A resubmission of the same form with changed parameters is therefore a
+  new request.
+
+  Args:
+    params: A django QueryDict, the POST parameters of the request.
+    secret: A str, the key of the hash.
+  Returns:
+    A str, the idempotency key.
+  """
+  normalized = sorted((name, sorted(value.strip() for value in
+    params.getlist(name))) for name in params if name not in UNIQUE_FIELDS)
+  digest = hmac.new(str(secret), json.dumps(normalized),
+    hashlib.sha256).hexdigest()
+  token = params.get("submission_token", "").strip()
+  if token:
+    return "token:{0}:{1}".format(token, digest)
+  return "params:" + digest
@@ -0,0 +1,197 @@
+""" Finds the public and private IPs of the host AppsCake runs on. They are
+  asked of the GCE and then the EC2 metadata server, each with a short
+  timeout, and otherwise taken from the host's own name. The answer is
+  cached on disk until the host reboots, so that restarts do not wait on
+  metadata servers that may not exist.
+"""
+import httplib
+import json
+import os
+import socket
+import time
+import urllib2
+
+
+# The metadata of the host's first network interface on GCE. May be pointed
+# at a stand-in server, for example in tests.
+GCE_METADATA_URL = os.environ.get('APPSCAKE_GCE_METADATA_URL',
+  "http://metadata.google.internal/computeMetadata/v1/instance/"
+  "network-interfaces/0")
+
+# The metadata of the host on EC2 (and Eucalyptus).
+EC2_METADATA_URL = os.environ.get('APPSCAKE_EC2_METADATA_URL',
+  "http://169.254.169.254/latest/meta-data")
+
+# The number of seconds to wait for each answer of a metadata server.
+DEFAULT_TIMEOUT = 1
+
+# Where the IPs found are cached.
+CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(
+  os.path.abspath(__file__))), "db", "host.json")
+
+# The number of seconds the cached IPs are used for, unless the host reboots
+# first.
+CACHE_MAX_AGE = 24 * 60 * 60
+
+# Changes every time the host boots.
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+
+
+def get_sources(gce_url=GCE_METADATA_URL, ec2_url=EC2_METADATA_URL):
+  """ Lists the metadata servers to ask for the host's IPs, in order.
+
+  Args:
+    gce_url: A str, the URL of the GCE network interface metadata.
+    ec2_url: A str, the URL of the EC2 metadata.
+  Returns:
+    A list of dicts, each with the name of the source, the URLs of the
+    private and public IPs, and the headers to send.
+  """
+  return [
+    {'name': 'gce', 'private_ip': gce_url + "/ip",
+      'public_ip': gce_url + "/access-configs/0/external-ip",
+      'headers': {'Metadata-Flavor': 'Google'}},
+    {'name': 'ec2', 'private_ip': ec2_url + "/local-ipv4",
+      'public_ip': ec2_url + "/public-ipv4", 'headers': {}},
+  ]
+
+def fetch_ip(url, headers, timeout=DEFAULT_TIMEOUT):
+  """ Asks a metadata server for an IP.
+
+  Args:
+    url: A str, the URL of the IP.
+    headers: A dict of the headers the server requires.
+    timeout: A float, the number of seconds to wait for the answer.
+  Returns:
+    A str, the IP, or None if the server did not answer with one.
+  """
+  try:
+    response = urllib2.urlopen(urllib2.Request(url, headers=headers),
+      timeout=timeout)
+    try:
+      ip = response.read(64).strip()
+    finally:
+      response.close()
+  except (urllib2.URLError, httplib.HTTPException, socket.error,
+    socket.timeout, ValueError):
+    return None
+  # Captive portals and proxies answer with pages instead.
+  try:
+    socket.inet_aton(ip)
+  except socket.error:
+    return None
+  return ip
+
+def get_socket_ip():
+  """ Resolves the host's own name.
+
+  Returns:
+    A str, the IP the host's name resolves to, or the loopback IP if it
+    does not resolve.
+  """
+  try:
+    return socket.gethostbyname(socket.gethostname())
+  except socket.error:
+    return "127.0.0.1"
+
+def discover(sources=None, timeout=DEFAULT_TIMEOUT):
+  """ Finds the host's IPs without looking at the cache.
+
+  Args:
+    sources: A list of dicts in the format of get_sources, or None to ask
+      the default metadata servers.
+    timeout: A float, the number of seconds to wait for each answer.
+  Returns:
+    A dict with the public IP, the private IP and the name of the source
+    they came from. The public IP is the private IP if the host has none.
+  """
+  if sources is None:
+    sources = get_sources()
+  for source in sources:
+    private_ip = fetch_ip(source['private_ip'], source['headers'], timeout)
+    if private_ip is None:
+      continue
+    public_ip = fetch_ip(source['public_ip'], source['headers'], timeout)
+    return {'public_ip': public_ip or private_ip, 'private_ip': private_ip,
+      'source': source['name']}
+
+  private_ip = get_socket_ip()
+  return {'public_ip': private_ip, 'private_ip': private_ip,
+    'source': 'socket'}
+
+def get_boot_id():
+  """ Reads the ID of the host's current boot.
+
+  Returns:
+    A str, the boot ID, or None if the host does not have one.
+  """
+  try:
+    with open(BOOT_ID_PATH) as file_handle:
+      return file_handle.read().strip()
+  except IOError:
+    return None
+
+def read_cache(cache_path, max_age):
+  """ Reads IPs cached by get_host_ips.
+
+  Args:
+    cache_path: A str, the path of the cache.
+    max_age: A float, the number of seconds cached IPs are used for.
+  Returns:
+    A dict in the format of discover, or None if nothing usable is cached.
+  """
+  try:
+    with open(cache_path) as file_handle:
+      cached = json.load(file_handle)
+  except (IOError, ValueError):
+    return None
+  if not isinstance(cached, dict) or cached.get('boot_id') != get_boot_id():
+    return None
+  if time.time() - cached.get('discovered', 0) > max_age:
+    return None
+  return cached.get('ips')
+
+def write_cache(cache_path, ips):
+  """ Caches the IPs found. A cache that cannot be written is skipped.
+
+  Args:
+    cache_path: A str, the path of the cache.
+    ips: A dict in the format of discover.
+  """
+  temporary_path = "{0}.{1}.tmp".format(cache_path, os.getpid())
+  try:
+    directory = os.path.dirname(cache_path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    with open(temporary_path, 'w') as file_handle:
+      json.dump({'ips': ips, 'boot_id': get_boot_id(),
+        'discovered': time.time()}, file_handle)
+    os.rename(temporary_path, cache_path)
+  except (IOError, OSError):
+    try:
+      os.remove(temporary_path)
+    except OSError:
+      pass
+
+def get_host_ips(cache_path=CACHE_PATH, max_age=CACHE_MAX_AGE,
+  sources=None, timeout=DEFAULT_TIMEOUT, refresh=False):
+  """ Finds the host's IPs, from the cache if they are cached.
+
+  Args:
+    cache_path: A str, the path of the cache, or None to not use one.
+    max_age: A float, the number of seconds cached IPs are used for.
+    sources: A list of dicts in the format of get_sources, or None to ask
+      the default metadata servers.
+    timeout: A float, the number of seconds to wait for each answer.
+    refresh: A bool, whether to skip the cached IPs and find them again.
+  Returns:
+    A dict in the format of discover.
+  """
+  if cache_path and not refresh:
+    ips = read_cache(cache_path, max_age)
+    if ips:
+      return ips
+  ips = discover(sources, timeout)
+  if cache_path:
+    write_cache(cache_path, ips)
+  return ips
@@ -0,0 +1,114 @@
+""" Checks that the nodes of a cluster layout can be reached over SSH before
+  the AppScale tools are run on them, so that a bad layout fails in seconds
+  instead of minutes into a deployment.
+"""
+import multiprocessing.pool
+import socket
+import time
+
+import yaml
+
+
+# The port the AppScale tools connect to on every node.
+SSH_PORT = 22
+
+# The number of seconds to wait for each node to answer.
+DEFAULT_TIMEOUT = 3
+
+# The most nodes checked at once.
+MAX_CHECKS = 32
+
+
+def get_ips(ips_yaml):
+  """ Lists the nodes of an ips.yaml layout.
+
+  Args:
+    ips_yaml: A str, the contents of the ips.yaml file.
+  Returns:
+    A list of strs, the distinct IPs (or hostnames) in the layout, in the
+    order they first appear.
+  Raises:
+    yaml.YAMLError: If the layout is not valid YAML.
+  """
+  ips = []
+  pending = [yaml.safe_load(ips_yaml or "")]
+  while pending:
+    value = pending.pop(0)
+    if isinstance(value, dict):
+      pending.extend(value.values())
+    elif isinstance(value, list):
+      pending.extend(value)
+    elif isinstance(value, basestring) and value.strip():
+      if value.strip() not in ips:
+        ips.append(value.strip())
+  return ips
+
+def check_node(ip, timeout=DEFAULT_TIMEOUT, port=SSH_PORT):
+  """ Connects to a node's SSH port and reads the server's greeting.
+
+  Args:
+    ip: A str, the IP or hostname of the node.
+    timeout: A float, the number of seconds to wait for the node.
+    port: An int, the port to connect to.
+  Returns:
+    A dict with the node's IP, whether an SSH server answered, the seconds
+    it took to connect (or None), and the error if it did not answer.
+  """
+  report = {'ip': ip, 'reachable': False, 'latency': None, 'error': None}
+  started = time.time()
+  try:
+    connection = socket.create_connection((ip, port), timeout)
+  except socket.timeout:
+    report['error'] = "timed out"
+    return report
+  except (socket.error, socket.gaierror) as error:
+    report['error'] = str(error)
+    return report
+
+  report['latency'] = time.time() - started
+  try:
+    greeting = connection.recv(255)
+  except (socket.timeout, socket.error):
+    greeting = ""
+  finally:
+    connection.close()
+  if greeting.startswith("SSH-"):
+    report['reachable'] = True
+  else:
+    report['error'] = "no SSH server answered on port {0}".format(port)
+  return report
+
+def check_nodes(ips, timeout=DEFAULT_TIMEOUT, port=SSH_PORT):
+  """ Checks many nodes at once.
+
+  Args:
+    ips: A list of strs, the IPs or hostnames of the nodes.
+    timeout: A float, the number of seconds to wait for each node.
+    port: An int, the port to connect to.
+  Returns:
+    A list of dicts in the format of check_node, one per node, in the order
+    of ips.
+  """
+  if not ips:
+    return []
+  pool = multiprocessing.pool.ThreadPool(min(len(ips), MAX_CHECKS))
+  try:
+    return pool.map(lambda ip: check_node(ip, timeout, port), ips)
+  finally:
+    pool.close()
+    pool.join()
+
+def get_failures(reports):
+  """ Summarizes the nodes which could not be reached.
+
+  Args:
+    reports: A list of dicts returned by check_nodes.
+  Returns:
+    A str listing each unreachable node with its error, or None if every
+    node was reached.
+  """
+  failures = ["{0} ({1})".format(report['ip'], report['error'])
+    for report in reports if not report['reachable']]
+  if not failures:
+    return None
+  return ", ".join(failures)
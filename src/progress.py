@@ -0,0 +1,332 @@
+""" Estimates how far along a run of the AppScale tools is by matching its
+  output against known phase markers, each weighted by how long that phase
+  has taken in past runs.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+
+# Kinds of tools commands we estimate progress for.
+RUN_INSTANCES = "run-instances"
+TERMINATE_INSTANCES = "terminate-instances"
+
+# Lines printed by appscale-run-instances at the end of each phase, in the
+# order they are printed, with the number of seconds the phase is expected
+# to take. The durations are only used until transcripts of past runs of
+# the same kind of deployment have been recorded.
+RUN_INSTANCES_PHASES = [
+  ("Starting AppScale", 5),
+  ("Log in to your head node", 240),
+  ("Please wait for AppScale to prepare your machines for use", 60),
+  ("Head node successfully initialized", 180),
+  ("AppScale successfully started", 600),
+  ("View status information about your AppScale deployment at", 5),
+]
+
+# Lines printed by appscale-terminate-instances at the end of each phase,
+# with the number of seconds the phase is expected to take.
+TERMINATE_INSTANCES_PHASES = [
+  ("Terminating", 10),
+  ("Terminated AppScale", 60),
+  ("Successfully shut down your AppScale deployment", 10),
+]
+
+# The default phases for each kind of tools command.
+DEFAULT_PHASES = {
+  RUN_INSTANCES: RUN_INSTANCES_PHASES,
+  TERMINATE_INSTANCES: TERMINATE_INSTANCES_PHASES,
+}
+
+# The highest percentage reported while the tools are still running.
+MAX_RUNNING_PERCENT = 99
+
+# The number of most recent transcripts used to compute phase durations.
+MAX_TRANSCRIPTS = 50
+
+
+class ProgressModel(object):
+  """ An ordered table of phase markers, each weighted by its expected
+  duration in seconds.
+  """
+
+  def __init__(self, phases):
+    """ Constructor.
+
+    Args:
+      phases: A list of (marker, seconds) tuples in the order the markers are
+        printed by the tools.
+    """
+    self.markers = [marker for marker, _ in phases]
+    self.durations = [max(float(seconds), 1.0) for _, seconds in phases]
+    self.total = sum(self.durations)
+    self.index = dict((marker, index) for index, marker in
+      enumerate(self.markers))
+
+  def estimate(self, phase, reached_at, now=None):
+    """ Estimates progress through the phase after the last one that ended,
+    assuming it goes at its expected pace. The estimate stays below the
+    share of the next phase until its marker is printed.
+
+    Args:
+      phase: An int, the index of the last phase that ended, or -1 if none
+        has ended yet.
+      reached_at: A float, the time (in seconds since the epoch) at which
+        the phase ended, or the run started if no phase has ended.
+      now: A float, the time to estimate progress at, or None to estimate it
+        as of reached_at.
+    Returns:
+      A tuple of the estimated percentage towards completion (an int capped
+      at MAX_RUNNING_PERCENT) and the estimated time of completion in
+      seconds since the epoch.
+    """
+    if now is None:
+      now = reached_at
+    done = sum(self.durations[:phase + 1])
+    percent = int(done / self.total * 100)
+    elapsed = max(now - reached_at, 0)
+    overrun = elapsed
+    if phase + 1 < len(self.durations):
+      expected = self.durations[phase + 1]
+      overrun = max(elapsed - expected, 0)
+      ceiling = int((done + expected) / self.total * 100) - 1
+      percent = max(percent, min(int((done + elapsed) / self.total * 100),
+        ceiling))
+    # A phase taking longer than expected pushes completion back.
+    return min(percent, MAX_RUNNING_PERCENT), reached_at + self.total - \
+      done + overrun
+
+
+class ProgressTracker(object):
+  """ Follows a single run of the tools through the phases of a
+  ProgressModel. It is meant to be the marker listener of the run's
+  CaptureStream.
+  """
+
+  def __init__(self, model):
+    """ Constructor.
+
+    Args:
+      model: A ProgressModel for the kind of run being tracked.
+    """
+    self.model = model
+    self.started_at = None
+    self.phase_started_at = None
+    self.phase = -1
+    self.percent = 0
+    self.eta = None
+    self.reached = {}
+
+  def start(self):
+    """ Marks the start of the run. """
+    self.started_at = time.time()
+    self.phase_started_at = self.started_at
+    self.phase = -1
+    self.reached = {}
+    self.update(self.started_at)
+
+  def on_marker(self, marker, line, offset):
+    """ Moves the run on to a later phase when the tools print its marker.
+
+    Args:
+      marker: A str, the marker found in the output.
+      line: A str, the line of output containing the marker.
+      offset: An int, the byte offset of the line in the output.
+    """
+    index = self.model.index.get(marker)
+    if index is None or self.started_at is None:
+      return
+    now = time.time()
+    self.reached.setdefault(marker, now - self.started_at)
+    if index > self.phase:
+      self.phase = index
+      self.phase_started_at = now
+      self.update(now)
+      logging.debug("Reached phase {0} ({1}) at {2}%.".format(index, marker,
+        self.percent))
+
+  def update(self, now=None):
+    """ Estimates the progress of the run as of a given time, moving it on
+    through the phase in progress.
+
+    Args:
+      now: A float, the time in seconds since the epoch, or None for the
+        current time.
+    Returns:
+      True if the estimated percentage or time of completion changed, False
+      otherwise.
+    """
+    if self.started_at is None:
+      return False
+    if now is None:
+      now = time.time()
+    estimate = self.model.estimate(self.phase, self.phase_started_at, now)
+    if estimate == (self.percent, self.eta):
+      return False
+    self.percent, self.eta = estimate
+    return True
+
+  def get_expected_phase_seconds(self):
+    """ Looks up how long the phase in progress is expected to take.
+
+    Returns:
+      A float, the expected duration in seconds, or None if the run has not
+      started or has passed its last marker.
+    """
+    if self.started_at is None or self.phase + 1 >= len(self.model.durations):
+      return None
+    return self.model.durations[self.phase + 1]
+
+  def get_transcript(self):
+    """ Summarizes the run for use by later runs' progress models.
+
+    Returns:
+      A dict with the seconds since the start at which each marker was
+      reached, and the total duration of the run.
+    """
+    total = 0
+    if self.started_at is not None:
+      total = time.time() - self.started_at
+    return {'markers': dict(self.reached), 'total': total}
+
+
+class TranscriptStore(object):
+  """ Stores the phase timings of finished runs on disk, and builds progress
+  models from them for each kind of run, deployment type and placement.
+  """
+
+  def __init__(self, directory):
+    """ Constructor.
+
+    Args:
+      directory: A str, the directory to keep transcripts in.
+    """
+    self.directory = directory
+    self.lock = threading.Lock()
+    self.models = {}
+
+  def get_path(self, kind, deployment_type, placement):
+    """ Determines the directory holding the transcripts of one kind of run.
+
+    Args:
+      kind: A str, RUN_INSTANCES or TERMINATE_INSTANCES.
+      deployment_type: A str, cloud or cluster.
+      placement: A str, the placement strategy, or None.
+    Returns:
+      A str, the path of the directory.
+    """
+    return os.path.join(self.directory, kind,
+      "{0}-{1}".format(deployment_type, placement or "default"))
+
+  def save(self, kind, deployment_type, placement, keyname, tracker):
+    """ Stores the timings of a successful run and drops the cached model so
+    the next run uses them. Only the MAX_TRANSCRIPTS most recent transcripts
+    of each kind of run are kept.
+
+    Args:
+      kind: A str, RUN_INSTANCES or TERMINATE_INSTANCES.
+      deployment_type: A str, cloud or cluster.
+      placement: A str, the placement strategy, or None.
+      keyname: A str, the keyname of the run.
+      tracker: The ProgressTracker which followed the run.
+    """
+    path = self.get_path(kind, deployment_type, placement)
+    try:
+      if not os.path.isdir(path):
+        os.makedirs(path)
+      with open(os.path.join(path, keyname + ".json"), 'w') as file_handle:
+        json.dump(tracker.get_transcript(), file_handle)
+      for file_name in self.list_transcripts(path)[MAX_TRANSCRIPTS:]:
+        os.remove(file_name)
+    except (IOError, OSError) as error:
+      logging.warning("Unable to store transcript for {0}: {1}".format(
+        keyname, error))
+    with self.lock:
+      self.models.pop(path, None)
+
+  def list_transcripts(self, path):
+    """ Lists the transcript files in a directory.
+
+    Args:
+      path: A str, the directory to list.
+    Returns:
+      A list of the paths of the transcript files, newest first.
+    """
+    try:
+      names = [name for name in os.listdir(path) if name.endswith(".json")]
+    except OSError:
+      return []
+    return sorted((os.path.join(path, name) for name in names),
+      key=os.path.getmtime, reverse=True)
+
+  def load_transcripts(self, path):
+    """ Reads the most recent transcripts in a directory.
+
+    Args:
+      path: A str, the directory to read.
+    Returns:
+      A list of transcript dicts, newest first.
+    """
+    transcripts = []
+    for file_name in self.list_transcripts(path)[:MAX_TRANSCRIPTS]:
+      try:
+        with open(file_name) as file_handle:
+          transcripts.append(json.load(file_handle))
+      except (IOError, ValueError) as error:
+        logging.warning("Skipping bad transcript {0}: {1}".format(file_name,
+          error))
+    return transcripts
+
+  def get_model(self, kind, deployment_type, placement):
+    """ Builds the progress model for a kind of run. Each phase is weighted
+    by the median of its duration in the stored transcripts, or by its
+    default duration if no transcript has reached it.
+
+    Args:
+      kind: A str, RUN_INSTANCES or TERMINATE_INSTANCES.
+      deployment_type: A str, cloud or cluster.
+      placement: A str, the placement strategy, or None.
+    Returns:
+      A ProgressModel.
+    """
+    path = self.get_path(kind, deployment_type, placement)
+    with self.lock:
+      if path in self.models:
+        return self.models[path]
+
+    phases = DEFAULT_PHASES[kind]
+    markers = [marker for marker, _ in phases]
+    samples = [[] for _ in phases]
+    for transcript in self.load_transcripts(path):
+      reached = transcript.get('markers', {})
+      previous = 0
+      for index, marker in enumerate(markers):
+        if marker in reached:
+          samples[index].append(max(reached[marker] - previous, 0))
+          previous = reached[marker]
+
+    learned = []
+    for (marker, default), durations in zip(phases, samples):
+      if durations:
+        durations.sort()
+        learned.append((marker, durations[len(durations) / 2]))
+      else:
+        learned.append((marker, default))
+
+    model = ProgressModel(learned)
+    with self.lock:
+      self.models[path] = model
+    return model
+
+
+def get_default_model(kind):
+  """ Builds a progress model from the default phase durations.
+
+  Args:
+    kind: A str, RUN_INSTANCES or TERMINATE_INSTANCES.
+  Returns:
+    A ProgressModel.
+  """
+  return ProgressModel(DEFAULT_PHASES[kind])
@@ -0,0 +1,69 @@
+""" Frees AppScale tools runs some time after they finish, so a long-running
+  AppsCake process only holds the runs that are still doing work. A
+  finished run lives on as its archived record in the deployment registry.
+"""
+import logging
+import threading
+import time
+
+
+# The number of seconds between passes of the reaper.
+REAP_INTERVAL = 60
+
+
+class RunReaper(threading.Thread):
+  """ A daemon thread which periodically removes finished AppScaleUp and
+  AppScaleDown threads from the maps a process keeps them in, once they
+  have been finished for longer than a time to live.
+  """
+
+  def __init__(self, run_maps, deployment_registry, ttl,
+    interval=REAP_INTERVAL):
+    """ Constructor.
+
+    Args:
+      run_maps: A list of dicts mapping keynames to AppScaleUp or
+        AppScaleDown threads.
+      deployment_registry: A registry.DeploymentRegistry to archive runs in.
+      ttl: A float, the number of seconds a finished run is kept in memory.
+      interval: A float, the number of seconds between passes.
+    """
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.run_maps = run_maps
+    self.deployment_registry = deployment_registry
+    self.ttl = ttl
+    self.interval = interval
+
+  def run(self):
+    """ Reaps finished runs until the process exits. """
+    while True:
+      time.sleep(self.interval)
+      try:
+        self.reap()
+      except Exception as exception:
+        logging.exception(exception)
+
+  def reap(self):
+    """ Archives and removes every run that finished more than ttl seconds
+    ago.
+
+    Returns:
+      An int, the number of runs removed.
+    """
+    now = time.time()
+    reaped = 0
+    for run_map in self.run_maps:
+      for keyname, run in run_map.items():
+        if run.finished_at is None or run.is_alive() or \
+          now - run.finished_at < self.ttl:
+          continue
+        # The keyname may have been reused by a newer run in the meantime.
+        if run_map.get(keyname) is not run:
+          continue
+        self.deployment_registry.archive(run)
+        run_map.pop(keyname, None)
+        reaped += 1
+    if reaped:
+      logging.info("Reaped {0} finished runs.".format(reaped))
+    return reaped
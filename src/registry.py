@@ -0,0 +1,654 @@
+""" A registry of AppScale tools runs kept in SQLite, so that every web worker
+  process can report the status of runs started by any other worker, and
+  so that runs are still known after AppsCake restarts.
+"""
+import errno
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.utils import simplejson
+
+
+# Kinds of runs kept in the registry.
+DEPLOYMENT = "deployment"
+TERMINATION = "termination"
+
+# States after which a run no longer changes. These match the final states
+# of AppScaleUp and AppScaleDown.
+FINISHED_STATES = ("complete", "terminated", "error", "timeout",
+  "cancelled")
+
+# Final states of runs which did not succeed. Start requests are never
+# coalesced onto a deployment in one of these states.
+FAILED_STATES = ("error", "timeout", "cancelled")
+
+# The number of seconds between checks for a status change by
+# wait_for_change.
+POLL_INTERVAL = 0.5
+
+# The error reported for runs whose worker process is gone before the run
+# finished.
+ORPHANED_MESSAGE = "AppsCake was restarted while this run was in progress."
+
+# The most runs returned in one page by list_statuses. This also keeps the
+# number of keynames in one query under SQLite's limit on bound parameters.
+MAX_PAGE_SIZE = 100
+
+# Statements creating the registry table and its indexes.
+SCHEMA = [
+  """CREATE TABLE IF NOT EXISTS deployment_registry (
+       id INTEGER PRIMARY KEY AUTOINCREMENT,
+       kind TEXT NOT NULL,
+       keyname TEXT NOT NULL,
+       state TEXT NOT NULL,
+       status TEXT NOT NULL,
+       deployment_type TEXT,
+       ec2_url TEXT,
+       owner_pid INTEGER NOT NULL,
+       created REAL NOT NULL,
+       updated REAL NOT NULL,
+       version INTEGER NOT NULL DEFAULT 1,
+       UNIQUE (kind, keyname))""",
+  """CREATE INDEX IF NOT EXISTS deployment_registry_state
+       ON deployment_registry (kind, state)""",
+  """CREATE TABLE IF NOT EXISTS deployment_batches (
+       id TEXT PRIMARY KEY,
+       kind TEXT NOT NULL,
+       keynames TEXT NOT NULL,
+       created REAL NOT NULL)""",
+  """CREATE TABLE IF NOT EXISTS deployment_submissions (
+       idempotency_key TEXT PRIMARY KEY,
+       keyname TEXT NOT NULL,
+       created REAL NOT NULL)""",
+]
+
+# Columns added to the registry table after it was first released, with
+# their types. They are added to existing databases when first opened.
+ADDED_COLUMNS = [
+  ("started", "REAL"),
+  ("finished", "REAL"),
+  ("transcript", "TEXT"),
+  ("archived", "REAL"),
+  ("cancel_requested", "REAL"),
+  ("requested", "REAL"),
+]
+
+# Columns in which earlier releases stored the EC2 credentials of cloud
+# deployments. Credentials are now only kept in the memory of the process
+# which started the deployment, so these are cleared when first opened.
+CREDENTIAL_COLUMNS = ["ec2_access", "ec2_secret"]
+
+# The state a run is added in when another process is asked to start it.
+REQUESTED_STATE = "queued"
+
+
+class DeploymentStatus(object):
+  """ A snapshot of the status of a run, serialized once when it is taken.
+  Runs replace their snapshot with a new one on every transition instead of
+  changing it, so a reader holding one always sees a consistent status
+  without taking a lock.
+  """
+
+  __slots__ = ('state', 'percent', 'eta', 'link', 'error_message',
+    'queue_position', 'started', 'updated', 'version', 'payload')
+
+  def __init__(self, status, started=None, version=1):
+    """ Constructor.
+
+    Args:
+      status: A dict, the run's get_status() result.
+      started: A float, the time the run started, or None if it has not.
+      version: An int, one more than the version of the previous snapshot.
+    """
+    self.state = status['status']
+    self.percent = status.get('percent', 0)
+    self.eta = status.get('eta')
+    self.link = status.get('link')
+    self.error_message = status.get('error_message')
+    self.queue_position = status.get('queue_position')
+    self.started = started
+    self.updated = time.time()
+    self.version = version
+    self.payload = simplejson.dumps(status)
+
+
+class DeploymentRegistry(object):
+  """ Stores the state of each AppScaleUp and AppScaleDown run in a SQLite
+  database in WAL mode, so readers in other processes never block the
+  threads writing state transitions.
+  """
+
+  def __init__(self, db_path):
+    """ Constructor. The database is opened lazily, on first use by each
+    thread.
+
+    Args:
+      db_path: A str, the path of the SQLite database file.
+    """
+    self.db_path = db_path
+    self.local = threading.local()
+    self.schema_lock = threading.Lock()
+    self.schema_created = False
+
+  def get_connection(self):
+    """ Opens (once per thread) a connection to the registry database.
+
+    Returns:
+      A sqlite3.Connection in autocommit mode.
+    """
+    connection = getattr(self.local, 'connection', None)
+    if connection is not None:
+      return connection
+
+    directory = os.path.dirname(self.db_path)
+    if directory and not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError as error:
+        if error.errno != errno.EEXIST:
+          raise
+
+    connection = sqlite3.connect(self.db_path, timeout=30,
+      isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    with self.schema_lock:
+      if not self.schema_created:
+        for statement in SCHEMA:
+          connection.execute(statement)
+        add_columns(connection)
+        clear_credentials(connection)
+        self.schema_created = True
+    self.local.connection = connection
+    return connection
+
+  def add(self, run):
+    """ Adds a new run, replacing any earlier run of the same kind with the
+    same keyname.
+
+    Args:
+      run: An AppScaleUp or AppScaleDown.
+    """
+    status = run.status
+    now = time.time()
+    self.get_connection().execute(
+      "INSERT OR REPLACE INTO deployment_registry (kind, keyname, state, "
+      "status, deployment_type, ec2_url, owner_pid, created, updated) VALUES "
+      "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+      (run.REGISTRY_KIND, run.keyname, status.state, status.payload,
+       run.deployment_type, run.ec2_url, os.getpid(), now, now))
+
+  def update(self, kind, keyname, status):
+    """ Records a new status for a run.
+
+    Args:
+      kind: A str, DEPLOYMENT or TERMINATION.
+      keyname: A str, the keyname of the run.
+      status: A DeploymentStatus, the run's current status.
+    """
+    self.get_connection().execute(
+      "UPDATE deployment_registry SET state = ?, status = ?, updated = ?, "
+      "version = version + 1 WHERE kind = ? AND keyname = ?",
+      (status.state, status.payload, status.updated, kind, keyname))
+
+  def archive(self, run):
+    """ Records the final details of a finished run, which is no longer
+    kept in memory.
+
+    Args:
+      run: An AppScaleUp or AppScaleDown which has finished.
+    """
+    status = run.status
+    # Only the row of this run is archived, not that of a newer run with
+    # the same keyname.
+    self.get_connection().execute(
+      "UPDATE deployment_registry SET state = ?, status = ?, started = ?, "
+      "finished = ?, transcript = ?, archived = ? WHERE kind = ? AND "
+      "keyname = ? AND owner_pid = ? AND created <= ?",
+      (status.state, status.payload, status.started,
+       run.finished_at, run.std_out_capture.log_path, time.time(),
+       run.REGISTRY_KIND, run.keyname, os.getpid(), run.finished_at))
+
+  def request_cancel(self, kind, keyname):
+    """ Asks the process running a run to cancel it.
+
+    Args:
+      kind: A str, DEPLOYMENT or TERMINATION.
+      keyname: A str, the keyname of the run.
+    Returns:
+      True if an unfinished run was found, False otherwise.
+    """
+    cursor = self.get_connection().execute(
+      "UPDATE deployment_registry SET cancel_requested = ? WHERE kind = ? "
+      "AND keyname = ? AND state NOT IN ({0})".format(
+      ", ".join("?" * len(FINISHED_STATES))),
+      [time.time(), kind, keyname] + list(FINISHED_STATES))
+    return cursor.rowcount > 0
+
+  def get_cancel_requests(self, kind):
+    """ Finds the unfinished runs of this process which were asked to
+    cancel.
+
+    Args:
+      kind: A str, DEPLOYMENT or TERMINATION.
+    Returns:
+      A list of strs, the keynames of the runs.
+    """
+    rows = self.get_connection().execute(
+      "SELECT keyname FROM deployment_registry WHERE kind = ? AND "
+      "state NOT IN ({0}) AND owner_pid = ? AND cancel_requested IS NOT "
+      "NULL".format(", ".join("?" * len(FINISHED_STATES))),
+      [kind] + list(FINISHED_STATES) + [os.getpid()]).fetchall()
+    return [row['keyname'] for row in rows]
+
+  def request_run(self, kind, keyname, deployment_type, ec2_url, owner_pid):
+    """ Asks another process to start a run, by adding the run on its
+    behalf in the REQUESTED_STATE. The run replaces this entry once that
+    process starts it. Nothing is requested while an earlier run of the
+    same kind and keyname is unfinished, so repeated requests start one run.
+
+    Args:
+      kind: A str, DEPLOYMENT or TERMINATION.
+      keyname: A str, the keyname of the run.
+      deployment_type: A str, either cloud or cluster deployment.
+      ec2_url: A str, the URL of the EC2/Euca cloud, or None.
+      owner_pid: An int, the ID of the process to start the run.
+    Returns:
+      True if the run was requested, False if an unfinished run exists.
+    """
+    status = DeploymentStatus({'status': REQUESTED_STATE, 'percent': 0,
+      'queue_position': None})
+    connection = self.get_connection()
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+      row = connection.execute(
+        "SELECT keyname, state, owner_pid FROM deployment_registry WHERE "
+        "kind = ? AND keyname = ?", (kind, keyname)).fetchone()
+      requested = row is None or row['state'] in FINISHED_STATES or \
+        is_orphaned(row)
+      if requested:
+        connection.execute(
+          "INSERT OR REPLACE INTO deployment_registry (kind, keyname, "
+          "state, status, deployment_type, ec2_url, owner_pid, created, "
+          "updated, requested) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+          (kind, keyname, status.state, status.payload, deployment_type,
+           ec2_url, owner_pid, now, now, now))
+    except Exception:
+      connection.execute("ROLLBACK")
+      raise
+    connection.execute("COMMIT")
+    return requested
+
+  def get_run_requests(self, kind):
+    """ Finds the runs other processes asked this process to start, which
+    it has not started yet.
+
+    Args:
+      kind: A str, DEPLOYMENT or TERMINATION.
+    Returns:
+      A list of strs, the keynames of the runs.
+    """
+    rows = self.get_connection().execute(
+      "SELECT keyname FROM deployment_registry WHERE kind = ? AND "
+      "state = ? AND owner_pid = ? AND requested IS NOT NULL",
+      (kind, REQUESTED_STATE, os.getpid())).fetchall()
+    return [row['keyname'] for row in rows]
+
+  def claim_submission(self, idempotency_key, keyname, window):
+    """ Records the deployment started for a start request, unless a
+    request with the same idempotency key already started one within the
+    window which has not failed. The check and the claim are one
+    transaction, so concurrent duplicates in different processes start a
+    single deployment.
+
+    Args:
+      idempotency_key: A str, the key of the start request.
+      keyname: A str, the keyname of the deployment the request would start.
+      window: A float, the number of seconds during which duplicates are
+        coalesced.
+    Returns:
+      A str, the keyname of the deployment to use for the request: the given
+      keyname if it was claimed, or that of the earlier deployment.
+    """
+    connection = self.get_connection()
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+      row = connection.execute(
+        "SELECT submission.keyname, submission.created, deployment.state, "
+        "deployment.owner_pid FROM deployment_submissions AS submission "
+        "LEFT JOIN deployment_registry AS deployment ON deployment.kind = ? "
+        "AND deployment.keyname = submission.keyname WHERE "
+        "submission.idempotency_key = ?",
+        (DEPLOYMENT, idempotency_key)).fetchone()
+      if row is not None and now - row['created'] < window and \
+        not is_failed(row):
+        keyname = row['keyname']
+      else:
+        connection.execute("DELETE FROM deployment_submissions WHERE "
+          "created < ?", (now - window,))
+        connection.execute("INSERT OR REPLACE INTO deployment_submissions "
+          "(idempotency_key, keyname, created) VALUES (?, ?, ?)",
+          (idempotency_key, keyname, now))
+    except Exception:
+      connection.execute("ROLLBACK")
+      raise
+    connection.execute("COMMIT")
+    return keyname
+
+  def release_submission(self, idempotency_key):
+    """ Forgets a start request which did not start a deployment, so that
+    it can be retried.
+
+    Args:
+      idempotency_key: A str, the key of the start request.
+    """
+    self.get_connection().execute(
+      "DELETE FROM deployment_submissions WHERE idempotency_key = ?",
+      (idempotency_key,))
+
+  def add_batch(self, batch_id, kind, keynames):
+    """ Records a batch of runs started together.
+
+    Args:
+      batch_id: A str, the ID of the batch.
+      kind: A str, DEPLOYMENT or TERMINATION.
+      keynames: A list of strs, the keynames of the runs.
+    """
+    self.get_connection().execute(
+      "INSERT INTO deployment_batches (id, kind, keynames, created) VALUES "
+      "(?, ?, ?, ?)", (batch_id, kind, simplejson.dumps(keynames), time.time()))
+
+  def get_batch_status(self, batch_id):
+    """ Sums up the progress of a batch of runs.
+
+    Args:
+      batch_id: A str, the ID of the batch.
+    Returns:
+      A dict with the number of runs, the number in each state, the
+      average percentage towards completion, whether every run has
+      finished and the status of each run. None is returned if the batch is
+      unknown.
+    """
+    row = self.get_connection().execute(
+      "SELECT kind, keynames FROM deployment_batches WHERE id = ?",
+      (batch_id,)).fetchone()
+    if row is None:
+      return None
+
+    keynames = simplejson.loads(row['keynames'])
+    statuses = {}
+    cursor = None
+    while True:
+      page, cursor = self.list_statuses(kind=row['kind'], keynames=keynames,
+        cursor=cursor)
+      for _, keyname, payload in page:
+        statuses[keyname] = simplejson.loads(payload)
+      if cursor is None:
+        break
+
+    counts = {}
+    percent = 0
+    for keyname in keynames:
+      status = statuses.setdefault(keyname, {'status': 'unknown',
+        'percent': 0})
+      counts[status['status']] = counts.get(status['status'], 0) + 1
+      if status['status'] in FINISHED_STATES:
+        percent += 100
+      else:
+        percent += status.get('percent', 0)
+    finished = sum(counts.get(state, 0) for state in FINISHED_STATES)
+    return {'total': len(keynames), 'counts': counts,
+      'percent': percent / max(len(keynames), 1),
+      'finished': finished == len(keynames), 'runs': statuses}
+
+  def get(self, kind, keyname):
+    """ Looks up a run.
+
+    Args:
+      kind: A str, DEPLOYMENT or TERMINATION.
+      keyname: A str, the keyname of the run.
+    Returns:
+      A sqlite3.Row for the run, or None if it is not in the registry.
+    """
+    return self.get_connection().execute(
+      "SELECT * FROM deployment_registry WHERE kind = ? AND keyname = ?",
+      (kind, keyname)).fetchone()
+
+  def get_status(self, kind, keyname):
+    """ Looks up the status of a run.
+
+    Args:
+      kind: A str, DEPLOYMENT or TERMINATION.
+      keyname: A str, the keyname of the run.
+    Returns:
+      A dict in the format of get_status() of AppScaleUp/AppScaleDown, or
+      None if the run is not in the registry.
+    """
+    result = self.get_versioned_status(kind, keyname)
+    if result is None:
+      return None
+    return result[1]
+
+  def get_versioned_status(self, kind, keyname):
+    """ Looks up the status of a run along with its version, which goes up
+    every time the run's status changes.
+
+    Args:
+      kind: A str, DEPLOYMENT or TERMINATION.
+      keyname: A str, the keyname of the run.
+    Returns:
+      A tuple of the version (an int) and the status dict, or None if the
+      run is not in the registry.
+    """
+    row = self.get(kind, keyname)
+    if row is None:
+      return None
+    if is_orphaned(row):
+      return row['version'], get_orphaned_status()
+    return row['version'], simplejson.loads(row['status'])
+
+  def get_payload(self, kind, keyname):
+    """ Looks up the status of a run as the JSON it was stored as, with an
+    entity tag that changes whenever the status does. The status was
+    serialized once, when it last changed, so nothing is parsed or
+    serialized here.
+
+    Args:
+      kind: A str, DEPLOYMENT or TERMINATION.
+      keyname: A str, the keyname of the run.
+    Returns:
+      A tuple of the entity tag (a str) and the JSON status (a str), or None
+      if the run is not in the registry.
+    """
+    row = self.get_connection().execute(
+      "SELECT id, keyname, state, status, owner_pid, version FROM "
+      "deployment_registry WHERE kind = ? AND keyname = ?",
+      (kind, keyname)).fetchone()
+    if row is None:
+      return None
+    tag = "{0}.{1}".format(row['id'], row['version'])
+    if is_orphaned(row):
+      return tag + ".orphaned", simplejson.dumps(get_orphaned_status())
+    return tag, row['status']
+
+  def list_statuses(self, kind=None, keynames=None, states=None, cursor=None,
+    limit=MAX_PAGE_SIZE):
+    """ Looks up the statuses of many runs at once, oldest first. Statuses
+    are returned as the JSON they were stored as, so that they can be put
+    into a larger response without being parsed.
+
+    Args:
+      kind: A str, DEPLOYMENT or TERMINATION, or None for both kinds.
+      keynames: A list of strs, the keynames of the runs, or None for all
+        runs.
+      states: A list of strs, the states of the runs, or None for any state.
+      cursor: An int, the cursor returned with the previous page, or None
+        for the first page.
+      limit: An int, the most runs to return, at most MAX_PAGE_SIZE.
+    Returns:
+      A tuple of a list of (kind, keyname, JSON status str) tuples, and the
+      cursor of the next page (an int), or None if this is the last page.
+    Raises:
+      ValueError: If more than MAX_PAGE_SIZE keynames or states are given.
+    """
+    for name, values in (("keynames", keynames), ("states", states)):
+      if values and len(values) > MAX_PAGE_SIZE:
+        raise ValueError("At most {0} {1} can be given, not {2}.".format(
+          MAX_PAGE_SIZE, name, len(values)))
+    if keynames is not None and not keynames:
+      return [], None
+    limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+
+    clauses = ["id > ?"]
+    params = [cursor or 0]
+    if kind is not None:
+      clauses.append("kind = ?")
+      params.append(kind)
+    for column, values in (("keyname", keynames), ("state", states)):
+      if values:
+        clauses.append("{0} IN ({1})".format(column,
+          ", ".join("?" * len(values))))
+        params.extend(values)
+    params.append(limit + 1)
+
+    rows = self.get_connection().execute(
+      "SELECT id, kind, keyname, state, status, owner_pid FROM "
+      "deployment_registry WHERE {0} ORDER BY id LIMIT ?".format(
+      " AND ".join(clauses)), params).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+      rows = rows[:limit]
+      next_cursor = rows[-1]['id']
+
+    statuses = []
+    for row in rows:
+      if is_orphaned(row):
+        payload = simplejson.dumps(get_orphaned_status())
+      else:
+        payload = row['status']
+      statuses.append((row['kind'], row['keyname'], payload))
+    return statuses, next_cursor
+
+  def wait_for_change(self, kind, keyname, version, timeout,
+    interval=POLL_INTERVAL):
+    """ Waits until the status of a run moves past a given version. Each
+    check is a single indexed lookup, so waiting is cheap for the database.
+
+    Args:
+      kind: A str, DEPLOYMENT or TERMINATION.
+      keyname: A str, the keyname of the run.
+      version: An int, the version the caller already has, or None.
+      timeout: A float, the longest time to wait in seconds.
+      interval: A float, the time to sleep between checks in seconds.
+    Returns:
+      A tuple of the version and the status dict, as get_versioned_status.
+      The version is unchanged if the timeout passed first or the run had
+      already finished. None is returned if the run is not in the registry.
+    """
+    deadline = time.time() + timeout
+    while True:
+      result = self.get_versioned_status(kind, keyname)
+      if result is None or result[0] != version or \
+        result[1]['status'] in FINISHED_STATES:
+        return result
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return result
+      time.sleep(min(interval, remaining))
+
+
+def add_columns(connection):
+  """ Adds the columns in ADDED_COLUMNS that a registry table created by an
+  earlier release is missing.
+
+  Args:
+    connection: A sqlite3.Connection to the registry database.
+  """
+  existing = set(row[1] for row in connection.execute(
+    "PRAGMA table_info(deployment_registry)"))
+  for name, column_type in ADDED_COLUMNS:
+    if name in existing:
+      continue
+    try:
+      connection.execute("ALTER TABLE deployment_registry ADD COLUMN "
+        "{0} {1}".format(name, column_type))
+    except sqlite3.OperationalError as error:
+      # Another process added it first.
+      if "duplicate column" not in str(error):
+        raise
+
+def clear_credentials(connection):
+  """ Clears the EC2 credentials that a registry table created by an
+  earlier release holds.
+
+  Args:
+    connection: A sqlite3.Connection to the registry database.
+  """
+  existing = set(row[1] for row in connection.execute(
+    "PRAGMA table_info(deployment_registry)"))
+  columns = [name for name in CREDENTIAL_COLUMNS if name in existing]
+  if not columns:
+    return
+  connection.execute("UPDATE deployment_registry SET {0} WHERE {1}".format(
+    ", ".join("{0} = NULL".format(name) for name in columns),
+    " OR ".join("{0} IS NOT NULL".format(name) for name in columns)))
+
+def is_orphaned(row):
+  """ Checks if a run stopped before finishing because the process running
+  it is gone.
+
+  Args:
+    row: A sqlite3.Row of the deployment_registry table.
+  Returns:
+    True if the run is orphaned, False otherwise.
+  """
+  if row['state'] in FINISHED_STATES or is_process_alive(row['owner_pid']):
+    return False
+  logging.warning("Run {0} lost its worker process {1}.".format(
+    row['keyname'], row['owner_pid']))
+  return True
+
+def is_failed(row):
+  """ Checks if the deployment a start request started has failed.
+
+  Args:
+    row: A sqlite3.Row with the state and owner_pid of the deployment, which
+      are None if the deployment is not in the registry yet.
+  Returns:
+    True if the deployment ended in one of the FAILED_STATES or is
+    orphaned, False otherwise.
+  """
+  if row['state'] is None:
+    return False
+  return row['state'] in FAILED_STATES or is_orphaned(row)
+
+def get_orphaned_status():
+  """ Builds the status reported for orphaned runs.
+
+  Returns:
+    A dict in the format of get_status() of AppScaleUp/AppScaleDown.
+  """
+  return {'status': 'error', 'percent': 0, 'error_message': ORPHANED_MESSAGE}
+
+def is_process_alive(pid):
+  """ Checks if a process is still running on this host.
+
+  Args:
+    pid: An int, the process ID.
+  Returns:
+    True if the process exists, False otherwise.
+  """
+  if pid == os.getpid():
+    return True
+  try:
+    os.kill(pid, 0)
+  except OSError as error:
+    return error.errno == errno.EPERM
+  return True
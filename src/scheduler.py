@@ -0,0 +1,157 @@
+""" Limits how many AppScale tools runs a process executes at once. Runs
+  beyond the limit wait in a priority queue and are started in order as
+  earlier runs finish.
+"""
+import heapq
+import itertools
+import logging
+import threading
+
+
+# Priorities of queued runs. Lower values are started first, so that
+# terminations, which free cloud resources, go ahead of pending deployments.
+TERMINATION_PRIORITY = 0
+DEPLOYMENT_PRIORITY = 1
+
+
+class DeploymentScheduler(object):
+  """ Starts AppScaleUp and AppScaleDown threads, never running more than
+  pool_size of them at once. Runs waiting for a slot are in their queued
+  state and know their position in the queue. Runs of equal priority are
+  started in the order they were submitted.
+  """
+
+  def __init__(self, pool_size):
+    """ Constructor.
+
+    Args:
+      pool_size: An int, the most runs to execute at once.
+    """
+    self.pool_size = max(int(pool_size), 1)
+    self.lock = threading.Lock()
+    self.queue = []
+    self.running = set()
+    self.counter = itertools.count()
+
+  def submit(self, run, priority):
+    """ Starts a run now if there is a free slot, and queues it otherwise.
+
+    Args:
+      run: An AppScaleUp or AppScaleDown which has not been started.
+      priority: An int, TERMINATION_PRIORITY or DEPLOYMENT_PRIORITY.
+    """
+    run.finish_callbacks.append(self.on_finish)
+    with self.lock:
+      if len(self.running) < self.pool_size:
+        self.running.add(run)
+        run.start()
+        return
+
+      heapq.heappush(self.queue, (priority, next(self.counter), run))
+      run.set_state(run.QUEUED_STATE)
+      self.update_positions()
+      logging.info("Queued {0} behind {1} running runs.".format(run.keyname,
+        len(self.running)))
+
+  def on_finish(self, run):
+    """ Frees the slot of a finished run and starts the next queued run.
+
+    Args:
+      run: The AppScaleUp or AppScaleDown which finished.
+    """
+    with self.lock:
+      self.running.discard(run)
+      if not self.queue or len(self.running) >= self.pool_size:
+        return
+      _, _, next_run = heapq.heappop(self.queue)
+      self.running.add(next_run)
+      next_run.start()
+      self.update_positions()
+
+  def remove(self, run):
+    """ Takes a run out of the queue, so it is never started.
+
+    Args:
+      run: An AppScaleUp or AppScaleDown.
+    Returns:
+      True if the run was queued, False otherwise.
+    """
+    with self.lock:
+      for index, (_, _, queued_run) in enumerate(self.queue):
+        if queued_run is run:
+          self.queue.pop(index)
+          heapq.heapify(self.queue)
+          self.update_positions()
+          return True
+    return False
+
+  def update_positions(self):
+    """ Tells every queued run its position in the queue, starting at 1.
+    Must be called with the lock held.
+    """
+    for position, (_, _, run) in enumerate(sorted(self.queue)):
+      run.set_queue_position(position + 1)
+
+  def get_running(self):
+    """ Lists the runs which hold a slot.
+
+    Returns:
+      A list of AppScaleUp and AppScaleDown threads.
+    """
+    with self.lock:
+      return list(self.running)
+
+  def get_queue_length(self):
+    """ Counts the runs waiting for a slot.
+
+    Returns:
+      An int, the number of queued runs.
+    """
+    with self.lock:
+      return len(self.queue)
+
+
+class RunBatch(object):
+  """ Submits a list of runs to a DeploymentScheduler, never more than a
+  given number at once, so that a large batch does not fill the whole
+  scheduler. Each run is submitted when an earlier one finishes.
+  """
+
+  def __init__(self, run_scheduler, runs, priority, parallelism):
+    """ Constructor.
+
+    Args:
+      run_scheduler: The DeploymentScheduler to submit the runs to.
+      runs: A list of AppScaleUp or AppScaleDown threads, not yet started.
+      priority: An int, the priority to submit the runs with.
+      parallelism: An int, the most runs of the batch submitted at once.
+    """
+    self.run_scheduler = run_scheduler
+    self.pending = list(runs)
+    self.priority = priority
+    self.parallelism = max(int(parallelism), 1)
+    self.lock = threading.Lock()
+
+  def start(self):
+    """ Submits the first runs of the batch. """
+    for _ in range(self.parallelism):
+      self.submit_next()
+
+  def submit_next(self):
+    """ Submits the next run of the batch, if any are left. """
+    with self.lock:
+      if not self.pending:
+        return
+      run = self.pending.pop(0)
+    # Called before the scheduler's own callback, while the finished run
+    # still holds its slot, so the next run waits at most until then.
+    run.finish_callbacks.append(self.on_finish)
+    self.run_scheduler.submit(run, self.priority)
+
+  def on_finish(self, run):
+    """ Submits the next run once one of the batch finishes.
+
+    Args:
+      run: The AppScaleUp or AppScaleDown which finished.
+    """
+    self.submit_next()
@@ -0,0 +1,31 @@
+""" Template tags loading the bundles of scripts and stylesheets built by
+  build_static.py.
+"""
+from django import template
+from django.conf import settings
+from django.utils.html import format_html
+from django.utils.html import format_html_join
+
+from src import assets
+
+
+register = template.Library()
+
+
+@register.simple_tag
+def bundle(name):
+  """ Renders the tags that load a bundle.
+
+  Args:
+    name: A str, the name of a bundle in assets.BUNDLES.
+  Returns:
+    A str, a link tag for a stylesheet bundle or a script tag for a script
+    bundle. There is one tag per source file if the bundles have not been
+    built.
+  """
+  if name.endswith(".css"):
+    tag = u'<link rel="stylesheet" href="{0}">'
+  else:
+    tag = u'<script src="{0}"></script>'
+  return format_html_join(u"\n", tag, ((settings.STATIC_URL + path,)
+    for path in assets.get_bundle_paths(name)))
@@ -1,23 +1,55 @@
+import BaseHTTPServer
+import gzip
+import json
 import os
+import re
+import shutil
+import socket
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from cStringIO import StringIO
 from flexmock import flexmock
 
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
 import appscale_tools_thread
+import assets
+import helpers
+import host_discovery
+import preflight
+import progress
+import reaper
+import registry
+import scheduler
+import tools_output
+import tools_worker
+import watchdog
+from generate_ssl_cert import NginxCert
 
-sys.path.append(os.path.join(os.path.dirname(__file__), "../appscale-tools/lib"))
-from appscale_tools import AppScaleTools
-from custom_exceptions import BadConfigurationException
-import parse_args
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+from django.conf import settings
+from django.http import QueryDict
+from django.test.client import Client
+from django.test.utils import override_settings
+from src import views
 
 
-class FakeIOString():
-  def __init__(self):
-    pass
-  def getvalue(self):
-    return "\n\n\n"
+def load_tools():
+  """ Imports the AppScale tools the way AppsCake does, on first use.
+
+  Returns:
+    A tuple of the AppScaleTools class, the BadConfigurationException of the
+    tools and the parse_args module.
+  """
+  modules = tools_worker.load_tools()
+  return (modules['appscale_tools'].AppScaleTools,
+    modules['custom_exceptions'].BadConfigurationException,
+    modules['parse_args'])
+
 
 class TestAppScaleDown(unittest.TestCase):
   def test_constructor(self):
@@ -33,6 +65,7 @@ class TestAppScaleDown(unittest.TestCase):
     appscale_thread.run()
   
   def test_appscale_down(self):
+    AppScaleTools, BadConfigurationException, parse_args = load_tools()
     appscale_thread = appscale_tools_thread.\
       AppScaleDown("cluster", "keyname")
 
@@ -57,12 +90,20 @@ class TestAppScaleDown(unittest.TestCase):
     appscale_thread.state = "terminating"
     flexmock(appscale_thread).should_receive("get_completion_percentage").\
       and_return(percent).once()
-    self.assertEquals({'status':'terminating', 'percent':percent}, appscale_thread.get_status())
+    self.assertEquals({'status':'terminating', 'percent':percent, 'eta':None}, appscale_thread.get_status())
    
   def test_completion_percentage(self):
     appscale_thread = appscale_tools_thread.AppScaleDown("cloud", "keyname")
-    appscale_thread.std_out_capture = FakeIOString()
-    self.assertEquals(60, appscale_thread.get_completion_percentage())
+    appscale_thread.progress.start()
+    self.assertEquals(0, appscale_thread.get_completion_percentage())
+
+    appscale_thread.std_out_capture.write("Terminating instances spawned "
+      "with keyname keyname\n")
+    self.assertEquals(12, appscale_thread.get_completion_percentage())
+
+    appscale_thread.std_out_capture.write("Terminated AppScale\n"
+      "Successfully shut down your AppScale deployment.\n")
+    self.assertEquals(99, appscale_thread.get_completion_percentage())
 
 class TestAppScaleUp(unittest.TestCase):
   def test_constructor(self):
@@ -110,6 +151,7 @@ class TestAppScaleUp(unittest.TestCase):
     self.assertRaises(NotImplementedError, appscale.appscale_up)
 
   def test_run_addkeypair(self):
+    AppScaleTools, BadConfigurationException, parse_args = load_tools()
     appscale = appscale_tools_thread.\
       AppScaleUp("cloud", "keyname", "a@a.com", "aaaaaa")
     class Args():
@@ -157,6 +199,7 @@ class TestAppScaleUp(unittest.TestCase):
     self.assertEquals(True, appscale.run_simple_cloud_deploy())
 
   def test_run_appscale(self):
+    AppScaleTools, BadConfigurationException, parse_args = load_tools()
     appscale = appscale_tools_thread.\
       AppScaleUp("cloud", "keyname", "a@a.com", "aaaaaa")
     class Args():
@@ -192,11 +235,1269 @@ class TestAppScaleUp(unittest.TestCase):
 
     appscale.state = appscale.RUNNING_STATE
     flexmock(appscale).should_receive("get_completion_percentage").and_return(10)
-    self.assertEquals({'status': 'running', 'percent': 10}, appscale.get_status())
+    self.assertEquals({'status': 'running', 'percent': 10, 'eta': None}, appscale.get_status())
 
     appscale.state = appscale.COMPLETE_STATE
     self.assertEquals({'status': 'complete', 'link': None, 'percent': 100}, appscale.get_status())
   
-    
+  def test_set_status_link(self):
+    appscale = appscale_tools_thread.\
+      AppScaleUp("cloud", "keyname", "a@a.com", "aaaaaa")
+    appscale.std_out_capture.write("Starting AppScale\n" +
+      appscale.STATUS_LINK_LINE + " http://1.2.3.4:1080/status\nDone\n")
+    appscale.set_status_link()
+    self.assertEquals("http://1.2.3.4:1080/", appscale.link)
+
+
+class TestAssets(unittest.TestCase):
+  def setUp(self):
+    self.static_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.static_dir, "css", "lib"))
+    files = {
+      "css/style.css": "/* @import statements. */\n"
+        "@import url('lib/base.css');\n@import \"print.css\" print;\n"
+        "a { background: url(../img/a.png); }",
+      "css/lib/base.css": "@import url(\"http://fonts/lato\");\n"
+        "b { background: url('icons.svg#x') }",
+      "css/print.css": "i { color: red }",
+      "a.js": "var a = 1",
+      "b.js": "var b = 2;",
+    }
+    for path, contents in files.items():
+      with open(os.path.join(self.static_dir, path), 'w') as file_handle:
+        file_handle.write(contents)
+
+  def tearDown(self):
+    shutil.rmtree(self.static_dir)
+
+  def test_combine(self):
+    self.assertEquals('@import url("http://fonts/lato");\n\n\n'
+      'b { background: url("../css/lib/icons.svg#x") }\n\n'
+      '@media print {\ni { color: red }\n}\n\n'
+      'a { background: url("../img/a.png"); }',
+      assets.combine("style.css", ["css/style.css"], self.static_dir))
+    self.assertEquals("var a = 1;\nvar b = 2;",
+      assets.combine("app.js", ["a.js", "b.js"], self.static_dir))
+
+  def test_build(self):
+    flexmock(assets).should_receive("minify").replace_with(
+      lambda name, contents: contents)
+    manifest = assets.build(self.static_dir, {'app.js': ["a.js", "b.js"]})
+    path = manifest['app.js']
+    self.assertTrue(path.startswith("bundles/app."))
+    self.assertEquals(manifest, assets.build(self.static_dir,
+      {'app.js': ["a.js", "b.js"]}))
+
+    with open(os.path.join(self.static_dir, path + ".gz"), 'rb') as \
+      file_handle:
+      compressed = file_handle.read()
+    self.assertEquals("var a = 1;\nvar b = 2;", gzip.GzipFile(
+      fileobj=StringIO(compressed)).read())
+    self.assertEquals([path], assets.get_bundle_paths("app.js",
+      self.static_dir))
+    self.assertEquals(assets.BUNDLES['head.js'],
+      assets.get_bundle_paths("head.js", self.static_dir))
+
+
+class TestNginxCert(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    NginxCert.LOCAL_NGINX_PATH = self.directory + "/"
+
+  def tearDown(self):
+    NginxCert.LOCAL_NGINX_PATH = "/etc/nginx/"
+    shutil.rmtree(self.directory)
+
+  def test_generate_ssl_certs(self):
+    self.assertEquals({'a': True, 'b': True},
+      NginxCert.generate_ssl_certs(["a", "b"], min_validity=60))
+    with open(NginxCert.get_certificate_location("a")) as file_handle:
+      certificate = file_handle.read()
+    self.assertEquals({'a': False, 'b': False},
+      NginxCert.generate_ssl_certs(["a", "b"], min_validity=60))
+    with open(NginxCert.get_certificate_location("a")) as file_handle:
+      self.assertEquals(certificate, file_handle.read())
+
+    # A certificate valid for less than the window is replaced, along with
+    # its key, by swapping the directory they are read through.
+    self.assertTrue(NginxCert.generate_ssl_cert("a",
+      min_validity=(NginxCert.VALID_DAYS + 1) * 24 * 60 * 60))
+    self.assertTrue(NginxCert.generate_ssl_cert("b"))
+    with open(NginxCert.get_certificate_location("a")) as file_handle:
+      self.assertNotEquals(certificate, file_handle.read())
+    names = sorted(os.listdir(self.directory))
+    self.assertEquals(["a-cert.pem", "a-key.pem", "a-ssl"], names[:3])
+    self.assertTrue(names[3].startswith("a-ssl."))
+    self.assertEquals(["b-cert.pem", "b-key.pem", "b-ssl"], names[4:7])
+    self.assertTrue(names[7].startswith("b-ssl."))
+    self.assertEquals(8, len(names))
+    self.assertEquals(["cert.pem", "key.pem"], sorted(os.listdir(
+      os.path.join(self.directory, names[3]))))
+
+  def test_generate_duplicate_keynames(self):
+    self.assertEquals({'a': True}, NginxCert.generate_ssl_certs(["a", "a"]))
+    self.assertEquals(4, len(os.listdir(self.directory)))
+
+  def test_replace_plain_files(self):
+    for location in [NginxCert.get_private_key_location("a"),
+      NginxCert.get_certificate_location("a")]:
+      with open(location, "w") as file_handle:
+        file_handle.write("old")
+    self.assertTrue(NginxCert.generate_ssl_cert("a"))
+    self.assertTrue(os.path.islink(NginxCert.get_certificate_location("a")))
+    self.assertTrue(NginxCert.is_ssl_cert_valid("a", 60))
+
+
+class TestHelpers(unittest.TestCase):
+  class Params(dict):
+    def getlist(self, name):
+      return [self[name]]
+
+  def test_get_idempotency_key(self):
+    first = self.Params(admin_email="a@a.com", max="2",
+      csrfmiddlewaretoken="x")
+    second = self.Params(max="2 ", admin_email="a@a.com",
+      csrfmiddlewaretoken="y")
+    self.assertEquals(helpers.get_idempotency_key(first, "secret"),
+      helpers.get_idempotency_key(second, "secret"))
+    self.assertNotEquals(helpers.get_idempotency_key(first, "secret"),
+      helpers.get_idempotency_key(self.Params(admin_email="a@a.com",
+      max="3"), "secret"))
+    with_token = helpers.get_idempotency_key(self.Params(max="2",
+      submission_token="abc"), "secret")
+    self.assertTrue(with_token.startswith("token:abc:"))
+    self.assertEquals(with_token, helpers.get_idempotency_key(self.Params(
+      max="2 ", submission_token="abc"), "secret"))
+    self.assertNotEquals(with_token, helpers.get_idempotency_key(self.Params(
+      max="3", submission_token="abc"), "secret"))
+
+
+class TestHostDiscovery(unittest.TestCase):
+  class MetadataHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    PATHS = {'/ip': "10.0.0.2", '/access-configs/0/external-ip': "1.2.3.4"}
+
+    def do_GET(self):
+      if self.headers.get('Metadata-Flavor') != "Google" or \
+        self.path not in self.PATHS:
+        self.send_error(404)
+        return
+      self.send_response(200)
+      self.end_headers()
+      self.wfile.write(self.PATHS[self.path])
+
+    def log_message(self, *args):
+      pass
+
+  def setUp(self):
+    self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+      self.MetadataHandler)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.directory)
+
+  def test_get_host_ips(self):
+    url = "http://127.0.0.1:{0}".format(self.server.server_port)
+    # Nothing listens on the port of the EC2 stand-in, so it is skipped.
+    sources = host_discovery.get_sources(url, "http://127.0.0.1:1")
+    cache_path = os.path.join(self.directory, "host.json")
+    ips = {'public_ip': "1.2.3.4", 'private_ip': "10.0.0.2",
+      'source': "gce"}
+    self.assertEquals(ips, host_discovery.get_host_ips(cache_path,
+      sources=sources))
+
+    self.server.shutdown()
+    self.assertEquals(ips, host_discovery.get_host_ips(cache_path,
+      sources=sources))
+    self.assertEquals("socket", host_discovery.get_host_ips(cache_path,
+      sources=list(reversed(sources)), refresh=True)['source'])
+    self.assertEquals("socket", host_discovery.get_host_ips(cache_path,
+      sources=sources)['source'])
+
+  def test_write_cache_failure(self):
+    cache_path = os.path.join(self.directory, "host.json")
+    flexmock(host_discovery.os).should_receive("rename").and_raise(OSError)
+    host_discovery.write_cache(cache_path, {'public_ip': "1.2.3.4"})
+    self.assertEquals([], os.listdir(self.directory))
+
+
+class TestPreflight(unittest.TestCase):
+  def test_get_ips(self):
+    self.assertEquals(["1.2.3.4", "1.2.3.5", "1.2.3.6"], sorted(
+      preflight.get_ips("master: 1.2.3.4\nappengine:\n- 1.2.3.5\n- 1.2.3.4\n"
+      "database: [1.2.3.6]\n")))
+    self.assertEquals([], preflight.get_ips(None))
+
+  def test_check_nodes(self):
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    def greet():
+      connection, _ = server.accept()
+      connection.sendall("SSH-2.0-OpenSSH\r\n")
+      connection.close()
+    greeter = threading.Thread(target=greet)
+    greeter.start()
+    try:
+      reports = preflight.check_nodes(["127.0.0.1", "127.0.0.2"], 1,
+        server.getsockname()[1])
+    finally:
+      greeter.join(1)
+      server.close()
+
+    self.assertTrue(reports[0]['reachable'])
+    self.assertFalse(reports[1]['reachable'])
+    self.assertEquals("127.0.0.2 ({0})".format(reports[1]['error']),
+      preflight.get_failures(reports))
+    self.assertEquals(None, preflight.get_failures(reports[:1]))
+
+  def test_run_preflight(self):
+    appscale = appscale_tools_thread.AppScaleUp("cluster", "keyname",
+      "a@a.com", "aaaaaa", ips_yaml="master: 1.2.3.4")
+    flexmock(preflight).should_receive("check_nodes").with_args(
+      ["1.2.3.4"], preflight.DEFAULT_TIMEOUT).and_return([{'ip': "1.2.3.4",
+      'reachable': False, 'latency': None, 'error': "timed out"}])
+    flexmock(appscale).should_receive("run_add_keypair").never()
+    self.assertEquals(False, appscale.run_cluster_deploy())
+    self.assertEquals({'status': 'error', 'percent': 0, 'error_message':
+      "Unable to reach nodes over SSH: 1.2.3.4 (timed out)"},
+      appscale.get_status())
+
+
+class TestCaptureStream(unittest.TestCase):
+  def test_counters(self):
+    stream = tools_output.CaptureStream(markers=["link at"])
+    stream.write("first line\nsecond ")
+    self.assertEquals(1, stream.line_count)
+    self.assertEquals(None, stream.last_marker)
+
+    stream.write("line\nthe link at http://x/\n")
+    self.assertEquals(3, stream.line_count)
+    self.assertEquals(len(stream.getvalue()), stream.byte_count)
+    self.assertEquals("link at", stream.last_marker)
+    self.assertEquals(stream.getvalue().index("the link"),
+      stream.last_marker_offset)
+    self.assertEquals("the link at http://x/",
+      stream.get_marker_line("link at"))
+
+  def test_ring_buffer(self):
+    stream = tools_output.CaptureStream(markers=["marker"], ring_size=16)
+    stream.write("0123456789\nthe marker\nabcdef\n")
+    self.assertEquals(29, stream.byte_count)
+    self.assertEquals(11, stream.last_marker_offset)
+    self.assertEquals("e marker\nabcdef\n", stream.getvalue())
+    self.assertEquals("abcdef\n", stream.tail(7))
+    self.assertEquals("ab", stream.read(22, 2))
+    self.assertEquals("e m", stream.read(0, 16))
+
+  def test_spill_to_log(self):
+    directory = tempfile.mkdtemp()
+    try:
+      path = tools_output.get_log_path(directory, "deployment", "../key",
+        "stdout")
+      self.assertEquals(directory, os.path.dirname(os.path.dirname(path)))
+      stream = tools_output.CaptureStream(log_path=path, ring_size=8)
+      stream.write("0123456789\n" * 3)
+      self.assertEquals("0123456789\n" * 3, stream.getvalue())
+      self.assertEquals("34", stream.read(3, 2))
+      stream.close()
+
+      self.assertEquals("23", tools_output.read_log(path, 2, 2))
+      self.assertEquals("", tools_output.read_log(path, 40, 2))
+      self.assertEquals((30, "89\n"), tools_output.tail_log(path, 3))
+      self.assertEquals((0, ""), tools_output.tail_log(path + "x", 3))
+    finally:
+      shutil.rmtree(directory)
+
+  def test_trim_partial_character(self):
+    self.assertEquals("ab", tools_output.trim_partial_character("ab\xc3"))
+    self.assertEquals("ab", tools_output.trim_partial_character("ab\xe2\x82"))
+    self.assertEquals("ab\xe2\x82\xac",
+      tools_output.trim_partial_character("ab\xe2\x82\xac"))
+    self.assertEquals("", tools_output.trim_partial_character(""))
+
+  def test_marker_split_across_writes(self):
+    stream = tools_output.CaptureStream(markers=["link at"])
+    stream.write("the li")
+    stream.write("nk at http://x/")
+    self.assertEquals(None, stream.get_marker_line("link at"))
+    stream.write("\n")
+    self.assertEquals(0, stream.last_marker_offset)
+    self.assertEquals("the link at http://x/",
+      stream.get_marker_line("link at"))
+
+class TestProgress(unittest.TestCase):
+  def test_model_estimate(self):
+    model = progress.ProgressModel([("one", 10), ("two", 30), ("three", 60)])
+    self.assertEquals((0, 100.0), model.estimate(-1, 0))
+    self.assertEquals((40, 160.0), model.estimate(1, 100))
+    self.assertEquals((99, 500.0), model.estimate(2, 500))
+
+    # Progress moves on within a phase, but stays short of the next one.
+    self.assertEquals((25, 190.0), model.estimate(0, 100, 115))
+    self.assertEquals((39, 190.0), model.estimate(0, 100, 130))
+    self.assertEquals((39, 260.0), model.estimate(0, 100, 200))
+
+  def test_tracker_update(self):
+    tracker = progress.ProgressTracker(
+      progress.ProgressModel([("one", 10), ("two", 30), ("three", 60)]))
+    self.assertFalse(tracker.update())
+    tracker.start()
+    tracker.on_marker("one", "one", 0)
+    self.assertEquals(10, tracker.percent)
+    self.assertTrue(tracker.update(tracker.phase_started_at + 15))
+    self.assertEquals(25, tracker.percent)
+    self.assertFalse(tracker.update(tracker.phase_started_at + 15))
+    tracker.update(tracker.phase_started_at + 300)
+    self.assertEquals(39, tracker.percent)
+
+  def test_refresh_progress(self):
+    appscale_thread = appscale_tools_thread.AppScaleDown("cloud", "keyname")
+    self.assertFalse(appscale_thread.refresh_progress())
+    appscale_thread.progress.start()
+    appscale_thread.set_state(appscale_thread.TERMINATING_STATE)
+    appscale_thread.progress.phase_started_at -= 5
+    version = appscale_thread.status.version
+    self.assertTrue(appscale_thread.refresh_progress())
+    self.assertEquals(version + 1, appscale_thread.status.version)
+    self.assertTrue(appscale_thread.status.percent > 0)
+    self.assertFalse(appscale_thread.refresh_progress())
+
+  def test_tracker_ignores_earlier_phases(self):
+    tracker = progress.ProgressTracker(
+      progress.ProgressModel([("one", 10), ("two", 30), ("three", 60)]))
+    tracker.start()
+    tracker.on_marker("two", "two", 0)
+    tracker.on_marker("one", "one", 4)
+    self.assertEquals(1, tracker.phase)
+    self.assertEquals(40, tracker.percent)
+    self.assertEquals(["one", "two"], sorted(tracker.get_transcript()
+      ['markers'].keys()))
+
+  def test_store_learns_durations(self):
+    directory = tempfile.mkdtemp()
+    try:
+      store = progress.TranscriptStore(directory)
+      phases = progress.TERMINATE_INSTANCES_PHASES
+      for index, total in enumerate([100, 200, 300]):
+        tracker = flexmock(get_transcript=lambda total=total: {
+          'markers': {phases[0][0]: 1, phases[1][0]: total - 1},
+          'total': total})
+        store.save(progress.TERMINATE_INSTANCES, "cloud", None,
+          "key{0}".format(index), tracker)
+
+      model = store.get_model(progress.TERMINATE_INSTANCES, "cloud", None)
+      self.assertEquals([1, 198, phases[2][1]], model.durations)
+      self.assertTrue(model is store.get_model(progress.TERMINATE_INSTANCES,
+        "cloud", None))
+    finally:
+      shutil.rmtree(directory)
+
+  def test_store_prunes_transcripts(self):
+    directory = tempfile.mkdtemp()
+    flexmock(progress, MAX_TRANSCRIPTS=2)
+    try:
+      store = progress.TranscriptStore(directory)
+      tracker = flexmock(get_transcript=lambda: {'markers': {}, 'total': 1})
+      path = store.get_path(progress.TERMINATE_INSTANCES, "cloud", None)
+      for index in range(4):
+        store.save(progress.TERMINATE_INSTANCES, "cloud", None,
+          "key{0}".format(index), tracker)
+        os.utime(os.path.join(path, "key{0}.json".format(index)),
+          (index, index))
+      self.assertEquals(["key2.json", "key3.json"], sorted(os.listdir(path)))
+    finally:
+      shutil.rmtree(directory)
+
+class TestDeploymentRegistry(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.registry = registry.DeploymentRegistry(
+      os.path.join(self.directory, "db", "appscake.sqlite3"))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_state_transitions(self):
+    AppScaleTools, BadConfigurationException, parse_args = load_tools()
+    appscale_thread = appscale_tools_thread.AppScaleDown("cloud", "keyname",
+      ec2_access="access", ec2_secret="secret", ec2_url="url",
+      deployment_registry=self.registry)
+    self.assertEquals({'status': 'init', 'percent': 0},
+      self.registry.get_status(registry.TERMINATION, "keyname"))
+    self.assertEquals(None,
+      self.registry.get_status(registry.DEPLOYMENT, "keyname"))
+
+    fake_args = flexmock(name="FakeArgs").should_receive("args").and_return()
+    flexmock(parse_args).should_receive("ParseArgs").and_return(fake_args)
+    flexmock(AppScaleTools).should_receive("terminate_instances").once()
+    self.assertEquals(True, appscale_thread.appscale_down())
+
+    row = self.registry.get(registry.TERMINATION, "keyname")
+    self.assertEquals("terminated", row['state'])
+    self.assertFalse("ec2_secret" in row.keys())
+    self.assertEquals(3, row['version'])
+    self.assertEquals({'status': 'terminated', 'percent': 100},
+      self.registry.get_status(registry.TERMINATION, "keyname"))
+
+  def test_list_statuses(self):
+    for keyname in ["a", "b", "c"]:
+      appscale_tools_thread.AppScaleUp("cloud", keyname, "a@a.com", "aaaaaa",
+        deployment_registry=self.registry)
+    appscale_tools_thread.AppScaleDown("cloud", "a",
+      deployment_registry=self.registry)
+
+    statuses, cursor = self.registry.list_statuses(limit=3)
+    self.assertEquals([(registry.DEPLOYMENT, "a"), (registry.DEPLOYMENT, "b"),
+      (registry.DEPLOYMENT, "c")], [status[:2] for status in statuses])
+    self.assertEquals({'status': 'initializing', 'percent': 0},
+      json.loads(statuses[0][2]))
+    statuses, cursor = self.registry.list_statuses(cursor=cursor, limit=3)
+    self.assertEquals([(registry.TERMINATION, "a")],
+      [status[:2] for status in statuses])
+    self.assertEquals(None, cursor)
+
+    statuses, _ = self.registry.list_statuses(kind=registry.DEPLOYMENT,
+      keynames=["a", "c", "unknown"])
+    self.assertEquals(["a", "c"], [status[1] for status in statuses])
+    statuses, _ = self.registry.list_statuses(states=["init"])
+    self.assertEquals([(registry.TERMINATION, "a")],
+      [status[:2] for status in statuses])
+    self.assertEquals(([], None), self.registry.list_statuses(keynames=[]))
+    self.assertRaises(ValueError, self.registry.list_statuses,
+      keynames=[str(i) for i in range(registry.MAX_PAGE_SIZE + 1)])
+
+  def test_wait_for_change(self):
+    appscale_thread = appscale_tools_thread.AppScaleDown("cloud", "keyname",
+      deployment_registry=self.registry)
+    self.assertEquals(None, self.registry.wait_for_change(
+      registry.TERMINATION, "unknown", None, 1))
+    self.assertEquals((1, {'status': 'init', 'percent': 0}),
+      self.registry.wait_for_change(registry.TERMINATION, "keyname", 1, 0.1,
+      interval=0.05))
+
+    timer = threading.Timer(0.1, appscale_thread.set_state,
+      [appscale_thread.TERMINATED_STATE])
+    timer.start()
+    self.assertEquals((2, {'status': 'terminated', 'percent': 100}),
+      self.registry.wait_for_change(registry.TERMINATION, "keyname", 1, 5,
+      interval=0.05))
+    timer.join()
+
+  def test_status_snapshots(self):
+    appscale = appscale_tools_thread.AppScaleUp("cloud", "keyname",
+      "a@a.com", "aaaaaa", deployment_registry=self.registry)
+    snapshot = appscale.status
+    self.assertFalse(hasattr(snapshot, '__dict__'))
+    self.assertEquals(("initializing", 1), (snapshot.state, snapshot.version))
+
+    appscale.link = "http://1.2.3.4:1080/"
+    appscale.set_state(appscale.COMPLETE_STATE)
+    self.assertEquals("initializing", snapshot.state)
+    self.assertEquals(("complete", 2, "http://1.2.3.4:1080/"),
+      (appscale.status.state, appscale.status.version, appscale.status.link))
+    self.assertEquals(json.loads(appscale.status.payload),
+      self.registry.get_status(registry.DEPLOYMENT, "keyname"))
+
+  def test_get_payload(self):
+    self.assertEquals(None, self.registry.get_payload(registry.DEPLOYMENT,
+      "keyname"))
+    appscale = appscale_tools_thread.AppScaleUp("cloud", "keyname",
+      "a@a.com", "aaaaaa", deployment_registry=self.registry)
+    tag, payload = self.registry.get_payload(registry.DEPLOYMENT, "keyname")
+    self.assertEquals({'status': 'initializing', 'percent': 0},
+      json.loads(payload))
+    self.assertEquals(tag, self.registry.get_payload(registry.DEPLOYMENT,
+      "keyname")[0])
+
+    appscale.set_state(appscale.COMPLETE_STATE)
+    new_tag, payload = self.registry.get_payload(registry.DEPLOYMENT,
+      "keyname")
+    self.assertNotEquals(tag, new_tag)
+    self.assertEquals('complete', json.loads(payload)['status'])
+
+  def test_cancel_request(self):
+    pool = scheduler.DeploymentScheduler(1)
+    running = appscale_tools_thread.AppScaleUp("cloud", "running", "a@a.com",
+      "aaaaaa", deployment_registry=self.registry)
+    flexmock(running).should_receive("start").once()
+    pool.submit(running, scheduler.DEPLOYMENT_PRIORITY)
+    queued = appscale_tools_thread.AppScaleUp("cloud", "queued", "a@a.com",
+      "aaaaaa", deployment_registry=self.registry)
+    pool.submit(queued, scheduler.DEPLOYMENT_PRIORITY)
+    self.assertEquals(1, pool.get_queue_length())
+
+    self.assertTrue(self.registry.request_cancel(registry.DEPLOYMENT,
+      "queued"))
+    run_watchdog = watchdog.RunWatchdog(pool, 60, 4,
+      deployment_registry=self.registry, deployments={"queued": queued})
+    self.assertEquals(1, run_watchdog.check_cancel_requests())
+    self.assertEquals(0, pool.get_queue_length())
+    self.assertNotEquals(None, queued.finished_at)
+    self.assertEquals({'status': 'cancelled', 'percent': 0,
+      'error_message': watchdog.CANCEL_MESSAGE},
+      self.registry.get_status(registry.DEPLOYMENT, "queued"))
+
+    self.assertEquals([], self.registry.get_cancel_requests(
+      registry.DEPLOYMENT))
+    self.assertFalse(self.registry.request_cancel(registry.DEPLOYMENT,
+      "queued"))
+    self.assertEquals([running], pool.get_running())
+
+  def test_claim_submission(self):
+    self.assertEquals("first", self.registry.claim_submission("key", "first",
+      60))
+    self.assertEquals("first", self.registry.claim_submission("key",
+      "second", 60))
+    self.assertEquals("other", self.registry.claim_submission("other key",
+      "other", 60))
+    self.assertEquals("third", self.registry.claim_submission("key", "third",
+      0))
+
+    self.registry.release_submission("key")
+    self.assertEquals("fourth", self.registry.claim_submission("key",
+      "fourth", 60))
+
+    # Requests are not coalesced onto a deployment which failed.
+    deployment = appscale_tools_thread.AppScaleUp("cluster", "fourth",
+      "a@a.com", "aaaaaa", deployment_registry=self.registry)
+    self.assertEquals("fourth", self.registry.claim_submission("key",
+      "fifth", 60))
+    deployment.set_state(deployment.ERROR_STATE)
+    self.assertEquals("sixth", self.registry.claim_submission("key",
+      "sixth", 60))
+
+  def test_batch_status(self):
+    self.assertEquals(None, self.registry.get_batch_status("batch"))
+    for keyname in ["a", "b"]:
+      appscale_tools_thread.AppScaleDown("cloud", keyname,
+        deployment_registry=self.registry)
+    self.registry.add_batch("batch", registry.TERMINATION, ["a", "b", "c"])
+    self.registry.update(registry.TERMINATION, "a", registry.DeploymentStatus(
+      {'status': 'terminated', 'percent': 100}))
+    self.registry.update(registry.TERMINATION, "b", registry.DeploymentStatus(
+      {'status': 'running', 'percent': 50}))
+
+    status = self.registry.get_batch_status("batch")
+    self.assertEquals(3, status['total'])
+    self.assertEquals({'terminated': 1, 'running': 1, 'unknown': 1},
+      status['counts'])
+    self.assertEquals(50, status['percent'])
+    self.assertFalse(status['finished'])
+    self.assertEquals('running', status['runs']['b']['status'])
+
+  def test_clear_credentials(self):
+    os.makedirs(os.path.dirname(self.registry.db_path))
+    connection = sqlite3.connect(self.registry.db_path)
+    connection.execute("CREATE TABLE deployment_registry (id INTEGER "
+      "PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, keyname TEXT NOT NULL, "
+      "state TEXT NOT NULL, status TEXT NOT NULL, deployment_type TEXT, "
+      "ec2_access TEXT, ec2_secret TEXT, ec2_url TEXT, owner_pid INTEGER NOT "
+      "NULL, created REAL NOT NULL, updated REAL NOT NULL, version INTEGER "
+      "NOT NULL DEFAULT 1, UNIQUE (kind, keyname))")
+    connection.execute("INSERT INTO deployment_registry (kind, keyname, "
+      "state, status, ec2_access, ec2_secret, owner_pid, created, updated) "
+      "VALUES ('deployment', 'keyname', 'complete', '{}', 'access', "
+      "'secret', 1, 0, 0)")
+    connection.commit()
+    connection.close()
+
+    row = self.registry.get(registry.DEPLOYMENT, "keyname")
+    self.assertEquals(None, row['ec2_access'])
+    self.assertEquals(None, row['ec2_secret'])
+
+  def test_run_requests(self):
+    self.assertTrue(self.registry.request_run(registry.TERMINATION,
+      "keyname", "cloud", "url", os.getpid()))
+    self.assertEquals(["keyname"],
+      self.registry.get_run_requests(registry.TERMINATION))
+    self.assertEquals({'status': 'queued', 'percent': 0,
+      'queue_position': None},
+      self.registry.get_status(registry.TERMINATION, "keyname"))
+    started = []
+    run_watchdog = watchdog.RunWatchdog(scheduler.DeploymentScheduler(1),
+      60, 4, deployment_registry=self.registry,
+      start_termination=started.append)
+    self.assertEquals(1, run_watchdog.check_termination_requests())
+    self.assertEquals(["keyname"], started)
+
+    appscale_tools_thread.AppScaleDown("cloud", "keyname",
+      deployment_registry=self.registry)
+    self.assertEquals([],
+      self.registry.get_run_requests(registry.TERMINATION))
+    self.assertFalse(self.registry.request_run(registry.TERMINATION,
+      "keyname", "cloud", "url", os.getpid()))
+    self.assertEquals("init", self.registry.get_status(registry.TERMINATION,
+      "keyname")['status'])
+
+  def test_orphaned_run(self):
+    appscale = appscale_tools_thread.AppScaleUp("cloud", "keyname",
+      "a@a.com", "aaaaaa", deployment_registry=self.registry)
+    appscale.set_state(appscale.RUNNING_STATE)
+    flexmock(registry).should_receive("is_process_alive").and_return(False)
+    self.assertEquals(registry.ORPHANED_MESSAGE, self.registry.get_status(
+      registry.DEPLOYMENT, "keyname")['error_message'])
+
+class TestRunReaper(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.registry = registry.DeploymentRegistry(
+      os.path.join(self.directory, "appscake.sqlite3"))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_reap(self):
+    finished = appscale_tools_thread.AppScaleDown("cloud", "finished",
+      ec2_access="access", ec2_secret="secret",
+      deployment_registry=self.registry)
+    flexmock(finished).should_receive("appscale_down").and_return(True)
+    finished.run()
+    finished.set_state(finished.TERMINATED_STATE)
+    queued = appscale_tools_thread.AppScaleDown("cloud", "queued",
+      deployment_registry=self.registry)
+    runs = {"finished": finished, "queued": queued}
+
+    run_reaper = reaper.RunReaper([runs], self.registry, 60)
+    self.assertEquals(0, run_reaper.reap())
+    run_reaper.ttl = 0
+    self.assertEquals(1, run_reaper.reap())
+    self.assertEquals(["queued"], runs.keys())
+
+    row = self.registry.get(registry.TERMINATION, "finished")
+    self.assertEquals("terminated", row['state'])
+    self.assertEquals(finished.finished_at, row['finished'])
+    self.assertNotEquals(None, row['archived'])
+
+
+class TestDeploymentScheduler(unittest.TestCase):
+  def test_queue(self):
+    released = threading.Event()
+    started = []
+    def fake_run(run):
+      def run_tools():
+        started.append(run.keyname)
+        released.wait()
+        return True
+      return run_tools
+    terminations = [appscale_tools_thread.AppScaleDown("cloud",
+      "key{0}".format(index)) for index in range(3)]
+    deployment = appscale_tools_thread.AppScaleUp("cloud", "up", "a@a.com",
+      "aaaaaa")
+    for run in terminations:
+      flexmock(run).should_receive("appscale_down").replace_with(
+        fake_run(run))
+    flexmock(deployment).should_receive("appscale_up").replace_with(
+      fake_run(deployment))
+
+    pool = scheduler.DeploymentScheduler(1)
+    pool.submit(terminations[0], scheduler.TERMINATION_PRIORITY)
+    pool.submit(deployment, scheduler.DEPLOYMENT_PRIORITY)
+    pool.submit(terminations[1], scheduler.TERMINATION_PRIORITY)
+    pool.submit(terminations[2], scheduler.TERMINATION_PRIORITY)
+    self.assertEquals({'status': 'queued', 'percent': 0,
+      'queue_position': 3}, deployment.get_status())
+    self.assertEquals(1, terminations[1].queue_position)
+    self.assertEquals(2, terminations[2].queue_position)
+    self.assertEquals(3, pool.get_queue_length())
+
+    released.set()
+    for run in terminations + [deployment]:
+      while run.ident is None:
+        time.sleep(0.01)
+      run.join()
+    self.assertEquals(["key0", "key1", "key2", "up"], started)
+    self.assertEquals(0, pool.get_queue_length())
+    self.assertEquals(set(), pool.running)
+
+  def test_batch(self):
+    released = threading.Event()
+    running = []
+    most_running = []
+    lock = threading.Lock()
+    def fake_down():
+      with lock:
+        running.append(1)
+        most_running.append(len(running))
+      released.wait()
+      with lock:
+        running.pop()
+      return True
+    terminations = [appscale_tools_thread.AppScaleDown("cloud",
+      "key{0}".format(index)) for index in range(5)]
+    for run in terminations:
+      flexmock(run).should_receive("appscale_down").replace_with(fake_down)
+
+    pool = scheduler.DeploymentScheduler(4)
+    scheduler.RunBatch(pool, terminations, scheduler.TERMINATION_PRIORITY,
+      2).start()
+    self.assertEquals(2, len(pool.get_running()))
+    self.assertEquals(None, terminations[2].ident)
+    while len(running) < 2:
+      time.sleep(0.01)
+
+    released.set()
+    for run in terminations:
+      while run.ident is None:
+        time.sleep(0.01)
+      run.join()
+    self.assertEquals(2, max(most_running))
+    self.assertEquals(set(), pool.running)
+
+  def test_stopped_run_keeps_slot(self):
+    running = threading.Event()
+    released = threading.Event()
+    stalled = appscale_tools_thread.AppScaleDown("cloud", "stalled")
+    def stalled_down():
+      # Tools running in the thread itself, which cannot be killed.
+      stalled.job.attach(None)
+      running.set()
+      released.wait(10)
+      stalled.job.detach()
+      return False
+    flexmock(stalled).should_receive("appscale_down").replace_with(
+      stalled_down)
+    waiting = appscale_tools_thread.AppScaleDown("cloud", "waiting")
+    flexmock(waiting).should_receive("appscale_down").and_return(True)
+
+    pool = scheduler.DeploymentScheduler(1)
+    pool.submit(stalled, scheduler.TERMINATION_PRIORITY)
+    pool.submit(waiting, scheduler.TERMINATION_PRIORITY)
+    running.wait(10)
+    stalled.time_out("Stalled.")
+    self.assertEquals("timeout", stalled.get_status()['status'])
+    self.assertEquals([stalled], pool.get_running())
+    self.assertEquals(None, waiting.ident)
+
+    released.set()
+    stalled.join(10)
+    waiting.join(10)
+    self.assertFalse(waiting.ident is None)
+    self.assertEquals(set(), pool.running)
+
+class TestRunWatchdog(unittest.TestCase):
+  def test_stall_before_tools(self):
+    appscale_thread = appscale_tools_thread.AppScaleUp("cluster", "keyname",
+      "a@a.com", "aaaaaa")
+    run_watchdog = watchdog.RunWatchdog(scheduler.DeploymentScheduler(1), 60,
+      4)
+    self.assertEquals(None, run_watchdog.get_stall(appscale_thread,
+      time.time()))
+
+    # Stuck in add-keypair, before the tools print anything.
+    appscale_thread.started_at = time.time() - 120
+    self.assertEquals(None, appscale_thread.progress.started_at)
+    self.assertEquals("The AppScale tools printed nothing for 1 minutes.",
+      run_watchdog.get_stall(appscale_thread, time.time()))
+
+class TestToolsLoading(unittest.TestCase):
+  def test_load_tools(self):
+    modules = tools_worker.load_tools()
+    self.assertTrue(sys.modules['appscale_tools'] is modules['appscale_tools'])
+    self.assertTrue(modules is tools_worker.load_tools())
+    report = tools_worker.get_import_report()
+    self.assertEquals(os.getpid(), report['pid'])
+    self.assertEquals(sorted(tools_worker.TOOLS_MODULES),
+      sorted(report['modules'].keys()))
+
+  def test_run_command(self):
+    AppScaleTools, BadConfigurationException, parse_args = load_tools()
+    flexmock(parse_args).should_receive("ParseArgs").replace_with(
+      lambda args, name: flexmock(args=args))
+    flexmock(AppScaleTools).should_receive("terminate_instances").and_raise(
+      BadConfigurationException, "Bad keyname").once()
+    try:
+      tools_worker.run_command("terminate_instances", [])
+      self.fail("The bad configuration was not raised.")
+    except tools_worker.BadConfigurationException as bad_config:
+      self.assertEquals("Bad keyname", str(bad_config))
+
+class TestProcessPoolExecutor(unittest.TestCase):
+  def test_execute(self):
+    AppScaleTools, BadConfigurationException, parse_args = load_tools()
+    def terminate_instances(options):
+      print "Terminating instances"
+      sys.stderr.write("Warning\n")
+      if options == ["--fail"]:
+        raise BadConfigurationException("Bad keyname")
+    flexmock(parse_args).should_receive("ParseArgs").replace_with(
+      lambda args, name: flexmock(args=args))
+    flexmock(AppScaleTools).should_receive("terminate_instances").\
+      replace_with(terminate_instances)
+
+    executor = tools_worker.ProcessPoolExecutor(1)
+    try:
+      std_out = tools_output.CaptureStream()
+      std_err = tools_output.CaptureStream()
+      executor.execute("terminate_instances", [], std_out, std_err)
+      self.assertEquals("Terminating instances\n", std_out.getvalue())
+      self.assertEquals("Warning\n", std_err.getvalue())
+
+      self.assertRaises(tools_worker.BadConfigurationException,
+        executor.execute, "terminate_instances", ["--fail"], std_out,
+        std_err)
+      self.assertEquals(2, std_out.line_count)
+    finally:
+      executor.stop()
+
+  def test_cancel(self):
+    AppScaleTools, BadConfigurationException, parse_args = load_tools()
+    def terminate_instances(options):
+      print "Terminating instances"
+      time.sleep(60)
+    flexmock(parse_args).should_receive("ParseArgs").replace_with(
+      lambda args, name: flexmock(args=args))
+    flexmock(AppScaleTools).should_receive("terminate_instances").\
+      replace_with(terminate_instances)
+
+    executor = tools_worker.ProcessPoolExecutor(1)
+    try:
+      appscale_thread = appscale_tools_thread.AppScaleDown("cloud", "keyname",
+        executor=executor)
+      pool = scheduler.DeploymentScheduler(1)
+      pool.submit(appscale_thread, scheduler.TERMINATION_PRIORITY)
+      while not appscale_thread.std_out_capture.line_count:
+        time.sleep(0.01)
+
+      run_watchdog = watchdog.RunWatchdog(pool, 1, 4)
+      self.assertEquals(0, run_watchdog.check_runs())
+      appscale_thread.started_at -= 5
+      appscale_thread.std_out_capture.last_write -= 5
+      self.assertEquals(1, run_watchdog.check_runs())
+      appscale_thread.join(10)
+      self.assertFalse(appscale_thread.is_alive())
+      self.assertEquals({'status': 'timeout', 'percent': 0, 'error_message':
+        "The AppScale tools printed nothing for 0 minutes."},
+        appscale_thread.get_status())
+      self.assertEquals([], pool.get_running())
+    finally:
+      executor.stop()
+
+class TestForkServerExecutor(unittest.TestCase):
+  def test_execute(self):
+    AppScaleTools, BadConfigurationException, parse_args = load_tools()
+    def run_instances(options):
+      print "Starting AppScale in process {0}".format(os.getpid())
+      if options == ["--fail"]:
+        raise SystemExit("Bad arguments")
+    flexmock(parse_args).should_receive("ParseArgs").replace_with(
+      lambda args, name: flexmock(args=args))
+    flexmock(AppScaleTools).should_receive("run_instances").\
+      replace_with(run_instances)
+
+    executor = tools_worker.ForkServerExecutor()
+    try:
+      std_out = tools_output.CaptureStream()
+      std_err = tools_output.CaptureStream()
+      executor.execute("run_instances", [], std_out, std_err)
+      self.assertRaises(SystemExit, executor.execute, "run_instances",
+        ["--fail"], std_out, std_err)
+
+      pids = set(line.split(" ")[-1] for line in
+        std_out.getvalue().splitlines())
+      self.assertEquals(2, len(pids))
+      self.assertFalse(str(os.getpid()) in pids)
+      metrics = executor.get_metrics()
+      self.assertEquals(2, metrics['jobs'])
+      self.assertTrue(metrics['max_startup_seconds'] >= 0)
+    finally:
+      executor.stop()
+
+class TestThreadOutputRouter(unittest.TestCase):
+  def test_concurrent_capture(self):
+    captures = [(StringIO(), StringIO()) for _ in range(5)]
+    barrier = threading.Event()
+    def write_output(index):
+      with tools_output.capture_output(*captures[index]):
+        barrier.wait()
+        for _ in range(100):
+          print "out {0}".format(index)
+          sys.stderr.write("err {0}\n".format(index))
+    threads = [threading.Thread(target=write_output, args=(index,))
+      for index in range(len(captures))]
+    for thread in threads:
+      thread.start()
+    barrier.set()
+    for thread in threads:
+      thread.join()
+
+    for index, (std_out, std_err) in enumerate(captures):
+      self.assertEquals("out {0}\n".format(index) * 100, std_out.getvalue())
+      self.assertEquals("err {0}\n".format(index) * 100, std_err.getvalue())
+
+  def test_unregistered_thread_uses_default(self):
+    default = StringIO()
+    router = tools_output.ThreadOutputRouter(default)
+    router.write("server output")
+    self.assertEquals("server output", default.getvalue())
+
+    capture = StringIO()
+    router.register(capture)
+    router.write("tools output")
+    router.unregister()
+    router.write(" again")
+    self.assertEquals("tools output", capture.getvalue())
+    self.assertEquals("server output again", default.getvalue())
+
+class ViewTestCase(unittest.TestCase):
+  """ Sends requests through the URLs of AppsCake, with views using a
+  registry of their own in a temporary directory.
+  """
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.settings = override_settings(APPSCAKE_LOG_DIR=os.path.join(
+      self.directory, "logs"))
+    self.settings.enable()
+    self.registry = views.registry.DeploymentRegistry(
+      os.path.join(self.directory, "registry.db"))
+    flexmock(views, REGISTRY=self.registry,
+      SCHEDULER=views.scheduler.DeploymentScheduler(4),
+      TRANSCRIPT_STORE=views.progress.TranscriptStore(os.path.join(
+      self.directory, "transcripts")),
+      EXECUTOR=views.tools_worker.IN_PROCESS_EXECUTOR)
+    self.client = Client()
+
+  def tearDown(self):
+    views.DEPLOYMENT_THREADS.clear()
+    views.TERMINATING_THREADS.clear()
+    views.DEPLOYMENT_CREDENTIALS.clear()
+    self.settings.disable()
+    shutil.rmtree(self.directory)
+
+class TestToolsViews(ViewTestCase):
+  def test_get_executor(self):
+    flexmock(views, EXECUTOR=None, WATCHDOG=None, REAPER=None)
+    flexmock(views.watchdog.RunWatchdog).should_receive("start").once()
+    flexmock(views.reaper.RunReaper).should_receive("start").once()
+    self.assertTrue(views.get_executor() is
+      views.tools_worker.IN_PROCESS_EXECUTOR)
+    self.assertTrue(views.get_executor() is
+      views.tools_worker.IN_PROCESS_EXECUTOR)
+
+  def test_get_tools_report(self):
+    flexmock(views, EXECUTOR=None, WATCHDOG=None, REAPER=None)
+    flexmock(views.watchdog.RunWatchdog).should_receive("start")
+    flexmock(views.reaper.RunReaper).should_receive("start")
+    report = json.loads(self.client.get("/gettoolsreport/").content)
+    self.assertEquals(os.getpid(), report['pid'])
+    self.assertEquals(None, report['executor_metrics'])
+
+  def test_get_tools_log(self):
+    deployment_thread = views.appscale_tools_thread.AppScaleUp("cluster",
+      "keyname", "a@a.com", "aaaaaa", deployment_registry=self.registry)
+    path = views.tools_output.get_log_path(settings.APPSCAKE_LOG_DIR,
+      views.registry.DEPLOYMENT, "keyname", "stdout")
+    os.makedirs(os.path.dirname(path))
+    with open(path, "w") as log:
+      log.write("first\nsecond\n")
+
+    # Clients only download output past the offset they already have.
+    message = json.loads(self.client.get("/gettoolslog/",
+      {'keyname': "keyname", 'offset': "6"}).content)
+    self.assertEquals(6, message['offset'])
+    self.assertEquals(13, message['next_offset'])
+    self.assertEquals("second\n", message['data'])
+    self.assertFalse(message['finished'])
+    message = json.loads(self.client.get("/gettoolslog/",
+      {'keyname': "keyname", 'offset': "13"}).content)
+    self.assertEquals("", message['data'])
+    self.assertEquals(13, message['next_offset'])
+
+    # A reconnecting event stream resumes after the last event it saw.
+    deployment_thread.set_state(deployment_thread.ERROR_STATE)
+    response = self.client.get("/gettoolslog/", {'keyname': "keyname"},
+      HTTP_ACCEPT="text/event-stream", HTTP_LAST_EVENT_ID="6")
+    events = "".join(response.streaming_content)
+    self.assertTrue(events.startswith("id: 13\nevent: log\n"))
+    self.assertTrue("first" not in events)
+    self.assertTrue(events.endswith("event: end\ndata: {}\n\n"))
+
+class TestTerminateViews(ViewTestCase):
+  def test_terminate_with_credentials(self):
+    views.appscale_tools_thread.AppScaleUp("cloud", "keyname", "a@a.com",
+      "aaaaaa", ec2_access="access", ec2_secret="secret",
+      deployment_registry=self.registry)
+    response = self.client.get("/terminate/", {'keyname': "keyname"})
+    self.assertEquals(500, response.status_code)
+    self.assertEquals(views.CREDENTIALS_GONE_MESSAGE, response.content)
+
+    views.DEPLOYMENT_CREDENTIALS["keyname"] = {'ec2_access': "access",
+      'ec2_secret': "secret"}
+    flexmock(views.SCHEDULER).should_receive("submit").once()
+    response = self.client.get("/terminate/", {'keyname': "keyname"})
+    self.assertEquals(200, response.status_code)
+    terminate_thread = views.TERMINATING_THREADS["keyname"]
+    self.assertEquals("secret", terminate_thread.ec2_secret)
+    self.assertFalse("ec2_secret" in self.registry.get(
+      views.registry.TERMINATION, "keyname").keys())
+
+    terminate_thread.set_state(terminate_thread.TERMINATED_STATE)
+    terminate_thread.run_finish_callbacks()
+    self.assertEquals({}, views.DEPLOYMENT_CREDENTIALS)
+
+  def test_terminate_in_other_process(self):
+    views.appscale_tools_thread.AppScaleUp("cloud", "keyname", "a@a.com",
+      "aaaaaa", deployment_registry=self.registry)
+    self.registry.get_connection().execute("UPDATE deployment_registry SET "
+      "owner_pid = ?", (os.getpid() + 1,))
+    flexmock(views.registry).should_receive("is_process_alive").and_return(
+      True)
+    flexmock(views.SCHEDULER).should_receive("submit").never()
+
+    response = self.client.get("/terminate/", {'keyname': "keyname"})
+    self.assertEquals(200, response.status_code)
+    row = self.registry.get(views.registry.TERMINATION, "keyname")
+    self.assertEquals("queued", row['state'])
+    self.assertEquals(os.getpid() + 1, row['owner_pid'])
+    self.assertNotEquals(None, row['requested'])
+
+  def test_cancel(self):
+    running = threading.Event()
+    released = threading.Event()
+    deployment_thread = views.appscale_tools_thread.AppScaleUp("cluster",
+      "keyname", "a@a.com", "aaaaaa", deployment_registry=self.registry)
+    flexmock(deployment_thread).should_receive("appscale_up").replace_with(
+      lambda: running.set() or released.wait(10))
+    views.DEPLOYMENT_THREADS["keyname"] = deployment_thread
+    submitted = []
+    flexmock(views.SCHEDULER).should_receive("submit").replace_with(
+      lambda run, priority: submitted.append(run))
+    deployment_thread.start()
+    running.wait(10)
+
+    # The tools run in the deployment thread and cannot be killed, so the
+    # termination waits for them. Cancelling again starts nothing more.
+    for _ in range(2):
+      response = self.client.get("/cancel/", {'keyname': "keyname"})
+      self.assertEquals(200, response.status_code)
+    self.assertEquals("cancelled", self.registry.get_status(
+      views.registry.DEPLOYMENT, "keyname")['status'])
+    self.assertEquals([], submitted)
+    self.assertEquals(1, len(deployment_thread.exit_callbacks))
+
+    released.set()
+    deployment_thread.join(10)
+    self.assertEquals([views.TERMINATING_THREADS["keyname"]], submitted)
+
+    response = self.client.get("/cancel/", {'keyname': "keyname"})
+    self.assertEquals(200, response.status_code)
+    self.assertEquals(1, len(submitted))
+
+  def test_cancel_running_in_thread(self):
+    deployment_thread = views.appscale_tools_thread.AppScaleUp("cluster",
+      "keyname", "a@a.com", "aaaaaa", deployment_registry=self.registry)
+    deployment_thread.set_state(deployment_thread.RUNNING_STATE)
+    deployment_thread.job.attach(None)
+    views.DEPLOYMENT_THREADS["keyname"] = deployment_thread
+    flexmock(views.SCHEDULER).should_receive("submit").never()
+
+    # Tools running in the deployment thread cannot be stopped, so the
+    # cancel is refused instead of waiting for the whole deployment.
+    response = self.client.get("/cancel/", {'keyname': "keyname"})
+    self.assertEquals(500, response.status_code)
+    self.assertEquals(views.NOT_CANCELLABLE_MESSAGE, response.content)
+    self.assertEquals("running", self.registry.get_status(
+      views.registry.DEPLOYMENT, "keyname")['status'])
+    self.assertFalse(deployment_thread.job.cancelled)
+
+  def test_cancel_in_other_process(self):
+    deployment_thread = views.appscale_tools_thread.AppScaleUp("cluster",
+      "keyname", "a@a.com", "aaaaaa", deployment_registry=self.registry)
+    deployment_thread.set_state(deployment_thread.RUNNING_STATE)
+    self.registry.get_connection().execute("UPDATE deployment_registry SET "
+      "owner_pid = ?", (os.getpid() + 1,))
+    flexmock(views.registry).should_receive("is_process_alive").and_return(
+      True)
+    response = self.client.get("/cancel/", {'keyname': "keyname"})
+    self.assertEquals(500, response.status_code)
+    self.assertEquals(None, self.registry.get(views.registry.DEPLOYMENT,
+      "keyname")['cancel_requested'])
+
+    with override_settings(APPSCAKE_TOOLS_BACKEND='process'):
+      response = self.client.get("/cancel/", {'keyname': "keyname"})
+    self.assertEquals(200, response.status_code)
+    self.assertNotEquals(None, self.registry.get(views.registry.DEPLOYMENT,
+      "keyname")['cancel_requested'])
+
+class TestStatusViews(ViewTestCase):
+  def test_get_statuses(self):
+    for keyname in ["a", "b", "c"]:
+      views.appscale_tools_thread.AppScaleUp("cluster", keyname, "a@a.com",
+        "aaaaaa", deployment_registry=self.registry)
+
+    keynames = []
+    params = {'kind': "deployment", 'limit': "2"}
+    while True:
+      response = self.client.get("/getstatuses/", params)
+      self.assertEquals(200, response.status_code)
+      page = json.loads(response.content)
+      self.assertTrue(len(page['statuses']) <= 2)
+      keynames.extend(status['keyname'] for status in page['statuses'])
+      if page['next_cursor'] is None:
+        break
+      params['cursor'] = page['next_cursor']
+    self.assertEquals(["a", "b", "c"], keynames)
+
+    # Keynames past the most one query holds are refused, not dropped.
+    response = self.client.get("/getstatuses/", {'keyname': [str(i)
+      for i in range(views.registry.MAX_PAGE_SIZE + 1)]})
+    self.assertEquals(400, response.status_code)
+    self.assertEquals("error", json.loads(response.content)['status'])
+
+  def test_get_status_etag(self):
+    deployment_thread = views.appscale_tools_thread.AppScaleUp("cluster",
+      "keyname", "a@a.com", "aaaaaa", deployment_registry=self.registry)
+    response = self.client.get("/getdeploymentstatus/",
+      {'keyname': "keyname"})
+    self.assertEquals(200, response.status_code)
+    self.assertEquals("initializing",
+      json.loads(response.content)['status'])
+    etag = response['ETag']
+
+    # Tags weakened by nginx compressing the response still match.
+    for header in [etag, "W/" + etag, '"0", ' + etag]:
+      response = self.client.get("/getdeploymentstatus/",
+        {'keyname': "keyname"}, HTTP_IF_NONE_MATCH=header)
+      self.assertEquals(304, response.status_code)
+      self.assertEquals("", response.content)
+      self.assertEquals(etag, response['ETag'])
+
+    deployment_thread.set_state(deployment_thread.ERROR_STATE)
+    response = self.client.get("/getdeploymentstatus/",
+      {'keyname': "keyname"}, HTTP_IF_NONE_MATCH=etag)
+    self.assertEquals(200, response.status_code)
+    self.assertNotEquals(etag, response['ETag'])
+
+  def test_stream_limit(self):
+    flexmock(views, STREAM_SLOTS=threading.BoundedSemaphore(1))
+    deployment_thread = views.appscale_tools_thread.AppScaleUp("cluster",
+      "keyname", "a@a.com", "aaaaaa", deployment_registry=self.registry)
+    deployment_thread.set_state(deployment_thread.ERROR_STATE)
+    stream = self.client.get("/streamdeploymentstatus/",
+      {'keyname': "keyname"}, HTTP_ACCEPT="text/event-stream")
+    self.assertEquals(200, stream.status_code)
+
+    # Streams past the limit are turned away until one is closed.
+    for path, params in [("/streamdeploymentstatus/", {}),
+      ("/gettoolslog/", {'HTTP_ACCEPT': "text/event-stream"})]:
+      response = self.client.get(path, {'keyname': "keyname"}, **params)
+      self.assertEquals(503, response.status_code)
+      self.assertEquals(str(views.STREAM_RETRY_AFTER),
+        response['Retry-After'])
+    stream.close()
+    response = self.client.get("/streamdeploymentstatus/",
+      {'keyname': "keyname"})
+    self.assertEquals(200, response.status_code)
+    self.assertEquals("error", json.loads(response.content)['status'])
+    self.assertTrue(views.STREAM_SLOTS.acquire(False))
+
+class TestBulkTerminateViews(ViewTestCase):
+  def test_bulk_terminate(self):
+    for keyname in ["a", "b"]:
+      deployment_thread = views.appscale_tools_thread.AppScaleUp("cluster",
+        keyname, "a@a.com", "aaaaaa", deployment_registry=self.registry)
+      deployment_thread.set_state(deployment_thread.COMPLETE_STATE)
+    views.appscale_tools_thread.AppScaleUp("cloud", "c", "a@a.com",
+      "aaaaaa", deployment_registry=self.registry)
+    submitted = []
+    flexmock(views.SCHEDULER).should_receive("submit").replace_with(
+      lambda run, priority: submitted.append(run))
+
+    response = self.client.post("/bulkterminate/", {'keyname': ["a", "c"]})
+    self.assertEquals(200, response.status_code)
+    result = json.loads(response.content)
+    self.assertEquals(["a"], result['keynames'])
+    self.assertEquals(["c"], result['unavailable'])
+    self.assertEquals([views.TERMINATING_THREADS["a"]], submitted)
+
+    # A deployment already being terminated is not terminated again.
+    response = self.client.post("/bulkterminate/", {'state': "complete"})
+    self.assertEquals(["a", "b"], json.loads(response.content)['keynames'])
+    self.assertEquals([views.TERMINATING_THREADS["a"],
+      views.TERMINATING_THREADS["b"]], submitted)
+
+    status = json.loads(self.client.get("/getbulkterminationstatus/",
+      {'batch': result['batch']}).content)
+    self.assertEquals(1, status['total'])
+    self.assertEquals({'init': 1}, status['counts'])
+    self.assertFalse(status['finished'])
+    terminate_thread = views.TERMINATING_THREADS["a"]
+    terminate_thread.set_state(terminate_thread.TERMINATED_STATE)
+    status = json.loads(self.client.get("/getbulkterminationstatus/",
+      {'batch': result['batch']}).content)
+    self.assertEquals({'terminated': 1}, status['counts'])
+    self.assertTrue(status['finished'])
+
+    status = json.loads(self.client.get("/getbulkterminationstatus/",
+      {'batch': "unknown"}).content)
+    self.assertEquals("error", status['status'])
+
+  def test_csrf(self):
+    views.appscale_tools_thread.AppScaleUp("cluster", "keyname", "a@a.com",
+      "aaaaaa", deployment_registry=self.registry)
+    flexmock(views.SCHEDULER).should_receive("submit")
+    client = Client(enforce_csrf_checks=True)
+    response = client.post("/bulkterminate/", {'keyname': "keyname"})
+    self.assertEquals(403, response.status_code)
+
+    client.get("/getstatuses/")
+    token = client.cookies['csrftoken'].value
+    response = client.post("/bulkterminate/", {'keyname': "keyname"},
+      HTTP_X_CSRFTOKEN=token)
+    self.assertEquals(200, response.status_code)
+    self.assertEquals(["keyname"], json.loads(response.content)['keynames'])
+
+class TestStartViews(ViewTestCase):
+  def test_start_coalescing(self):
+    flexmock(views.SCHEDULER).should_receive("submit")
+    params = {'cluster': "Submit", 'admin_email': "a@a.com",
+      'admin_pass': "aaaaaa", 'root_pass': "root",
+      'ips_yaml': "controller: 1.2.3.4", 'submission_token': "abc"}
+    for _ in range(2):
+      response = self.client.post("/start/", params)
+      self.assertEquals(200, response.status_code)
+    self.assertEquals(1, len(views.DEPLOYMENT_THREADS))
+    keyname, deployment_thread = views.DEPLOYMENT_THREADS.items()[0]
+    self.assertTrue(keyname in response.content)
+
+    # The same form with other parameters is a new request.
+    response = self.client.post("/start/", dict(params,
+      ips_yaml="controller: 1.2.3.5"))
+    self.assertEquals(2, len(views.DEPLOYMENT_THREADS))
+
+    # A failed deployment is started again.
+    deployment_thread.set_state(deployment_thread.ERROR_STATE)
+    response = self.client.post("/start/", params)
+    self.assertEquals(3, len(views.DEPLOYMENT_THREADS))
+    self.assertFalse(keyname in response.content)
+
+  def test_start_failure(self):
+    flexmock(views.appscale_tools_thread).should_receive("AppScaleUp") \
+      .and_raise(IOError)
+    params = {'cluster': "Submit", 'admin_email': "a@a.com",
+      'admin_pass': "aaaaaa", 'root_pass': "root",
+      'ips_yaml': "controller: 1.2.3.4", 'submission_token': "abc"}
+    self.assertRaises(IOError, self.client.post, "/start/", params)
+    self.assertEquals({}, views.DEPLOYMENT_THREADS)
+
+    # A retry of the request is not coalesced onto the failed one.
+    query = QueryDict("", mutable=True)
+    query.update(params)
+    idempotency_key = helpers.get_idempotency_key(query, settings.SECRET_KEY)
+    self.assertEquals("retry", self.registry.claim_submission(
+      idempotency_key, "retry", settings.APPSCAKE_DUPLICATE_WINDOW))
+
+  def test_home_tokens(self):
+    response = self.client.get("/")
+    tokens = re.findall(r'name="submission_token" value="(\w+)"',
+      response.content)
+    self.assertEquals(2, len(tokens))
+    self.assertNotEquals(tokens[0], tokens[1])
+
 if __name__ == "__main__":
   unittest.main()
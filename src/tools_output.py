@@ -0,0 +1,489 @@
+""" Stream classes for capturing the output of the AppScale tools while
+  several deployments run at the same time in one process.
+"""
+import contextlib
+import errno
+import logging
+import mmap
+import os
+import sys
+import threading
+import time
+import urllib
+
+
+# The number of bytes of each transcript kept in memory.
+RING_SIZE = 64 * 1024
+
+
+class RingBuffer(object):
+  """ Holds the most recent bytes written to a stream, up to a fixed size,
+  along with the offset in the stream of the oldest byte held.
+  """
+
+  def __init__(self, size):
+    """ Constructor.
+
+    Args:
+      size: An int, the most bytes to hold.
+    """
+    self.size = size
+    self.data = bytearray()
+    self.start = 0
+
+  def write(self, data):
+    """ Appends data, dropping the oldest bytes once the buffer is full.
+
+    Args:
+      data: A str to append.
+    """
+    self.data.extend(data)
+    excess = len(self.data) - self.size
+    if excess > 0:
+      del self.data[:excess]
+      self.start += excess
+
+  def read(self, offset, length):
+    """ Reads bytes still held in the buffer.
+
+    Args:
+      offset: An int, the offset in the stream to start at.
+      length: An int, the most bytes to read.
+    Returns:
+      A str, or None if bytes at the offset have been dropped.
+    """
+    if offset < self.start:
+      return None
+    begin = offset - self.start
+    return str(self.data[begin:begin + max(length, 0)])
+
+
+class CaptureStream(object):
+  """ A write-only stream holding the captured output of one tools command.
+  Line and byte counts are kept up to date as output is written and every
+  complete line is checked against a set of markers, so readers never have
+  to copy or scan the whole transcript. Only the end of the transcript is
+  kept in memory; the full transcript can be spilled to a log file.
+  """
+
+  # The longest partial line we keep around while waiting for its newline.
+  # Anything longer cannot be one of the short lines the tools print for
+  # markers.
+  MAX_PARTIAL_LINE = 4096
+
+  def __init__(self, markers=(), listener=None, log_path=None,
+    ring_size=RING_SIZE):
+    """ Constructor.
+
+    Args:
+      markers: A list of strs. Lines containing any of them are remembered
+        and can be looked up with get_marker_line.
+      listener: A function called with the marker, the line and its byte
+        offset whenever a line matches a marker.
+      log_path: A str, the file to write the full transcript to, replacing
+        any earlier contents. Only the last ring_size bytes are kept if not
+        given.
+      ring_size: An int, the number of bytes of the transcript kept in
+        memory.
+    """
+    self.ring = RingBuffer(ring_size)
+    self.log_path = log_path
+    self.log_file = None
+    if log_path:
+      self.log_file = open_log(log_path)
+      if self.log_file is None:
+        self.log_path = None
+    self.markers = tuple(markers)
+    self.listener = listener
+    self.lock = threading.Lock()
+    self.line_count = 0
+    self.byte_count = 0
+    self.last_marker = None
+    self.last_marker_offset = None
+    self.marker_lines = {}
+    self.partial_line = ""
+    self.line_offset = 0
+    self.last_write = None
+
+  def write(self, data):
+    """ Appends data to the transcript and updates the counters.
+
+    Args:
+      data: A str (or unicode) to write.
+    """
+    if not data:
+      return
+    if isinstance(data, unicode):
+      data = data.encode('utf-8')
+
+    log_error = None
+    with self.lock:
+      self.last_write = time.time()
+      offset = self.byte_count
+      self.ring.write(data)
+      if self.log_file:
+        try:
+          self.log_file.write(data)
+        except IOError as error:
+          log_error = error
+          self.log_file = None
+      self.byte_count += len(data)
+      self.line_count += data.count('\n')
+      if self.markers:
+        self.scan_lines(data, offset)
+
+    # Logged once the lock is released, as the log message may itself be
+    # captured by this stream.
+    if log_error:
+      logging.warning("Stopped writing transcript log: {0}".format(log_error))
+
+  def scan_lines(self, data, offset):
+    """ Checks the complete lines in newly written data for markers. Must be
+    called with the lock held.
+
+    Args:
+      data: A str, the data written.
+      offset: An int, the byte offset of the data in the transcript.
+    """
+    lines = data.split('\n')
+    last_line = lines.pop()
+    if not lines:
+      self.partial_line = (self.partial_line + last_line)[
+        -self.MAX_PARTIAL_LINE:]
+      return
+
+    self.match_markers(self.partial_line + lines[0], self.line_offset)
+    offset += len(lines[0]) + 1
+    for line in lines[1:]:
+      self.match_markers(line, offset)
+      offset += len(line) + 1
+    self.line_offset = offset
+    self.partial_line = last_line[-self.MAX_PARTIAL_LINE:]
+
+  def match_markers(self, line, offset):
+    """ Records the markers found in a complete line of output.
+
+    Args:
+      line: A str, the line without its newline.
+      offset: An int, the byte offset of the line in the transcript.
+    """
+    for marker in self.markers:
+      if marker in line:
+        self.last_marker = marker
+        self.last_marker_offset = offset
+        self.marker_lines[marker] = line
+        if self.listener:
+          self.listener(marker, line, offset)
+
+  def get_marker_line(self, marker):
+    """ Looks up the most recent line containing a marker.
+
+    Args:
+      marker: A str, one of the markers given to the constructor.
+    Returns:
+      A str, the matching line, or None if no line has matched yet.
+    """
+    return self.marker_lines.get(marker)
+
+  def read(self, offset, length):
+    """ Reads part of the transcript, from memory if it is still held there
+    and from the log file otherwise. Without a log file, output which has
+    left memory is skipped.
+
+    Args:
+      offset: An int, the byte offset to start at.
+      length: An int, the most bytes to read.
+    Returns:
+      A str with the output read.
+    """
+    with self.lock:
+      data = self.ring.read(offset, length)
+      if data is None and not self.log_path:
+        length -= self.ring.start - offset
+        data = self.ring.read(self.ring.start, length)
+      if data is not None:
+        return data
+    return read_log(self.log_path, offset, length)
+
+  def tail(self, length):
+    """ Reads the end of the transcript.
+
+    Args:
+      length: An int, the most bytes to read.
+    Returns:
+      A str with the last length bytes written.
+    """
+    return self.read(max(self.byte_count - length, 0), length)
+
+  def getvalue(self):
+    """ Copies the whole transcript. This is O(output), so it should only be
+    used when the full transcript is really needed.
+
+    Returns:
+      A str with everything written so far that can still be read.
+    """
+    return self.read(0, self.byte_count)
+
+  def close(self):
+    """ Closes the log file. The transcript can still be read afterwards. """
+    with self.lock:
+      if self.log_file:
+        self.log_file.close()
+        self.log_file = None
+
+  def writelines(self, lines):
+    """ Writes a sequence of strs.
+
+    Args:
+      lines: An iterable of strs to write.
+    """
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    """ Nothing to flush; present so the stream can stand in for a file. """
+    pass
+
+  def isatty(self):
+    """ Tells the tools not to colorize output written to this stream.
+
+    Returns:
+      False.
+    """
+    return False
+
+
+def get_log_path(directory, kind, keyname, name):
+  """ Determines the log file holding a transcript of a run. Keynames are
+  quoted, so any keyname maps to a single file inside the directory.
+
+  Args:
+    directory: A str, the directory holding all transcript logs.
+    kind: A str, the kind of run (as recorded in the deployment registry).
+    keyname: A str, the keyname of the run.
+    name: A str, the name of the stream, such as stdout or stderr.
+  Returns:
+    A str, the path of the log file.
+  """
+  if isinstance(keyname, unicode):
+    keyname = keyname.encode('utf-8')
+  return os.path.join(directory, kind, "{0}.{1}.log".format(
+    urllib.quote(keyname, safe=''), name))
+
+def open_log(path):
+  """ Creates (or empties) a transcript log file for writing. The file is
+  unbuffered, so readers in other processes see output as soon as it is
+  written.
+
+  Args:
+    path: A str, the path of the log file.
+  Returns:
+    A file object, or None if the file could not be created.
+  """
+  try:
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError as error:
+        if error.errno != errno.EEXIST:
+          raise
+    return open(path, 'wb', 0)
+  except (IOError, OSError) as error:
+    logging.warning("Unable to create transcript log {0}: {1}".format(path,
+      error))
+    return None
+
+def read_log(path, offset, length):
+  """ Reads part of a transcript log file through a memory map, so only the
+  pages read are loaded, however large the file is.
+
+  Args:
+    path: A str, the path of the log file.
+    offset: An int, the byte offset to start at.
+    length: An int, the most bytes to read.
+  Returns:
+    A str with the output read, empty if the file does not exist or has
+    nothing at the offset.
+  """
+  try:
+    with open(path, 'rb') as file_handle:
+      size = os.fstat(file_handle.fileno()).st_size
+      if offset < 0 or offset >= size or length <= 0:
+        return ""
+      mapped = mmap.mmap(file_handle.fileno(), size, access=mmap.ACCESS_READ)
+      try:
+        return mapped[offset:offset + length]
+      finally:
+        mapped.close()
+  except (IOError, OSError) as error:
+    if error.errno != errno.ENOENT:
+      logging.warning("Unable to read transcript log {0}: {1}".format(path,
+        error))
+    return ""
+
+def tail_log(path, length):
+  """ Reads the end of a transcript log file.
+
+  Args:
+    path: A str, the path of the log file.
+    length: An int, the most bytes to read.
+  Returns:
+    A tuple of the byte offset the output starts at (an int) and the output
+    (a str).
+  """
+  try:
+    size = os.path.getsize(path)
+  except OSError:
+    return 0, ""
+  offset = max(size - length, 0)
+  return offset, read_log(path, offset, length)
+
+
+def trim_partial_character(data):
+  """ Drops a UTF-8 character cut off at the end of a piece of output, so
+  that the piece can be decoded on its own. The dropped bytes start the
+  next piece.
+
+  Args:
+    data: A str of UTF-8 bytes.
+  Returns:
+    A str, data without any trailing partial character.
+  """
+  for back in range(1, min(len(data), 4) + 1):
+    byte = ord(data[-back])
+    if byte & 0xC0 == 0x80:
+      # A continuation byte; the start of the character is further back.
+      continue
+    if byte & 0x80 == 0:
+      return data
+    if byte & 0xE0 == 0xC0:
+      length = 2
+    elif byte & 0xF0 == 0xE0:
+      length = 3
+    else:
+      length = 4
+    if back < length:
+      return data[:-back]
+    return data
+  return data
+
+
+class ThreadOutputRouter(object):
+  """ A file-like object which takes the place of sys.stdout or sys.stderr
+  and sends every write to the stream registered by the calling thread.
+  Threads that have not registered a stream write to the original stream,
+  so the web server's own output is never lost in a deployment's buffer.
+  """
+
+  def __init__(self, default_stream):
+    """ Constructor.
+
+    Args:
+      default_stream: A file-like object, the stream used by threads which
+        have not registered one (normally the original sys.stdout/stderr).
+    """
+    self.default_stream = default_stream
+    self.streams = {}
+    self.softspaces = {}
+
+  def register(self, stream):
+    """ Routes all writes from the calling thread to the given stream.
+
+    Args:
+      stream: A file-like object to receive the calling thread's output.
+    """
+    self.streams[threading.current_thread().ident] = stream
+
+  def unregister(self):
+    """ Stops routing the calling thread's writes to its own stream. """
+    self.streams.pop(threading.current_thread().ident, None)
+    self.softspaces.pop(threading.current_thread().ident, None)
+
+  def get_stream(self):
+    """ Looks up the stream of the calling thread.
+
+    Returns:
+      The file-like object registered by the calling thread, or the default
+      stream if it has not registered one.
+    """
+    return self.streams.get(threading.current_thread().ident,
+      self.default_stream)
+
+  def write(self, data):
+    """ Writes data to the calling thread's stream.
+
+    Args:
+      data: A str to write.
+    """
+    self.get_stream().write(data)
+
+  def writelines(self, lines):
+    """ Writes a sequence of strs to the calling thread's stream.
+
+    Args:
+      lines: An iterable of strs to write.
+    """
+    stream = self.get_stream()
+    for line in lines:
+      stream.write(line)
+
+  def flush(self):
+    """ Flushes the calling thread's stream, if it supports flushing. """
+    stream = self.get_stream()
+    if hasattr(stream, 'flush'):
+      stream.flush()
+
+  @property
+  def softspace(self):
+    """ The print statement's pending-space flag. It is kept per thread, as
+    it would otherwise leak between the threads sharing this router.
+    """
+    return self.softspaces.get(threading.current_thread().ident, 0)
+
+  @softspace.setter
+  def softspace(self, value):
+    self.softspaces[threading.current_thread().ident] = value
+
+  def __getattr__(self, name):
+    """ Passes any other file attribute (isatty, encoding, fileno...) on to
+    the calling thread's stream.
+    """
+    return getattr(self.get_stream(), name)
+
+
+# Guards the one-time replacement of sys.stdout and sys.stderr.
+INSTALL_LOCK = threading.Lock()
+
+def install_routers():
+  """ Replaces sys.stdout and sys.stderr with ThreadOutputRouters. This is
+  only done once per process; the routers stay installed for its lifetime,
+  so no thread ever has to restore the streams.
+
+  Returns:
+    A tuple of the (stdout, stderr) ThreadOutputRouters.
+  """
+  with INSTALL_LOCK:
+    if not isinstance(sys.stdout, ThreadOutputRouter):
+      sys.stdout = ThreadOutputRouter(sys.stdout)
+    if not isinstance(sys.stderr, ThreadOutputRouter):
+      sys.stderr = ThreadOutputRouter(sys.stderr)
+    return sys.stdout, sys.stderr
+
+@contextlib.contextmanager
+def capture_output(std_out, std_err):
+  """ A context manager which captures everything the calling thread writes
+  to stdout and stderr. Other threads are not affected.
+
+  Args:
+    std_out: A file-like object to receive the thread's stdout.
+    std_err: A file-like object to receive the thread's stderr.
+  """
+  stdout_router, stderr_router = install_routers()
+  stdout_router.register(std_out)
+  stderr_router.register(std_err)
+  try:
+    yield
+  finally:
+    stdout_router.unregister()
+    stderr_router.unregister()
@@ -0,0 +1,713 @@
+""" Executors that run AppScale tools commands on behalf of AppScaleUp and
+  AppScaleDown threads, either in the calling thread or in separate worker
+  processes which have the tools already imported.
+"""
+import collections
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import Queue
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__),"../appscale-tools/lib"))
+
+import tools_output
+
+
+# The AppScaleTools methods that can be executed, mapped to the name of the
+# command line tool whose arguments they take.
+COMMANDS = {
+  'add_keypair': "appscale-add-keypair",
+  'run_instances': "appscale-run-instances",
+  'terminate_instances': "appscale-terminate-instances",
+}
+
+# The modules of the AppScale tools that commands are run with, imported
+# by load_tools in this order.
+TOOLS_MODULES = ["custom_exceptions", "parse_args", "appscale_tools"]
+
+# Libraries the tools load which the fork server imports before forking.
+TOOLS_DEPENDENCIES = ["boto", "SOAPpy", "yaml"]
+
+# The modules of the AppScale tools once load_tools has imported them, and
+# how long importing them took.
+TOOLS = {'modules': None, 'report': None}
+
+# Guards TOOLS.
+TOOLS_LOCK = threading.Lock()
+
+# Kinds of failures sent back by worker processes, so that the calling
+# thread can raise the same kind of exception the tools raised.
+BAD_CONFIGURATION = "bad_configuration"
+SYSTEM_EXIT = "system_exit"
+EXCEPTION = "exception"
+
+
+def load_tools():
+  """ Imports the AppScale tools the first time a command needs them.
+  Rendering pages and serving statuses never do, so AppsCake processes
+  start without paying for the import.
+
+  Returns:
+    A dict mapping each name in TOOLS_MODULES to the imported module.
+  Raises:
+    ImportError: If the tools are not installed.
+  """
+  with TOOLS_LOCK:
+    if TOOLS['modules'] is not None:
+      return TOOLS['modules']
+    started = time.time()
+    modules = {}
+    seconds = {}
+    for name in TOOLS_MODULES:
+      module_started = time.time()
+      modules[name] = __import__(name)
+      seconds[name] = time.time() - module_started
+    TOOLS['report'] = {'pid': os.getpid(), 'loaded_at': time.time(),
+      'seconds': time.time() - started, 'modules': seconds}
+    TOOLS['modules'] = modules
+  logging.info("Imported the AppScale tools in {0:.2f} seconds ({1}).".format(
+    TOOLS['report']['seconds'], ", ".join("{0} {1:.2f}s".format(name,
+    seconds[name]) for name in TOOLS_MODULES)))
+  return modules
+
+def get_import_report():
+  """ Reports how long importing the AppScale tools took in this process.
+
+  Returns:
+    A dict with the process ID, when the tools were imported, the seconds
+    the import took and the seconds taken by each module in TOOLS_MODULES,
+    or None if this process has not imported the tools.
+  """
+  with TOOLS_LOCK:
+    if TOOLS['report'] is None:
+      return None
+    report = dict(TOOLS['report'])
+    report['modules'] = dict(report['modules'])
+    return report
+
+def run_command(command, args):
+  """ Runs an AppScale tools command in the calling thread.
+
+  Args:
+    command: A str, one of the keys of COMMANDS.
+    args: A list of strs, the command line arguments of the command.
+  Raises:
+    BadConfigurationException: If the tools found the configuration bad.
+    Whatever else the tools raise.
+  """
+  modules = load_tools()
+  try:
+    options = modules['parse_args'].ParseArgs(args, COMMANDS[command]).args
+    getattr(modules['appscale_tools'].AppScaleTools, command)(options)
+  except modules['custom_exceptions'].BadConfigurationException as bad_config:
+    raise BadConfigurationException(str(bad_config))
+
+
+class BadConfigurationException(Exception):
+  """ Raised by run_command in place of the BadConfigurationException of the
+  AppScale tools, so that runs can catch it without importing the tools. It
+  is also raised when a worker process reports a bad configuration.
+  """
+  pass
+
+
+class CommandCancelled(Exception):
+  """ Raised when a tools command is not started because its job was
+  cancelled.
+  """
+  pass
+
+
+class CommandNotCancellable(Exception):
+  """ Raised when a job is asked to stop right away while its current
+  command runs in the calling thread, which cannot be interrupted.
+  """
+  pass
+
+
+class ToolsJob(object):
+  """ A handle on the tools commands of one run, through which another
+  thread can cancel them. A command running in a worker process is killed
+  along with every process it started. A command running in the calling
+  thread cannot be interrupted, but no further command of the job starts.
+  """
+
+  def __init__(self):
+    """ Constructor. """
+    self.lock = threading.Lock()
+    self.pid = None
+    self.attached = False
+    self.cancelled = False
+
+  def attach(self, pid):
+    """ Records the process running the job's current command. If the job
+    was already cancelled, the process is killed right away.
+
+    Args:
+      pid: An int, the ID of the process (which leads its own process
+        group), or None if the command runs in the calling thread.
+    Raises:
+      CommandCancelled: If the job was cancelled and the command runs in the
+        calling thread.
+    """
+    with self.lock:
+      self.pid = pid
+      self.attached = True
+      if not self.cancelled:
+        return
+    if pid is None:
+      raise CommandCancelled("The AppScale tools run was cancelled.")
+    self.kill()
+
+  def detach(self):
+    """ Records that the job's current command has finished. """
+    with self.lock:
+      self.pid = None
+      self.attached = False
+
+  def cancel(self):
+    """ Cancels the job, killing its current command if it runs in a worker
+    process.
+
+    Returns:
+      True if a command was killed, False otherwise.
+    """
+    with self.lock:
+      self.cancelled = True
+    return self.kill()
+
+  def cancel_now(self):
+    """ Cancels the job, but only if that stops it right away: no command
+    is running, or the running one is in a worker process and is killed.
+
+    Returns:
+      True if a command was killed, False otherwise.
+    Raises:
+      CommandNotCancellable: If the current command runs in the calling
+        thread. The job is not cancelled then.
+    """
+    with self.lock:
+      if self.attached and self.pid is None:
+        raise CommandNotCancellable("The AppScale tools are running inside "
+          "AppsCake and cannot be interrupted.")
+      self.cancelled = True
+    return self.kill()
+
+  def kill(self):
+    """ Kills the process group of the job's current command.
+
+    Returns:
+      True if a process group was killed, False otherwise.
+    """
+    with self.lock:
+      pid = self.pid
+    if pid is None:
+      return False
+    try:
+      os.killpg(pid, signal.SIGKILL)
+    except OSError as error:
+      logging.warning("Unable to kill tools process {0}: {1}".format(pid,
+        error))
+      return False
+    logging.info("Killed tools process {0}.".format(pid))
+    return True
+
+
+class InProcessExecutor(object):
+  """ Runs tools commands in the calling thread, capturing the thread's
+  output.
+  """
+
+  def execute(self, command, args, std_out, std_err, job=None):
+    """ Runs a tools command.
+
+    Args:
+      command: A str, one of the keys of COMMANDS.
+      args: A list of strs, the command line arguments of the command.
+      std_out: A file-like object receiving the command's stdout.
+      std_err: A file-like object receiving the command's stderr.
+      job: A ToolsJob the command belongs to, or None.
+    Raises:
+      CommandCancelled: If the job was cancelled.
+      Whatever the tools raise.
+    """
+    if job:
+      job.attach(None)
+    try:
+      with tools_output.capture_output(std_out, std_err):
+        run_command(command, args)
+    finally:
+      if job:
+        job.detach()
+
+
+class PipeStream(object):
+  """ A write-only stream which sends each write from a worker process back
+  to the thread that asked for the command.
+  """
+
+  def __init__(self, connection, lock, name):
+    """ Constructor.
+
+    Args:
+      connection: A multiprocessing Connection to the calling process.
+      lock: A threading.Lock shared by all streams on the connection.
+      name: A str, 'out' or 'err'.
+    """
+    self.connection = connection
+    self.lock = lock
+    self.name = name
+
+  def write(self, data):
+    """ Sends data to the calling process.
+
+    Args:
+      data: A str to write.
+    """
+    if data:
+      with self.lock:
+        self.connection.send((self.name, data, None))
+
+  def writelines(self, lines):
+    """ Sends a sequence of strs to the calling process.
+
+    Args:
+      lines: An iterable of strs to write.
+    """
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    """ Nothing to flush; every write is sent right away. """
+    pass
+
+  def isatty(self):
+    """ Tells the tools not to colorize their output.
+
+    Returns:
+      False.
+    """
+    return False
+
+
+def run_in_worker(connection, command, args):
+  """ Runs a tools command in a worker process, sending its output and then
+  its result to the calling process.
+
+  Args:
+    connection: A multiprocessing Connection to the calling process.
+    command: A str, one of the keys of COMMANDS.
+    args: A list of strs, the command line arguments of the command.
+  """
+  send_lock = threading.Lock()
+  sys.stdout = PipeStream(connection, send_lock, 'out')
+  sys.stderr = PipeStream(connection, send_lock, 'err')
+  try:
+    run_command(command, args)
+    result = ('done', None, None)
+  except BadConfigurationException as bad_config:
+    result = ('failed', BAD_CONFIGURATION, str(bad_config))
+  except SystemExit as sys_exit:
+    result = ('failed', SYSTEM_EXIT, str(sys_exit))
+  except Exception as exception:
+    result = ('failed', EXCEPTION, str(exception))
+  finally:
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+  with send_lock:
+    connection.send(result)
+
+def relay_output(connection, std_out, std_err):
+  """ Copies the output of a command running in a worker process into the
+  calling run's streams until the command finishes.
+
+  Args:
+    connection: A multiprocessing Connection to the worker process.
+    std_out: A file-like object receiving the command's stdout.
+    std_err: A file-like object receiving the command's stderr.
+  Raises:
+    BadConfigurationException, SystemExit or Exception, matching what the
+    tools raised in the worker.
+    EOFError, IOError: If the worker process died.
+  """
+  while True:
+    kind, first, second = connection.recv()
+    if kind == 'out':
+      std_out.write(first)
+    elif kind == 'err':
+      std_err.write(first)
+    elif kind == 'done':
+      return
+    elif first == BAD_CONFIGURATION:
+      raise BadConfigurationException(second)
+    elif first == SYSTEM_EXIT:
+      raise SystemExit(second)
+    else:
+      raise Exception(second)
+
+def serve_commands(connection):
+  """ The main loop of a pool worker process. Runs the commands received on
+  the connection one at a time, sending back their output and result,
+  until None is received.
+
+  Args:
+    connection: A multiprocessing Connection to the calling process.
+  """
+  while True:
+    try:
+      message = connection.recv()
+    except (EOFError, IOError):
+      return
+    if message is None:
+      return
+    command, args = message
+    run_in_worker(connection, command, args)
+
+
+class ToolsWorker(object):
+  """ A worker process with the tools imported, ready to run commands. """
+
+  def __init__(self, fork_server):
+    """ Constructor. Has the fork server fork the worker process.
+
+    Args:
+      fork_server: The ForkServer to fork the worker process from.
+    """
+    self.connection, self.pid = fork_server.fork(None)
+    self.broken = False
+
+  def execute(self, command, args, std_out, std_err, job=None):
+    """ Runs a tools command in the worker process and waits for it.
+
+    Args:
+      command: A str, one of the keys of COMMANDS.
+      args: A list of strs, the command line arguments of the command.
+      std_out: A file-like object receiving the command's stdout.
+      std_err: A file-like object receiving the command's stderr.
+      job: A ToolsJob the command belongs to, or None.
+    Raises:
+      BadConfigurationException, SystemExit or Exception, matching what the
+      tools raised in the worker, or Exception if the worker died.
+    """
+    try:
+      if job:
+        job.attach(self.pid)
+      self.connection.send((command, args))
+      relay_output(self.connection, std_out, std_err)
+    except (EOFError, IOError) as error:
+      self.broken = True
+      raise Exception("The AppScale tools worker process {0} exited " \
+        "unexpectedly: {1}".format(self.pid, error))
+    finally:
+      if job:
+        job.detach()
+
+  def is_alive(self):
+    """ Checks if the worker process is still running. It is a child of the
+    fork server, which reaps it as soon as it exits.
+
+    Returns:
+      True if the process is running, False otherwise.
+    """
+    try:
+      os.kill(self.pid, 0)
+    except OSError:
+      return False
+    return True
+
+  def stop(self):
+    """ Asks the worker process to exit, killing it if it is stuck. """
+    try:
+      self.connection.send(None)
+    except (IOError, ValueError):
+      pass
+    self.connection.close()
+    deadline = time.time() + 1
+    while self.is_alive() and time.time() < deadline:
+      time.sleep(0.05)
+    if self.is_alive():
+      try:
+        os.killpg(self.pid, signal.SIGKILL)
+      except OSError:
+        pass
+
+
+class ProcessPoolExecutor(object):
+  """ Runs tools commands in a pool of pre-forked worker processes, so that
+  runs execute in parallel on all cores and a crash in the tools cannot
+  take down the web server. Each command is handed to an idle worker; the
+  calling thread only relays the worker's output.
+  """
+
+  def __init__(self, size):
+    """ Constructor. Starts a fork server and forks the worker processes
+    from it.
+
+    Args:
+      size: An int, the number of worker processes.
+    """
+    # Workers, and the replacements of workers which died, are forked from
+    # the fork server rather than from this process. Its other threads could
+    # hold a lock (such as that of logging) at the time of a fork, which
+    # would then never be released in the worker.
+    self.fork_server = ForkServer()
+    self.idle = Queue.Queue()
+    for _ in range(max(int(size), 1)):
+      self.idle.put(ToolsWorker(self.fork_server))
+
+  def execute(self, command, args, std_out, std_err, job=None):
+    """ Runs a tools command in the next idle worker process, waiting for
+    one if they are all busy.
+
+    Args:
+      command: A str, one of the keys of COMMANDS.
+      args: A list of strs, the command line arguments of the command.
+      std_out: A file-like object receiving the command's stdout.
+      std_err: A file-like object receiving the command's stderr.
+      job: A ToolsJob the command belongs to, or None.
+    Raises:
+      Whatever the tools raised in the worker, as ToolsWorker.execute.
+    """
+    worker = self.idle.get()
+    try:
+      worker.execute(command, args, std_out, std_err, job)
+    finally:
+      if worker.broken or not worker.is_alive():
+        logging.warning("Replacing tools worker process {0}.".format(
+          worker.pid))
+        worker.stop()
+        worker = ToolsWorker(self.fork_server)
+      self.idle.put(worker)
+
+
+  def stop(self):
+    """ Stops all idle worker processes and the fork server. """
+    while True:
+      try:
+        self.idle.get_nowait().stop()
+      except Queue.Empty:
+        break
+    self.fork_server.stop()
+
+
+def initialize_tools():
+  """ Imports the AppScale tools and the libraries they load on first use,
+  so that processes forked afterwards start with them ready.
+  """
+  try:
+    load_tools()
+  except ImportError as error:
+    logging.warning("Unable to preload the AppScale tools: {0}".format(error))
+  for module in TOOLS_DEPENDENCIES:
+    try:
+      __import__(module)
+    except ImportError:
+      logging.warning("Unable to preload {0}.".format(module))
+
+def fork_server_main(address, authkey, ready_connection):
+  """ The main loop of the fork server. Initializes the tools once, then
+  forks a new process for each command received on its socket. The forked
+  process runs the command with the connection it was received on, or, if
+  the command is None, serves commands on it as a pool worker.
+
+  Args:
+    address: A str, the path of the Unix socket to listen on.
+    authkey: A str, the key clients must authenticate with.
+    ready_connection: A multiprocessing Connection on which the time taken
+      to initialize the tools is sent once the server is ready.
+  """
+  started = time.time()
+  initialize_tools()
+  listener = multiprocessing.connection.Listener(address, family='AF_UNIX',
+    authkey=authkey)
+  # Forked processes are reaped automatically.
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+  ready_connection.send(time.time() - started)
+  ready_connection.close()
+
+  while True:
+    try:
+      connection = listener.accept()
+      message = connection.recv()
+    except (EOFError, IOError, multiprocessing.AuthenticationError) as error:
+      logging.warning("Bad fork server request: {0}".format(error))
+      continue
+    if message is None:
+      connection.close()
+      listener.close()
+      return
+
+    if os.fork() == 0:
+      # The tools wait for their own subprocesses, so they need the default
+      # SIGCHLD handling back.
+      signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+      try:
+        os.setpgrp()
+        command, args = message
+        connection.send(('started', os.getpid(), None))
+        if command is None:
+          serve_commands(connection)
+        else:
+          run_in_worker(connection, command, args)
+        connection.close()
+      finally:
+        os._exit(0)
+    connection.close()
+
+
+class ForkServer(object):
+  """ A process which has imported and initialized the tools, and forks a
+  new process with them ready for each request. It is forked once, and
+  every later process comes from it instead of from the web server process,
+  whose other threads may hold locks at the time of a fork.
+  """
+
+  def __init__(self):
+    """ Constructor. Starts the fork server and waits for it to be ready. """
+    self.directory = tempfile.mkdtemp(prefix="appscake-")
+    self.address = os.path.join(self.directory, "tools.sock")
+    self.authkey = os.urandom(16)
+    ready_connection, child_connection = multiprocessing.Pipe(False)
+    self.process = multiprocessing.Process(target=fork_server_main,
+      args=(self.address, self.authkey, child_connection))
+    self.process.daemon = True
+    self.process.start()
+    child_connection.close()
+    self.import_seconds = ready_connection.recv()
+    ready_connection.close()
+    logging.info("Fork server {0} initialized the tools in {1:.3f}s.".format(
+      self.process.pid, self.import_seconds))
+
+  def fork(self, command, args=None):
+    """ Has the fork server fork a process for a command.
+
+    Args:
+      command: A str, one of the keys of COMMANDS, or None for a pool worker
+        process which runs the commands sent to it.
+      args: A list of strs, the command line arguments of the command.
+    Returns:
+      A tuple of the multiprocessing Connection to the new process, which
+      leads its own process group, and its process ID.
+    Raises:
+      EOFError, IOError: If the process could not be forked.
+    """
+    connection = multiprocessing.connection.Client(self.address,
+      family='AF_UNIX', authkey=self.authkey)
+    try:
+      connection.send((command, args))
+      _, pid, _ = connection.recv()
+    except (EOFError, IOError):
+      connection.close()
+      raise
+    return connection, pid
+
+  def stop(self):
+    """ Stops the fork server. Processes it forked are not affected. """
+    try:
+      connection = multiprocessing.connection.Client(self.address,
+        family='AF_UNIX', authkey=self.authkey)
+      connection.send(None)
+      connection.close()
+    except (EOFError, IOError):
+      pass
+    self.process.join(1)
+    if self.process.is_alive():
+      self.process.terminate()
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ForkServerExecutor(object):
+  """ Runs each tools command in a fresh process forked from a fork server
+  which has already imported and initialized the tools. Every command gets
+  a clean process, like running the tools from the command line, without
+  paying their start up cost. The time each forked process takes to become
+  ready is recorded so it can be compared with the import time it saves.
+  """
+
+  # The number of start up times kept for get_metrics.
+  MAX_STARTUP_SAMPLES = 100
+
+  def __init__(self):
+    """ Constructor. Starts the fork server and waits for it to be ready. """
+    self.fork_server = ForkServer()
+    self.import_seconds = self.fork_server.import_seconds
+    self.lock = threading.Lock()
+    self.startup_seconds = collections.deque(maxlen=self.MAX_STARTUP_SAMPLES)
+    self.jobs = 0
+
+  def execute(self, command, args, std_out, std_err, job=None):
+    """ Runs a tools command in a newly forked process and waits for it.
+
+    Args:
+      command: A str, one of the keys of COMMANDS.
+      args: A list of strs, the command line arguments of the command.
+      std_out: A file-like object receiving the command's stdout.
+      std_err: A file-like object receiving the command's stderr.
+      job: A ToolsJob the command belongs to, or None.
+    Raises:
+      Whatever the tools raised in the forked process, as relay_output, or
+      Exception if the process died.
+    """
+    requested = time.time()
+    connection = None
+    try:
+      connection, pid = self.fork_server.fork(command, args)
+      self.record_startup(command, pid, time.time() - requested)
+      if job:
+        job.attach(pid)
+      relay_output(connection, std_out, std_err)
+    except (EOFError, IOError) as error:
+      raise Exception("The AppScale tools process for {0} exited " \
+        "unexpectedly: {1}".format(command, error))
+    finally:
+      if job:
+        job.detach()
+      if connection is not None:
+        connection.close()
+
+  def record_startup(self, command, pid, seconds):
+    """ Records how long a forked process took to be ready.
+
+    Args:
+      command: A str, the command the process runs.
+      pid: An int, the process ID.
+      seconds: A float, the time from request to ready.
+    """
+    with self.lock:
+      self.jobs += 1
+      self.startup_seconds.append(seconds)
+    logging.info("Forked process {0} for {1} was ready in {2:.3f}s " \
+      "(initializing the tools took {3:.3f}s).".format(pid, command, seconds,
+      self.import_seconds))
+
+  def get_metrics(self):
+    """ Summarizes start up times of the forked processes.
+
+    Returns:
+      A dict with the time the fork server took to initialize the tools,
+      the number of commands run, and the average and maximum time the
+      recent forked processes took to be ready, all in seconds.
+    """
+    with self.lock:
+      samples = list(self.startup_seconds)
+      jobs = self.jobs
+    metrics = {'import_seconds': self.import_seconds, 'jobs': jobs,
+      'average_startup_seconds': None, 'max_startup_seconds': None}
+    if samples:
+      metrics['average_startup_seconds'] = sum(samples) / len(samples)
+      metrics['max_startup_seconds'] = max(samples)
+    return metrics
+
+  def stop(self):
+    """ Stops the fork server. Commands already running are not affected. """
+    self.fork_server.stop()
+
+
+# Runs commands in the calling thread; the default executor.
+IN_PROCESS_EXECUTOR = InProcessExecutor()
@@ -7,10 +7,18 @@ urlpatterns = patterns('src.views',
     (r'^about/$', 'about',),
     (r'^common/.*', 'common',),
     url(r'start/$', 'start'),
+    url(r'bulkterminate/$', 'bulk_terminate'),
     url(r'terminate/$', 'terminate'),
+    url(r'cancel/$', 'cancel'),
     url(r'test/$', 'test'),
     url(r'getdeploymentstatus/$', 'get_deployment_status'),
-    url(r'getterminationstatus/$', 'get_termination_status')
+    url(r'getterminationstatus/$', 'get_termination_status'),
+    url(r'getstatuses/$', 'get_statuses'),
+    url(r'getbulkterminationstatus/$', 'get_bulk_termination_status'),
+    url(r'gettoolslog/$', 'get_tools_log'),
+    url(r'gettoolsreport/$', 'get_tools_report'),
+    url(r'streamdeploymentstatus/$', 'stream_deployment_status'),
+    url(r'streamterminationstatus/$', 'stream_termination_status')
     )
 
 
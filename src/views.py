@@ -3,16 +3,30 @@
 import logging
 import os
 import sys
+import threading
+import time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
 import helpers
 import appscale_tools_thread
+import progress
+import reaper
+import registry
+import scheduler
+import tools_output
+import tools_worker
+import watchdog
 from forms import CommonFields
  
+from django.conf import settings
 from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
+from django.http import HttpResponseNotModified
 from django.http import HttpResponseServerError
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
 from django.utils import simplejson
+from django.views.decorators.csrf import ensure_csrf_cookie
 
 # When deploying on virtual machines without IaaS support.
 CLUSTER_DEPLOY = "cluster"
@@ -20,16 +34,88 @@ CLUSTER_DEPLOY = "cluster"
 # When deploying on IaaS such as EC2 or Eucalyptus.
 CLOUD_DEPLOY = "cloud"
 
-# A global variable to store all threads deploying AppScale.
+# A global variable to store the threads deploying AppScale that were started
+# by this process. Their state is read from the deployment registry.
 DEPLOYMENT_THREADS = {}
 
-# A global variable to store all threads terminating AppScale.
+# A global variable to store the threads terminating AppScale that were
+# started by this process.
 TERMINATING_THREADS = {}
 
+# The EC2 credentials of the cloud deployments started by this process,
+# keyed by keyname. They are never written to the deployment registry, so
+# only this process can terminate these deployments. They are dropped once
+# a deployment is terminated.
+DEPLOYMENT_CREDENTIALS = {}
+
+# The state of every deployment and termination, shared by all processes
+# serving AppsCake.
+REGISTRY = registry.DeploymentRegistry(
+  settings.DATABASES['default']['NAME'])
+
+# Starts deployments and terminations, running a limited number at once.
+SCHEDULER = scheduler.DeploymentScheduler(
+  settings.APPSCAKE_MAX_CONCURRENT_RUNS)
+
+# Times out runs whose tools have stalled, freeing their slots, and picks
+# up cancel and termination requests from other processes. Created by
+# get_executor along with the first run of this process.
+WATCHDOG = None
+
+# Archives finished runs and drops them from the thread maps above. Created
+# by get_executor along with the first run of this process.
+REAPER = None
+
+# Runs the AppScale tools, either in the deployment threads themselves, in a
+# pool of worker processes, or in processes forked from a fork server.
+# Created by get_executor, so that importing this module forks nothing.
+EXECUTOR = None
+
+# Guards the creation of EXECUTOR, WATCHDOG and REAPER.
+EXECUTOR_LOCK = threading.Lock()
+
+# Held by each status stream, tools log stream and long poll this process
+# has open, so that they cannot take up every request thread.
+STREAM_SLOTS = threading.BoundedSemaphore(settings.APPSCAKE_MAX_OPEN_STREAMS)
+
+# Held while checking for an unfinished termination of a deployment and
+# setting up a new one, so that concurrent requests start one termination.
+TERMINATION_LOCK = threading.Lock()
+
+# Phase timings of past runs, used to estimate the progress of new ones.
+TRANSCRIPT_STORE = progress.TranscriptStore(settings.APPSCAKE_TRANSCRIPT_DIR)
+
 # Placement stategies for cloud deployments.
 SIMPLE_DEPLOYMENT = "simple"
 ADVANCE_DEPLOYMENT = "advanced"
 
+# How often, in seconds, a comment is sent on an idle status event stream
+# so that proxies do not close it.
+STATUS_STREAM_HEARTBEAT = 15
+
+# How long, in seconds, a client turned away because too many streams are
+# open should wait before trying again.
+STREAM_RETRY_AFTER = 5
+
+# The most bytes of tools output sent in one response or event.
+TOOLS_LOG_CHUNK_SIZE = 64 * 1024
+
+# Output streams of the tools that can be read from the tools log.
+TOOLS_LOG_STREAMS = ("stdout", "stderr")
+
+# The reason a cloud deployment cannot be terminated by AppsCake once the
+# process holding its credentials is gone.
+CREDENTIALS_GONE_MESSAGE = "AppsCake was restarted since this deployment " \
+  "started, so it no longer has its credentials. Terminate it with " \
+  "appscale-terminate-instances instead."
+
+# The reason a deployment cannot be cancelled while the tools run inside the
+# deployment thread, as they do with the 'thread' backend.
+NOT_CANCELLABLE_MESSAGE = "The AppScale tools of this deployment run " \
+  "inside AppsCake and cannot be interrupted. Wait for the deployment to " \
+  "finish and terminate it, or set APPSCAKE_TOOLS_BACKEND to 'process' or " \
+  "'forkserver' so that deployments can be cancelled."
+
 # The location of template files.
 TERMINATE_HTML_FILE_PATH = "base/terminate.html"
 HOMEPAGE_HTML_FILE_PATH = "base/home.html"
@@ -52,23 +138,330 @@ def terminate(request):
       "instances to terminate.")
 
   keyname = get['keyname']
-  if keyname not in DEPLOYMENT_THREADS:
+  deployment = REGISTRY.get(registry.DEPLOYMENT, keyname)
+  if deployment is None:
     return HttpResponseServerError("Unknown keyname of the " \
       "instances to terminate.")
 
-  appscale_up_thread = DEPLOYMENT_THREADS[keyname]
+  if not start_termination(deployment):
+    return HttpResponseServerError(CREDENTIALS_GONE_MESSAGE)
+  return render(request, TERMINATE_HTML_FILE_PATH, {'keyname': keyname})
+
+def cancel(request):
+  """ A request to stop a deployment that is queued or still coming up, and
+  to terminate whatever it has started once it has stopped. Cancelling a
+  deployment again does nothing more. A deployment whose tools cannot be
+  interrupted is left running.
+
+  Args:
+    request: A Django web request.
+  Returns:
+    A rendered version of terminate.html with the keyname passed into the 
+    javascript, or HttpResponseServerError if the deployment cannot be
+    cancelled.
+  """
+  get = request.GET.copy()
+  if 'keyname' not in get:
+    return HttpResponseServerError("Did not receive the keyname of the " \
+      "deployment to cancel.")
+
+  keyname = get['keyname']
+  deployment = REGISTRY.get(registry.DEPLOYMENT, keyname)
+  if deployment is None:
+    return HttpResponseServerError("Unknown keyname of the " \
+      "deployment to cancel.")
+
+  # Deployments started by another process are cancelled by that process's
+  # watchdog.
+  deployment_thread = DEPLOYMENT_THREADS.get(keyname)
+  if deployment_thread is None:
+    if not is_cancellable(deployment):
+      return HttpResponseServerError(NOT_CANCELLABLE_MESSAGE)
+    REGISTRY.request_cancel(registry.DEPLOYMENT, keyname)
+  else:
+    try:
+      deployment_thread.cancel(watchdog.CANCEL_MESSAGE)
+    except tools_worker.CommandNotCancellable:
+      return HttpResponseServerError(NOT_CANCELLABLE_MESSAGE)
+    SCHEDULER.remove(deployment_thread)
+
+  if not start_termination(deployment):
+    return HttpResponseServerError(CREDENTIALS_GONE_MESSAGE)
+  return render(request, TERMINATE_HTML_FILE_PATH, {'keyname': keyname})
+
+def is_cancellable(deployment):
+  """ Checks if a deployment started by another process can be stopped
+  right away. Tools running in a worker process are killed, but with the
+  'thread' backend they run inside the deployment thread and cannot be
+  interrupted once the deployment has started.
+
+  Args:
+    deployment: A sqlite3.Row, the deployment's registry entry.
+  Returns:
+    True if the deployment can be cancelled, False otherwise.
+  """
+  if settings.APPSCAKE_TOOLS_BACKEND in ('process', 'forkserver'):
+    return True
+  return deployment['state'] not in (appscale_tools_thread.AppScaleUp.
+    INIT_STATE, appscale_tools_thread.AppScaleUp.RUNNING_STATE)
+
+def bulk_terminate(request):
+  """ Terminates many deployments at once. The deployments are picked by
+  repeated keyname parameters or by repeated state parameters, and at most
+  APPSCAKE_BULK_TERMINATE_PARALLELISM of them terminate at the same time.
+  Their progress is reported together by get_bulk_termination_status.
+
+  AppsCake has no logins, so the CSRF check is what keeps other sites from
+  terminating deployments through a visitor's browser. Clients send the
+  csrftoken cookie set by get_statuses (or by any page) back in both the
+  cookie and the X-CSRFToken header.
+
+  Args:
+    request: A Django web request.
+  Returns:
+    A HttpResponse object with a json message holding the ID of the batch,
+    the keynames of the deployments being terminated, and the keynames of
+    the cloud deployments whose credentials are gone.
+  """
+  if request.method != 'POST':
+    return HttpResponseServerError("404 Page not found")
+  keynames = request.POST.getlist('keyname')
+  states = request.POST.getlist('state')
+  if not keynames and not states:
+    message = {'status': 'error', 'error_message': 
+      "Bad JSON request (missing keyname or state)."}
+    return HttpResponse(simplejson.dumps(message))  
+
+  try:
+    statuses, next_cursor = REGISTRY.list_statuses(kind=registry.DEPLOYMENT,
+      keynames=keynames or None, states=states or None)
+  except ValueError as error:
+    message = {'status': 'error', 'error_message': str(error)}
+    return HttpResponseBadRequest(simplejson.dumps(message))
+  if next_cursor is not None:
+    message = {'status': 'error', 'error_message': 
+      "At most {0} deployments can be terminated at once.".format(
+      registry.MAX_PAGE_SIZE)}
+    return HttpResponseBadRequest(simplejson.dumps(message))
+
+  runs = []
+  keynames = []
+  unavailable = []
+  for _, keyname, _ in statuses:
+    terminating, terminate_thread = prepare_termination(
+      REGISTRY.get(registry.DEPLOYMENT, keyname))
+    if not terminating:
+      unavailable.append(keyname)
+      continue
+    keynames.append(keyname)
+    if terminate_thread is None:
+      continue
+    # Deployments still being deployed by this process are terminated on
+    # their own once their thread exits, outside the batch's slots.
+    deployment_thread = DEPLOYMENT_THREADS.get(keyname)
+    if deployment_thread is None or deployment_thread.exited:
+      runs.append(terminate_thread)
+    else:
+      submit_termination(terminate_thread)
+  batch_id = helpers.generate_batch_id()
+  REGISTRY.add_batch(batch_id, registry.TERMINATION, keynames)
+  scheduler.RunBatch(SCHEDULER, runs, scheduler.TERMINATION_PRIORITY,
+    settings.APPSCAKE_BULK_TERMINATE_PARALLELISM).start()
+  return HttpResponse(simplejson.dumps({'batch': batch_id,
+    'keynames': keynames, 'unavailable': unavailable}))
+
+def get_bulk_termination_status(request):
+  """ Returns the combined status of a batch of terminations.
+
+  Args:
+    request: A Django web request.
+  Returns:
+    A HttpResponse object with a json message of the number of
+    terminations in each state, their average percentage towards
+    completion, whether they have all finished, and each one's status.
+  """
+  get = request.GET.copy()
+  if 'batch' not in get:
+    message = {'status': 'error', 'error_message': 
+      "Bad JSON request (missing batch)."}
+    return HttpResponse(simplejson.dumps(message))  
+
+  status = REGISTRY.get_batch_status(get['batch'])
+  if status is None:
+    status = {'status': 'error', 'error_message': 
+      "Unknown batch given {0}.".format(get['batch'])}
+  return HttpResponse(simplejson.dumps(status))
+
+def start_termination(deployment):
+  """ Starts terminating a deployment, ahead of any queued deployments. See
+  prepare_termination.
+
+  Args:
+    deployment: A sqlite3.Row, the deployment's registry entry.
+  Returns:
+    True if the deployment is being terminated, False if no process holds
+    its credentials anymore.
+  """
+  terminating, terminate_thread = prepare_termination(deployment)
+  if terminate_thread is not None:
+    submit_termination(terminate_thread)
+  return terminating
+
+def prepare_termination(deployment):
+  """ Sets up the termination of a deployment, unless one is already
+  unfinished, so that repeated requests start a single termination. A
+  deployment started by another process which is still running is
+  terminated by that process instead, since only it holds the deployment's
+  thread and credentials; it is asked to through the registry.
+
+  Args:
+    deployment: A sqlite3.Row, the deployment's registry entry.
+  Returns:
+    A tuple of whether the deployment is being terminated (False if no
+    process holds its credentials anymore) and the AppScaleDown thread to
+    submit, or None if there is nothing for this process to submit.
+  """
+  owner_pid = deployment['owner_pid']
+  if owner_pid != os.getpid() and registry.is_process_alive(owner_pid):
+    REGISTRY.request_run(registry.TERMINATION, deployment['keyname'],
+      deployment['deployment_type'], deployment['ec2_url'], owner_pid)
+    return True, None
+
+  with TERMINATION_LOCK:
+    status = REGISTRY.get_status(registry.TERMINATION, deployment['keyname'])
+    if status is not None and \
+      status['status'] not in registry.FINISHED_STATES:
+      return True, None
+    terminate_thread = create_termination(deployment)
+  return terminate_thread is not None, terminate_thread
+
+def start_requested_termination(keyname):
+  """ Starts a termination another process asked this one for. Called by the
+  watchdog.
+
+  Args:
+    keyname: A str, the keyname of the deployment to terminate.
+  """
+  deployment = REGISTRY.get(registry.DEPLOYMENT, keyname)
+  terminate_thread = None
+  if deployment is not None:
+    with TERMINATION_LOCK:
+      terminate_thread = create_termination(deployment)
+  if terminate_thread is None:
+    REGISTRY.update(registry.TERMINATION, keyname, registry.DeploymentStatus(
+      {'status': 'error', 'percent': 0,
+       'error_message': CREDENTIALS_GONE_MESSAGE}))
+    return
+  submit_termination(terminate_thread)
+
+def submit_termination(terminate_thread):
+  """ Submits a termination to the scheduler once the thread deploying the
+  same deployment in this process, if any, has exited, so that the tools
+  never deploy and terminate a deployment at the same time.
+
+  Args:
+    terminate_thread: An AppScaleDown thread, not yet started.
+  """
+  deployment_thread = DEPLOYMENT_THREADS.get(terminate_thread.keyname)
+  if deployment_thread is None:
+    SCHEDULER.submit(terminate_thread, scheduler.TERMINATION_PRIORITY)
+    return
+  deployment_thread.add_exit_callback(lambda _: SCHEDULER.submit(
+    terminate_thread, scheduler.TERMINATION_PRIORITY))
+
+def create_termination(deployment):
+  """ Sets up the termination of a deployment without starting it.
+
+  Args:
+    deployment: A sqlite3.Row, the deployment's registry entry.
+  Returns:
+    An AppScaleDown thread, or None if the deployment is a cloud deployment
+    whose credentials this process does not hold.
+  """
+  keyname = deployment['keyname']
+  credentials = {}
+  if deployment['deployment_type'] == CLOUD_DEPLOY:
+    credentials = DEPLOYMENT_CREDENTIALS.get(keyname)
+    if credentials is None:
+      return None
 
   terminate_thread = appscale_tools_thread.AppScaleDown(
-    appscale_up_thread.deployment_type, keyname,
-    ec2_access=appscale_up_thread.ec2_access, 
-    ec2_secret=appscale_up_thread.ec2_secret,
-    ec2_url=appscale_up_thread.ec2_url)
+    deployment['deployment_type'], keyname,
+    ec2_access=credentials.get('ec2_access'),
+    ec2_secret=credentials.get('ec2_secret'),
+    ec2_url=deployment['ec2_url'],
+    transcript_store=TRANSCRIPT_STORE,
+    deployment_registry=REGISTRY,
+    log_directory=settings.APPSCAKE_LOG_DIR,
+    executor=get_executor())
+  terminate_thread.finish_callbacks.append(release_credentials)
 
   TERMINATING_THREADS[keyname] = terminate_thread
+  return terminate_thread
 
-  terminate_thread.start()
+def release_credentials(terminate_thread):
+  """ Drops the credentials of a deployment once it is terminated. Called
+  when an AppScaleDown thread finishes.
 
-  return render(request, TERMINATE_HTML_FILE_PATH, {'keyname': keyname})
+  Args:
+    terminate_thread: The AppScaleDown thread which finished.
+  """
+  if terminate_thread.state == terminate_thread.TERMINATED_STATE:
+    DEPLOYMENT_CREDENTIALS.pop(terminate_thread.keyname, None)
+
+def get_executor():
+  """ Returns the executor running the AppScale tools, creating it on first
+  use. The threads watching over this process's runs are started along
+  with it, since there is nothing for them to watch before the first run.
+  Under gunicorn, the executor is created before the worker starts serving
+  requests (see config/gunicorn.py).
+
+  Returns:
+    A tools_worker executor, as chosen by APPSCAKE_TOOLS_BACKEND.
+  """
+  global EXECUTOR, WATCHDOG, REAPER
+  with EXECUTOR_LOCK:
+    if EXECUTOR is None:
+      # The fork server of the process backends is forked before this
+      # module starts any thread of its own. Worker processes, including
+      # the replacements of workers which died, are then forked from it
+      # rather than from this multithreaded process.
+      if settings.APPSCAKE_TOOLS_BACKEND == 'process':
+        executor = tools_worker.ProcessPoolExecutor(
+          settings.APPSCAKE_MAX_CONCURRENT_RUNS)
+      elif settings.APPSCAKE_TOOLS_BACKEND == 'forkserver':
+        executor = tools_worker.ForkServerExecutor()
+      else:
+        executor = tools_worker.IN_PROCESS_EXECUTOR
+      WATCHDOG = watchdog.RunWatchdog(SCHEDULER,
+        settings.APPSCAKE_IDLE_OUTPUT_TIMEOUT,
+        settings.APPSCAKE_PHASE_TIMEOUT_FACTOR, deployment_registry=REGISTRY,
+        deployments=DEPLOYMENT_THREADS,
+        start_termination=start_requested_termination)
+      WATCHDOG.start()
+      REAPER = reaper.RunReaper([DEPLOYMENT_THREADS, TERMINATING_THREADS],
+        REGISTRY, settings.APPSCAKE_RUN_TTL)
+      REAPER.start()
+      EXECUTOR = executor
+    return EXECUTOR
+
+def get_tools_report(request):
+  """ Reports how the AppScale tools are run by the process serving the
+  request: how long it took to import them, if it has, and the start up
+  metrics of its fork server, if it has one.
+
+  Args:
+    request: A Django web request.
+  Returns:
+    A HttpResponse object with a json message of the report.
+  """
+  metrics = None
+  if EXECUTOR is not None and hasattr(EXECUTOR, 'get_metrics'):
+    metrics = EXECUTOR.get_metrics()
+  return HttpResponse(simplejson.dumps({'pid': os.getpid(),
+    'backend': settings.APPSCAKE_TOOLS_BACKEND,
+    'import_report': tools_worker.get_import_report(),
+    'executor_metrics': metrics}))
 
 def home(request):
   """ Render the home page which takes in input from the user to start 
@@ -79,7 +472,11 @@ def home(request):
   Returns:
     A rendered version of home.html with form fields.
   """
-  return render(request, HOMEPAGE_HTML_FILE_PATH, {'form': CommonFields()})
+  # Each form has a token of its own, so submitting one never coalesces
+  # onto a deployment started by the other.
+  return render(request, HOMEPAGE_HTML_FILE_PATH, {'form': CommonFields(),
+    'cluster_token': helpers.generate_submission_token(),
+    'cloud_token': helpers.generate_submission_token()})
 
 def about(request):
   """ Render the about page that tells users about AppsCake. 
@@ -97,50 +494,402 @@ def get_deployment_status(request):
   Args:
     request: A Django web request.
   Returns:
-    A HttpResponse object with a json message of the current deployment status.
+    A HttpResponse object with a json message of the current deployment
+    status, or a HttpResponseNotModified if the client already has it.
+  """
+  return get_status(request, registry.DEPLOYMENT)
+
+def get_termination_status(request):
+  """ Returns a json string of the status of the tools being run.
+
+  Args:
+    request: A Django web request.
+  Returns:
+    A HttpResponse object with a json message of the current termination
+    status, or a HttpResponseNotModified if the client already has it.
+  """
+  return get_status(request, registry.TERMINATION)
+
+def get_status(request, kind):
+  """ Returns the status of a run as stored in the registry, with an ETag
+  header. A request whose If-None-Match header has the current ETag gets an
+  empty 304 response instead.
+
+  Args:
+    request: A Django web request.
+    kind: A str, registry.DEPLOYMENT or registry.TERMINATION.
+  Returns:
+    A HttpResponse object with a json message of the run's status, or a
+    HttpResponseNotModified.
   """
   get = request.GET.copy()
-  identifier = None
-  if 'keyname' in get:
-    identifier = get['keyname']
-  else:
+  if 'keyname' not in get:
     message = {'status': 'error', 'error_message': 
       "Bad JSON request (missing keyname)."}
     return HttpResponse(simplejson.dumps(message))  
+  identifier = get['keyname']
 
-  logging.debug("Running keyname {0}".format(DEPLOYMENT_THREADS.keys()))
-
-  if identifier not in DEPLOYMENT_THREADS:
+  result = REGISTRY.get_payload(kind, identifier)
+  if result is None:
     message = {'status': 'error', 'error_message': 
       "Unknown keyname given {0}.".format(identifier)}
+    return HttpResponse(simplejson.dumps(message))  
+
+  etag = '"{0}"'.format(result[0])
+  if etag in get_if_none_match(request):
+    response = HttpResponseNotModified()
   else:
-    message = DEPLOYMENT_THREADS[identifier].get_status()
+    response = HttpResponse(result[1])
+  response['ETag'] = etag
+  # Browsers must check with us before reusing a status.
+  response['Cache-Control'] = 'no-cache'
+  return response
 
-  return HttpResponse(simplejson.dumps(message))  
+def get_if_none_match(request):
+  """ Parses the If-None-Match header of a request. Weak tags (as set by
+  nginx when it compresses a response) are treated like strong ones.
 
-def get_termination_status(request):
-  """ Returns a json string of the status of the tools being run.
+  Args:
+    request: A Django web request.
+  Returns:
+    A list of strs, the quoted entity tags in the header.
+  """
+  header = request.META.get('HTTP_IF_NONE_MATCH', '')
+  tags = []
+  for tag in header.split(','):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+      tag = tag[2:]
+    tags.append(tag)
+  return tags
+
+@ensure_csrf_cookie
+def get_statuses(request):
+  """ Returns the statuses of many deployments and terminations at once.
+  The runs can be picked by any of the kind, keyname and state parameters,
+  the last two of which may be repeated. Large results are split into
+  pages; the next_cursor of a page is passed as the cursor parameter to
+  get the next one. The response sets the CSRF cookie that
+  bulk_terminate expects, for clients picking deployments to terminate.
 
+  Args:
+    request: A Django web request.
   Returns:
-    A HttpResponse object with a json message of the current termination status.
+    A HttpResponse object with a json message of the statuses and the
+    cursor of the next page.
   """
   get = request.GET.copy()
-  identifier = None
-  if 'keyname' in get:
-    identifier = get['keyname']
-  else:
+  kind = get.get('kind') or None
+  if kind not in (None, registry.DEPLOYMENT, registry.TERMINATION):
+    message = {'status': 'error', 'error_message': 
+      "Unknown kind given {0}.".format(kind)}
+    return HttpResponse(simplejson.dumps(message))  
+
+  limit = parse_version(get.get('limit')) or registry.MAX_PAGE_SIZE
+  try:
+    statuses, next_cursor = REGISTRY.list_statuses(kind=kind,
+      keynames=get.getlist('keyname') or None,
+      states=get.getlist('state') or None,
+      cursor=parse_version(get.get('cursor')), limit=limit)
+  except ValueError as error:
+    # Pages are of runs, not of the keynames asked for, so a client with
+    # more keynames than fit in one query has to split them up itself.
+    message = {'status': 'error', 'error_message': str(error)}
+    return HttpResponseBadRequest(simplejson.dumps(message))
+
+  # The statuses are already JSON, so they are placed into the response as
+  # they are instead of being parsed and serialized again.
+  entries = ['{{"kind": {0}, "keyname": {1}, "status": {2}}}'.format(
+    simplejson.dumps(run_kind), simplejson.dumps(keyname), payload)
+    for run_kind, keyname, payload in statuses]
+  return HttpResponse('{{"statuses": [{0}], "next_cursor": {1}}}'.format(
+    ", ".join(entries), simplejson.dumps(next_cursor)))
+
+def stream_deployment_status(request):
+  """ Streams the status of the tools deploying AppScale, sending an update
+  only when the status changes. See stream_status.
+
+  Args:
+    request: A Django web request.
+  Returns:
+    A HttpResponse with the status, or a StreamingHttpResponse of
+    server-sent events.
+  """
+  return stream_status(request, registry.DEPLOYMENT)
+
+def stream_termination_status(request):
+  """ Streams the status of the tools terminating AppScale, sending an
+  update only when the status changes. See stream_status.
+
+  Args:
+    request: A Django web request.
+  Returns:
+    A HttpResponse with the status, or a StreamingHttpResponse of
+    server-sent events.
+  """
+  return stream_status(request, registry.TERMINATION)
+
+def stream_status(request, kind):
+  """ Sends status changes of a run without the client having to poll.
+  Clients that accept text/event-stream get a stream of server-sent events.
+  Other clients long-poll: they pass the version of the last status they
+  saw and the response is held until there is a newer one (or a timeout
+  passes). Every status carries its version.
+
+  Args:
+    request: A Django web request.
+    kind: A str, registry.DEPLOYMENT or registry.TERMINATION.
+  Returns:
+    A HttpResponse with the status, a StreamingHttpResponse of server-sent
+    events, or a 503 HttpResponse if this process already holds
+    APPSCAKE_MAX_OPEN_STREAMS streams open.
+  """
+  get = request.GET.copy()
+  if 'keyname' not in get:
     message = {'status': 'error', 'error_message': 
       "Bad JSON request (missing keyname)."}
     return HttpResponse(simplejson.dumps(message))  
+  keyname = get['keyname']
 
-  if identifier not in TERMINATING_THREADS:
+  if not STREAM_SLOTS.acquire(False):
+    return streams_full_response()
+
+  if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+    version = parse_version(request.META.get('HTTP_LAST_EVENT_ID'))
+    response = StreamingHttpResponse(HeldStream(status_events(kind, keyname,
+      version)), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stops nginx from buffering the events.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+  try:
+    result = REGISTRY.wait_for_change(kind, keyname,
+      parse_version(get.get('version')), settings.APPSCAKE_LONG_POLL_TIMEOUT)
+  finally:
+    STREAM_SLOTS.release()
+  if result is None:
     message = {'status': 'error', 'error_message': 
-      "Unknown keyname given {0}.".format(identifier)}
+      "Unknown keyname given {0}.".format(keyname)}
   else:
-    message = TERMINATING_THREADS[identifier].get_status()
+    version, message = result
+    message['version'] = version
+  return HttpResponse(simplejson.dumps(message))
 
-  return HttpResponse(simplejson.dumps(message))  
+def status_events(kind, keyname, version):
+  """ Generates server-sent events for each status change of a run, with a
+  comment line every so often to keep the connection open. The stream ends
+  when the run finishes or the stream timeout passes; browsers then
+  reconnect with the Last-Event-ID header to resume from the last version.
 
+  Args:
+    kind: A str, registry.DEPLOYMENT or registry.TERMINATION.
+    keyname: A str, the keyname of the run.
+    version: An int, the version the client already has, or None.
+  Yields:
+    strs, the events in text/event-stream format.
+  """
+  deadline = time.time() + settings.APPSCAKE_STATUS_STREAM_TIMEOUT
+  while time.time() < deadline:
+    timeout = min(STATUS_STREAM_HEARTBEAT, deadline - time.time())
+    result = REGISTRY.wait_for_change(kind, keyname, version, timeout)
+    if result is None:
+      message = {'status': 'error', 'error_message': 
+        "Unknown keyname given {0}.".format(keyname)}
+      yield "event: status\ndata: {0}\n\n".format(simplejson.dumps(message))
+      return
+
+    new_version, message = result
+    finished = message['status'] in registry.FINISHED_STATES
+    if new_version == version and not finished:
+      yield ": keepalive\n\n"
+      continue
+
+    version = new_version
+    message['version'] = version
+    yield "id: {0}\nevent: status\ndata: {1}\n\n".format(version,
+      simplejson.dumps(message))
+    if finished:
+      return
+
+def streams_full_response():
+  """ Turns away a stream or long poll because this process already holds
+  APPSCAKE_MAX_OPEN_STREAMS of them open.
+
+  Returns:
+    A 503 HttpResponse with a json error message, telling the client when
+    to try again.
+  """
+  message = {'status': 'error', 'error_message':
+    "Too many open status streams, try again later."}
+  response = HttpResponse(simplejson.dumps(message), status=503)
+  response['Retry-After'] = str(STREAM_RETRY_AFTER)
+  return response
+
+class HeldStream(object):
+  """ Iterates over the events of a stream which holds one of STREAM_SLOTS,
+  giving the slot back once the server closes the response, whether or not
+  the stream was read to its end.
+  """
+
+  def __init__(self, events):
+    """ Creates a HeldStream for a slot the caller has already acquired.
+
+    Args:
+      events: A generator of the events to stream.
+    """
+    self.events = events
+    self.held = True
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    return next(self.events)
+
+  def close(self):
+    """ Stops the events and releases the slot of the stream. """
+    try:
+      self.events.close()
+    finally:
+      if self.held:
+        self.held = False
+        STREAM_SLOTS.release()
+
+def parse_version(value):
+  """ Parses a status version, or another number, sent by a client.
+
+  Args:
+    value: A str, the version, or None.
+  Returns:
+    An int, or None if no valid version was given.
+  """
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return None
+
+def get_tools_log(request):
+  """ Returns the output of the tools for a run, starting at the byte offset
+  given by the client, so clients only ever download output they have not
+  seen. Without an offset, the end of the output is returned. Clients that
+  accept text/event-stream get a stream of server-sent events with each new
+  piece of output instead.
+
+  Args:
+    request: A Django web request with the keyname, and optionally the kind
+      (deployment or termination), the stream (stdout or stderr) and the
+      offset.
+  Returns:
+    A HttpResponse object with a json message holding the output, the
+    offset it starts at and the offset to ask for next, a
+    StreamingHttpResponse of server-sent events, or a 503 HttpResponse if
+    this process already holds APPSCAKE_MAX_OPEN_STREAMS streams open.
+  """
+  get = request.GET.copy()
+  if 'keyname' not in get:
+    message = {'status': 'error', 'error_message': 
+      "Bad JSON request (missing keyname)."}
+    return HttpResponse(simplejson.dumps(message))  
+  keyname = get['keyname']
+  kind = get.get('kind', registry.DEPLOYMENT)
+  name = get.get('stream', "stdout")
+  if kind not in (registry.DEPLOYMENT, registry.TERMINATION) or \
+    name not in TOOLS_LOG_STREAMS:
+    message = {'status': 'error', 'error_message': 
+      "Unknown kind or stream given."}
+    return HttpResponse(simplejson.dumps(message))  
+  if REGISTRY.get(kind, keyname) is None:
+    message = {'status': 'error', 'error_message': 
+      "Unknown keyname given {0}.".format(keyname)}
+    return HttpResponse(simplejson.dumps(message))  
+
+  path = tools_output.get_log_path(settings.APPSCAKE_LOG_DIR, kind, keyname,
+    name)
+  if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+    if not STREAM_SLOTS.acquire(False):
+      return streams_full_response()
+    offset = parse_version(request.META.get('HTTP_LAST_EVENT_ID'))
+    if offset is None:
+      offset = parse_version(get.get('offset'))
+    response = StreamingHttpResponse(HeldStream(tools_log_events(kind,
+      keyname, path, offset)), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+  finished = is_run_finished(kind, keyname)
+  offset, data = read_tools_log(path, parse_version(get.get('offset')))
+  message = {'offset': offset, 'next_offset': offset + len(data),
+    'data': data.decode('utf-8', 'replace'), 'finished': finished}
+  return HttpResponse(simplejson.dumps(message))
+
+def tools_log_events(kind, keyname, path, offset):
+  """ Generates server-sent events for each new piece of output of a run,
+  until the run finishes or the stream timeout passes. The id of each event
+  is the offset to resume from.
+
+  Args:
+    kind: A str, registry.DEPLOYMENT or registry.TERMINATION.
+    keyname: A str, the keyname of the run.
+    path: A str, the log file holding the output.
+    offset: An int, the byte offset the client already has output up to,
+      or None to start with the end of the output.
+  Yields:
+    strs, the events in text/event-stream format.
+  """
+  deadline = time.time() + settings.APPSCAKE_STATUS_STREAM_TIMEOUT
+  idle_since = time.time()
+  while time.time() < deadline:
+    # Checked before reading, so output written just before the run
+    # finished is still sent.
+    finished = is_run_finished(kind, keyname)
+    start, data = read_tools_log(path, offset)
+    if data:
+      offset = start + len(data)
+      idle_since = time.time()
+      yield "id: {0}\nevent: log\ndata: {1}\n\n".format(offset,
+        simplejson.dumps({'offset': start, 'next_offset': offset,
+        'data': data.decode('utf-8', 'replace')}))
+      continue
+    if offset is None:
+      offset = start
+    if finished:
+      yield "event: end\ndata: {}\n\n"
+      return
+    if time.time() - idle_since >= STATUS_STREAM_HEARTBEAT:
+      idle_since = time.time()
+      yield ": keepalive\n\n"
+    time.sleep(registry.POLL_INTERVAL)
+
+def read_tools_log(path, offset):
+  """ Reads the next piece of a tools log, ending on a whole character.
+
+  Args:
+    path: A str, the log file to read.
+    offset: An int, the byte offset to start at, or None to read the end of
+      the log.
+  Returns:
+    A tuple of the offset the output starts at (an int) and the output (a
+    str of UTF-8 bytes).
+  """
+  if offset is None:
+    offset, data = tools_output.tail_log(path, TOOLS_LOG_CHUNK_SIZE)
+  else:
+    data = tools_output.read_log(path, max(offset, 0), TOOLS_LOG_CHUNK_SIZE)
+  return max(offset, 0), tools_output.trim_partial_character(data)
+
+def is_run_finished(kind, keyname):
+  """ Checks if a run will not write any more output.
+
+  Args:
+    kind: A str, registry.DEPLOYMENT or registry.TERMINATION.
+    keyname: A str, the keyname of the run.
+  Returns:
+    True if the run has finished (or is not known), False otherwise.
+  """
+  status = REGISTRY.get_status(kind, keyname)
+  return status is None or status['status'] in registry.FINISHED_STATES
 
 def start(request):
   """ This is the page a user submits a request to start AppScale. 
@@ -162,66 +911,106 @@ def start(request):
     elif 'cloud' in request.POST:
       cloud_type = CLOUD_DEPLOY
 
-    if cloud_type == CLOUD_DEPLOY:
-      infras = form['infrastructure'].value()
-      deployment_type = form['deployment_type'].value()
-      instance_type = form['instance_type'].value()
-      machine = form['machine'].value()
-      instance_type = form['instance_type'].value()
-      access_key = form['key'].value()
-      secret_key = form['secret'].value()
-      ec2_url = form['ec2_euca_url'].value()
-      if not ec2_url:
-        ec2_url = None
-
-      if deployment_type == ADVANCE_DEPLOYMENT:
+    # Double-clicks and browser retries of a start request coalesce onto the
+    # deployment the first one started, unless that deployment failed.
+    idempotency_key = helpers.get_idempotency_key(request.POST,
+      settings.SECRET_KEY)
+    claimed = REGISTRY.claim_submission(idempotency_key, keyname,
+      settings.APPSCAKE_DUPLICATE_WINDOW)
+    if claimed != keyname:
+      logging.info("Duplicate start request for deployment {0}.".format(
+        claimed))
+      return render(request, APPSCALE_STARTED_HTML_FILE_PATH, {'keyname':
+        claimed})
+
+    # A start request which fails before its deployment is scheduled is
+    # forgotten, so that retrying it starts a deployment.
+    try:
+      if cloud_type == CLOUD_DEPLOY:
+        infras = form['infrastructure'].value()
+        deployment_type = form['deployment_type'].value()
+        instance_type = form['instance_type'].value()
+        machine = form['machine'].value()
+        instance_type = form['instance_type'].value()
+        access_key = form['key'].value()
+        secret_key = form['secret'].value()
+        ec2_url = form['ec2_euca_url'].value()
+        if not ec2_url:
+          ec2_url = None
+
+        if deployment_type == ADVANCE_DEPLOYMENT:
+          ips_yaml = form['ips_yaml'].value()
+          appscale_up_thread = appscale_tools_thread.AppScaleUp(cloud_type,
+                                     keyname,
+                                     email,
+                                     password,
+                                     placement=ADVANCE_DEPLOYMENT,
+                                     machine=machine,
+                                     instance_type=instance_type,
+                                     infrastructure=infras,
+                                     ips_yaml=ips_yaml,
+                                     ec2_access=access_key,
+                                     ec2_secret=secret_key,
+                                     ec2_url=ec2_url,
+                                     transcript_store=TRANSCRIPT_STORE,
+                                     log_directory=settings.APPSCAKE_LOG_DIR,
+                                     deployment_registry=REGISTRY,
+                                     executor=get_executor())
+        elif deployment_type == SIMPLE_DEPLOYMENT:
+          min_nodes = max_nodes = form['max'].value()
+          appscale_up_thread = appscale_tools_thread.AppScaleUp(cloud_type,
+                                     keyname,
+                                     email,
+                                     password,
+                                     placement=SIMPLE_DEPLOYMENT,
+                                     machine=machine,
+                                     instance_type=instance_type,
+                                     infrastructure=infras,
+                                     max_nodes=max_nodes,
+                                     min_nodes=min_nodes,
+                                     ec2_access=access_key,
+                                     ec2_secret=secret_key,
+                                     ec2_url=ec2_url,
+                                     transcript_store=TRANSCRIPT_STORE,
+                                     log_directory=settings.APPSCAKE_LOG_DIR,
+                                     deployment_registry=REGISTRY,
+                                     executor=get_executor())
+        else:
+          REGISTRY.release_submission(idempotency_key)
+          return HttpResponseServerError(
+            "Unable to get the deployment strategy.")
+      elif cloud_type == CLUSTER_DEPLOY:
         ips_yaml = form['ips_yaml'].value()
-        appscale_up_thread = appscale_tools_thread.AppScaleUp(cloud_type,
-                                   keyname,
-                                   email,
-                                   password,
-                                   placement=ADVANCE_DEPLOYMENT,
-                                   machine=machine,
-                                   instance_type=instance_type,
-                                   infrastructure=infras,
-                                   ips_yaml=ips_yaml,
-                                   ec2_access=access_key,
-                                   ec2_secret=secret_key,
-                                   ec2_url=ec2_url)
-      elif deployment_type == SIMPLE_DEPLOYMENT:
-        min_nodes = max_nodes = form['max'].value()
-        appscale_up_thread = appscale_tools_thread.AppScaleUp(cloud_type,
-                                   keyname,
-                                   email,
-                                   password,
-                                   placement=SIMPLE_DEPLOYMENT,
-                                   machine=machine,
-                                   instance_type=instance_type,
-                                   infrastructure=infras,
-                                   max_nodes=max_nodes,
-                                   min_nodes=min_nodes,
-                                   ec2_access=access_key,
-                                   ec2_secret=secret_key,
-                                   ec2_url=ec2_url)
+        root_password = form['root_pass'].value()
+        appscale_up_thread = appscale_tools_thread.AppScaleUp(cloud_type, 
+                                     keyname,  
+                                     email,
+                                     password,
+                                     ips_yaml=ips_yaml,
+                                     root_pass=root_password,
+                                     preflight_timeout=
+                                       settings.APPSCAKE_PREFLIGHT_TIMEOUT,
+                                     transcript_store=TRANSCRIPT_STORE,
+                                     log_directory=settings.APPSCAKE_LOG_DIR,
+                                     deployment_registry=REGISTRY,
+                                     executor=get_executor())
       else:
-        return HttpResponseServerError("Unable to get the deployment strategy.")
-    elif cloud_type == CLUSTER_DEPLOY:
-      ips_yaml = form['ips_yaml'].value()
-      root_password = form['root_pass'].value()
-      appscale_up_thread = appscale_tools_thread.AppScaleUp(cloud_type, 
-                                   keyname,  
-                                   email,
-                                   password,
-                                   ips_yaml=ips_yaml,
-                                   root_pass=root_password)
-    else:
-      return HttpResponseServerError(
-        "Unable to figure out the type of cloud deployment.")  
-
-    appscale_up_thread.start()
-
-    identifier = appscale_up_thread.keyname
-    DEPLOYMENT_THREADS[identifier] = appscale_up_thread
+        REGISTRY.release_submission(idempotency_key)
+        return HttpResponseServerError(
+          "Unable to figure out the type of cloud deployment.")  
+
+      identifier = appscale_up_thread.keyname
+      DEPLOYMENT_THREADS[identifier] = appscale_up_thread
+      if cloud_type == CLOUD_DEPLOY:
+        DEPLOYMENT_CREDENTIALS[identifier] = {'ec2_access': access_key,
+          'ec2_secret': secret_key}
+
+      SCHEDULER.submit(appscale_up_thread, scheduler.DEPLOYMENT_PRIORITY)
+    except Exception:
+      REGISTRY.release_submission(idempotency_key)
+      DEPLOYMENT_THREADS.pop(keyname, None)
+      DEPLOYMENT_CREDENTIALS.pop(keyname, None)
+      raise
 
     return render(request, APPSCALE_STARTED_HTML_FILE_PATH, {'keyname': 
       identifier})
@@ -0,0 +1,172 @@
+""" Stops AppScale tools runs which have stalled, for example on SSH to an
+  unreachable node or a stuck cloud API call, so that they give their
+  scheduler slot back instead of running forever. Tools running in a run's
+  own thread cannot be killed, so such runs keep their slot until the tools
+  end. Also stops deployments which another process was asked to cancel.
+"""
+import logging
+import threading
+import time
+
+import registry
+import tools_worker
+
+
+# The number of seconds between checks of the running runs.
+CHECK_INTERVAL = 30
+
+# The number of seconds between checks for cancel and termination requests.
+CANCEL_INTERVAL = 2
+
+# The reason given for deployments that were cancelled.
+CANCEL_MESSAGE = "The deployment was cancelled."
+
+# The shortest time, in seconds, a run may spend in one phase, however
+# quick the phase is expected to be.
+MIN_PHASE_TIMEOUT = 600
+
+
+class RunWatchdog(threading.Thread):
+  """ A daemon thread which periodically checks the runs holding a slot in a
+  scheduler. A run times out if the tools print nothing for too long, or if
+  it stays in one phase much longer than the phase is expected to take.
+  Cancel and termination requests recorded in the deployment registry for
+  this process's deployments are checked more often.
+  """
+
+  def __init__(self, run_scheduler, idle_timeout, phase_timeout_factor,
+    deployment_registry=None, deployments=None, start_termination=None,
+    interval=CHECK_INTERVAL, cancel_interval=CANCEL_INTERVAL):
+    """ Constructor.
+
+    Args:
+      run_scheduler: The scheduler.DeploymentScheduler starting the runs.
+      idle_timeout: A float, the longest time in seconds the tools may go
+        without printing anything.
+      phase_timeout_factor: A float, how many times its expected duration a
+        phase may take (but never less than MIN_PHASE_TIMEOUT seconds).
+      deployment_registry: A registry.DeploymentRegistry holding cancel
+        and termination requests, or None to ignore them.
+      deployments: A dict mapping keynames to the AppScaleUp threads of this
+        process.
+      start_termination: A function called with the keyname of each
+        deployment of this process which another process asked to
+        terminate, or None to ignore such requests.
+      interval: A float, the number of seconds between checks for stalled
+        runs.
+      cancel_interval: A float, the number of seconds between checks for
+        cancel and termination requests.
+    """
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.run_scheduler = run_scheduler
+    self.idle_timeout = idle_timeout
+    self.phase_timeout_factor = phase_timeout_factor
+    self.interval = interval
+    self.deployment_registry = deployment_registry
+    self.deployments = deployments or {}
+    self.start_termination = start_termination
+    self.cancel_interval = min(cancel_interval, interval)
+
+  def run(self):
+    """ Checks the running runs until the process exits. """
+    last_check = time.time()
+    while True:
+      time.sleep(self.cancel_interval)
+      try:
+        self.check_cancel_requests()
+        self.check_termination_requests()
+        if time.time() - last_check >= self.interval:
+          last_check = time.time()
+          self.check_runs()
+      except Exception as exception:
+        logging.exception(exception)
+
+  def check_cancel_requests(self):
+    """ Cancels the deployments of this process that were asked to cancel
+    through the registry.
+
+    Returns:
+      An int, the number of deployments cancelled.
+    """
+    if not self.deployment_registry:
+      return 0
+    cancelled = 0
+    for keyname in self.deployment_registry.get_cancel_requests(
+      registry.DEPLOYMENT):
+      run = self.deployments.get(keyname)
+      if run is None:
+        continue
+      self.run_scheduler.remove(run)
+      try:
+        if run.cancel(CANCEL_MESSAGE):
+          cancelled += 1
+      except tools_worker.CommandNotCancellable:
+        # The request stays, and is carried out if the tools end between
+        # two commands.
+        logging.debug("Unable to cancel {0} yet.".format(keyname))
+    return cancelled
+
+  def check_termination_requests(self):
+    """ Starts the terminations that other processes asked this process for,
+    since only this process holds the credentials of its deployments.
+
+    Returns:
+      An int, the number of terminations started.
+    """
+    if not self.deployment_registry or not self.start_termination:
+      return 0
+    keynames = self.deployment_registry.get_run_requests(
+      registry.TERMINATION)
+    for keyname in keynames:
+      self.start_termination(keyname)
+    return len(keynames)
+
+  def check_runs(self):
+    """ Times out every stalled run. The progress of the others is estimated
+    again, since it moves on between the phase markers of the tools.
+
+    Returns:
+      An int, the number of runs timed out.
+    """
+    now = time.time()
+    timed_out = 0
+    for run in self.run_scheduler.get_running():
+      message = self.get_stall(run, now)
+      if message:
+        run.time_out(message)
+        timed_out += 1
+      else:
+        run.refresh_progress()
+    return timed_out
+
+  def get_stall(self, run, now):
+    """ Checks if a run has stalled.
+
+    Args:
+      run: An AppScaleUp or AppScaleDown thread.
+      now: A float, the current time in seconds since the epoch.
+    Returns:
+      A str saying why the run has stalled, or None if it has not.
+    """
+    # Stopped runs whose tools cannot be killed keep their slot until the
+    # tools end, and are not stopped again.
+    if run.started_at is None or run.state in run.STOPPED_STATES:
+      return None
+
+    writes = [run.std_out_capture.last_write, run.std_err_capture.last_write]
+    last_output = max([run.started_at] +
+      [written for written in writes if written is not None])
+    if now - last_output > self.idle_timeout:
+      return "The AppScale tools printed nothing for {0} minutes.".format(
+        int(self.idle_timeout / 60))
+
+    tracker = run.progress
+    expected = tracker.get_expected_phase_seconds()
+    if expected is None:
+      return None
+    timeout = max(expected * self.phase_timeout_factor, MIN_PHASE_TIMEOUT)
+    if now - tracker.phase_started_at > timeout:
+      return "The AppScale tools spent more than {0} minutes in one " \
+        "phase.".format(int(timeout / 60))
+    return None